@@ -32,6 +32,8 @@ import string
 
 from settings import authentication as auth_settings
 
+import protocol
+
 def rand_token(length, chars = string.digits):
     """
     At the moment, the token is only digits. This is to conserve bandwidth. It
@@ -65,15 +67,56 @@ class AuthenticatedClient(object):
             self.token = token
 
         self.last_frame_update = self.time_created
+        # When the client last sent a fragment, set by the receiver whether
+        # or not the fragment's frame is cached (it may only be relayed)
+        self.last_seen = self.time_created
+
+        # The fragment protocol version negotiated on authentication
+        self.protocol_version = 1
+
+        # Set once the client's token has expired, see
+        # `Authenticator.remove_client`
+        self.expired = False
 
         self.cache = None
 
 class Authenticator(object):
+    """
+    Maintains the list of authenticated clients, indexed by token and by
+    (host, identifier). The indexes are only modified with the lock held,
+    but token lookups happen for every received fragment, so they read the
+    index without taking the lock; single dict operations are atomic.
+    """
     def __init__(self):
         self.clients = []
 
+        # Map of token -> client
+        self._by_token = {}
+        # Map of (host, identifier) -> client
+        self._by_info = {}
+
         self.lock = threading.Lock()
 
+        # A dict-like map of token -> (host, identifier), shared with
+        # receiver worker processes. See `share_tokens`.
+        self.shared_tokens = None
+
+    def share_tokens(self, shared_tokens):
+        """
+        Publishes the tokens of all current and future clients to a map
+        shared with other processes, typically a `multiprocessing.Manager`
+        dict, so the processes can verify tokens issued by this one (see
+        `SharedTokenAuthenticator`).
+
+        :param shared_tokens The dict-like map of token -> (host, identifier)
+                             to publish to
+        """
+        with self.lock:
+            self.shared_tokens = shared_tokens
+
+            for client in self.clients:
+                shared_tokens[client.token] = (client.host, client.identifier)
+
     def add_new_client(self, host, identifier):
         """
         Attempts to create a new client object with the given information. The
@@ -85,28 +128,86 @@ class Authenticator(object):
         :return AuthenticatedClient The new (or existing) client object
 
         """
-        client = None
+        with self.lock:
+            client = self._by_info.get((host, identifier))
 
-        try:
-            client = self.get_client_by_info(host, identifier)
+            if client is not None:
+                logging.debug("Found client matching host '%s', uuid: '%s'",
+                    host, client.uuid)
 
-            logging.debug("Found client matching host '%s', uuid: '%s'",
-                host, client.uuid)
+                return client
 
-        except NoClientFoundError:
             logging.debug("No client matching '%s' (%s), creating a new one", 
                 host, identifier)
 
             client = AuthenticatedClient(host, identifier)
 
-            with self.lock:
-                self.clients.append(client)
+            # Tokens are short, so make sure we haven't handed this one out
+            # already
+            while client.token in self._by_token:
+                client.token = rand_token(8)
 
-            logging.debug("Created client for '%s' ('%s'). uuid: %s, token: %s", 
-                host, identifier, client.uuid, client.token)
+            self.clients.append(client)
+            self._by_token[client.token] = client
+            self._by_info[(host, identifier)] = client
 
-        finally:
-            return client
+            if self.shared_tokens is not None:
+                self.shared_tokens[client.token] = (host, identifier)
+
+        logging.debug("Created client for '%s' ('%s'). uuid: %s, token: %s", 
+            host, identifier, client.uuid, client.token)
+
+        return client
+
+    def remove_client(self, client):
+        """
+        Removes a client, expiring its token. The client's feed must be
+        removed from the feed cache separately.
+
+        :param client The client to remove
+        """
+        with self.lock:
+            if self._by_token.get(client.token) is client:
+                del self._by_token[client.token]
+
+            if self._by_info.get((client.host, client.identifier)) is client:
+                del self._by_info[(client.host, client.identifier)]
+
+            if client in self.clients:
+                self.clients.remove(client)
+
+            client.expired = True
+
+            if self.shared_tokens is not None:
+                self.shared_tokens.pop(client.token, None)
+
+        logging.debug("Removed client for '%s' ('%s'), token: %s",
+            client.host, client.identifier, client.token)
+
+    def get_idle_clients(self, timeout):
+        """
+        :param timeout Seconds without a fragment after which a client is
+                       idle
+
+        :return A list of the clients which haven't sent a fragment for
+                longer than `timeout` (or since authenticating, if they never
+                have)
+        """
+        now = time.time()
+
+        with self.lock:
+            return [ client for client in self.clients
+                     if now - client.last_seen > timeout ]
+
+    def find_client_by_token(self, token):
+        """
+        Finds the client a token belongs to, without raising on a miss.
+
+        :param token The token to look up
+
+        :return The client matching the token, or None if there is no match
+        """
+        return self._by_token.get(token)
 
     def authenticate_token(self, token):
         """
@@ -120,35 +221,122 @@ class Authenticator(object):
 
         :raises InvalidAuthenticationTokenError When the token is invalid
         """
-        
-        try:
-            client = self.get_client_by_token(token)
+        client = self.find_client_by_token(token)
 
-            return client
+        if client is None:
+            raise InvalidAuthenticationTokenError(
+                    "Invalid token '%s'" % token
+                )
 
-        except NoClientFoundError:
-            raise InvalidAuthenticationTokenError("")
+        return client
 
     def get_client_by_info(self, host, identifier):
-        with self.lock:
-            for c in self.clients:
-                if c.host == host and c.identifier == identifier:
-                    return c
+        client = self._by_info.get((host, identifier))
 
+        if client is None:
             raise NoClientFoundError(
                     "No client found matching host '%s'" % host
                 )
 
+        return client
+
     def get_client_by_token(self, token):
-        with self.lock:
-            for c in self.clients:
-                if c.token == token:
-                    return c
+        client = self._by_token.get(token)
 
+        if client is None:
             raise NoClientFoundError(
                     "No client found matching token '%s'" % token
                 )
 
+        return client
+
+class SharedTokenAuthenticator(object):
+    """
+    Verifies tokens in a process other than the one running the
+    authentication server, such as a receiver worker process. Tokens are
+    looked up in the map published by `Authenticator.share_tokens`, and
+    remembered locally, so the shared map is only consulted the first time
+    a token is seen. Unknown tokens are also remembered for a short while,
+    so a flood of invalid fragments doesn't become a flood of lookups.
+    Tokens which have since expired are found with `revalidate`.
+    """
+    # Seconds before looking up an unknown token again
+    miss_interval = 1.0
+
+    def __init__(self, shared_tokens):
+        self.shared_tokens = shared_tokens
+
+        # Map of token -> client, for tokens already looked up
+        self._by_token = {}
+        # Map of token -> time of the failed lookup
+        self._misses = {}
+
+        self.lock = threading.Lock()
+
+    def find_client_by_token(self, token):
+        """
+        Finds the client a token belongs to, without raising on a miss.
+
+        :param token The token to look up
+
+        :return An AuthenticatedClient for the token, or None if the token
+                hasn't been issued
+        """
+        client = self._by_token.get(token)
+
+        if client is not None:
+            return client
+
+        with self.lock:
+            # Another reader thread may have looked it up in the meantime
+            client = self._by_token.get(token)
+
+            if client is not None:
+                return client
+
+            now = time.time()
+
+            missed = self._misses.get(token)
+            if missed is not None and now - missed < self.miss_interval:
+                return None
+
+            info = self.shared_tokens.get(token)
+
+            if info is None:
+                if len(self._misses) > 1024:
+                    self._misses.clear()
+
+                self._misses[token] = now
+
+                return None
+
+            host, identifier = info
+
+            client = AuthenticatedClient(host, identifier, token)
+
+            self._by_token[token] = client
+            self._misses.pop(token, None)
+
+        return client
+
+    def revalidate(self):
+        """
+        Checks the tokens looked up so far are still in the shared map, and
+        forgets those which aren't, marking their clients expired.
+
+        :return A list of the expired clients
+        """
+        expired = []
+
+        for token, client in self._by_token.items():
+            if self.shared_tokens.get(token) is None:
+                with self.lock:
+                    self._by_token.pop(token, None)
+
+                client.expired = True
+                expired.append(client)
+
+        return expired
 
 class AuthenticationServerHandler(SocketServer.BaseRequestHandler):
     """
@@ -156,13 +344,17 @@ class AuthenticationServerHandler(SocketServer.BaseRequestHandler):
     connection remains open until either end hangs up. 
 
     An authentication attempt is in the form:
-    \x01\x00<identifier>\x00
+    \x01\x00<identifier>\x00[<protocol version>\x00]
     where <identifier> is a custom string used to identify the source, ideally
-    well named so as to allow viewers to identify the stream.
+    well named so as to allow viewers to identify the stream. The optional
+    <protocol version> is the highest fragment protocol version the
+    transmitter supports (see the `protocol` module), and defaults to 1.
 
 
     A response is in the form:
-    \x01\x00<challenge_token>\x00<receiver ip>\x00<receiver port>\x00
+    \x01\x00<challenge_token>\x00<receiver ip>\x00<receiver port>\x00<protocol version>\x00
+    where <protocol version> is the fragment protocol version the transmitter
+    should use. Old transmitters simply ignore the trailing field.
 
     No additional parameters are required, and the source address must be
     whitelisted. TCP source is not spoofable like UDP sources (but can
@@ -192,24 +384,37 @@ class AuthenticationServerHandler(SocketServer.BaseRequestHandler):
             # was successfully verified by the server in `verify_request`), we
             # can safely acknowledge the authentication.
             client = None
+            request = data.split("\x00")
 
             try:
                 client = self.server.authenticator.add_new_client(
                             self.client_address[0],
-                            data.split("\x00")[1]
+                            request[1]
                         )
 
             except:
                 logging.exception("An exception occurred creating a new client")
                 return
 
+            # Use the highest protocol version supported by both ends
+            requested_version = 1
+            if len(request) > 3 and request[2]:
+                try:
+                    requested_version = int(request[2])
+                except ValueError:
+                    logging.warn("Invalid protocol version '%s' from '%s'",
+                        request[2], self.client_address[0])
+
+            client.protocol_version = max(1, min(requested_version,
+                auth_settings.protocol_version, protocol.PROTOCOL_VERSION))
 
             self.server.storage_manager.add_client(client)
 
-            self.request.send("\x01\x00%s\x00%s\x00%s\x00" % (
+            self.request.send("\x01\x00%s\x00%s\x00%s\x00%d\x00" % (
                         client.token,
                         self.server.receiver_address[0],
-                        self.server.receiver_address[1]
+                        self.server.receiver_address[1],
+                        client.protocol_version
                     )
                 )
 
@@ -252,19 +457,30 @@ class AuthenticationServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
 class SimpleAuthenticationClient(object):
     """
     A basic implementation of a client which authenticates with the server and
-    stores the retrieved token and receiver address.
+    stores the retrieved token, receiver address and negotiated protocol
+    version. Frames can then be split into datagrams with `fragment_frame`.
     """
-    def __init__(self, server_address, identifier):
+    def __init__(self, server_address, identifier, 
+                 protocol_version = protocol.PROTOCOL_VERSION,
+                 checksum = False, timeout = None):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Timeout in seconds for connecting and waiting for the response
+        self.socket.settimeout(timeout)
 
         self.server_address = server_address
         self.identifier = identifier
 
+        # The highest version we ask for, the server may choose a lower one
+        self.requested_protocol_version = protocol_version
+        # Whether to checksum fragment payloads, if supported by the protocol
+        self.checksum = checksum
+
         self.authenticated = False
         self.connected = False
 
         self.token = None
         self.receiver_address = None
+        self.protocol_version = 1
 
     def authenticate(self):
         if self.authenticated:
@@ -273,7 +489,8 @@ class SimpleAuthenticationClient(object):
         self._connect()
 
         # Send auth code
-        self.socket.send("\x01\x00%s\x00" % (self.identifier,))
+        self.socket.send("\x01\x00%s\x00%d\x00" % (self.identifier,
+            self.requested_protocol_version))
 
         # Wait for response
         resp = self.socket.recv(128)
@@ -287,11 +504,40 @@ class SimpleAuthenticationClient(object):
             self.token = token
             self.receiver_address = (r_host, int(r_port))
 
-            print "Succesfully authenticated! Token: %s, recv address: %s" % (
-                token, self.receiver_address)
+            # Servers which predate protocol negotiation only speak version 1
+            if len(resp) > 5 and resp[4]:
+                self.protocol_version = int(resp[4])
+
+            print "Succesfully authenticated! Token: %s, recv address: %s, " \
+                "protocol version: %d" % (token, self.receiver_address, 
+                                          self.protocol_version)
 
             self.authenticated = True
 
+    def fragment_frame(self, sequence_num, frame, max_payload_size):
+        """
+        Splits a frame into datagrams to send to the receiver, using the
+        negotiated protocol version.
+
+        :param sequence_num The ID of the frame
+        :param frame The encoded frame
+        :param max_payload_size The maximum size of each fragment's payload
+
+        :return A list of datagrams
+        """
+        return protocol.fragment_frame(self.token, sequence_num, frame,
+                                       max_payload_size, 
+                                       self.protocol_version, self.checksum)
+
+    def close(self):
+        """
+        Closes the connection to the authentication server. The token and
+        receiver address remain valid.
+        """
+        self.socket.close()
+
+        self.connected = False
+
     def _connect(self):
         if not self.connected:
             self.socket.connect(self.server_address)
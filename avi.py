@@ -0,0 +1,444 @@
+"""
+avi.py
+
+Writes recordings of feeds as Motion JPEG AVI files. Transmitters already
+send every frame as a JPEG, which is exactly what an MJPEG stream holds, so
+frames are appended to the file as they are, without being decoded or
+encoded again. The frame size written in the headers is read from the first
+frame's JPEG header.
+
+The file is written in a single pass: the headers are written with
+placeholder sizes, frames are appended as they arrive, and the sizes, frame
+count, framerate and the AVI index are filled in when the writer is closed.
+Frames are buffered until the writer is flushed, so a batch of frames is
+written with a single call.
+
+Alongside every AVI, a timestamp index records the time every frame was
+received and where its data is in the AVI (see `INDEX_ENTRY`). It is
+appended to as frames are written, so it's usable even if the AVI was never
+closed, and lets a recording be read from any point in time without
+parsing the AVI (see `AVIReader`).
+"""
+
+import logging
+import mmap
+import os
+import struct
+
+# Extension of the timestamp index written next to each AVI
+INDEX_EXTENSION = ".idx"
+
+# timestamp, offset of the frame data in the AVI, frame length
+INDEX_ENTRY = struct.Struct("!dQI")
+
+# RIFF chunk header: FourCC, size
+CHUNK_HEADER = struct.Struct("<4sI")
+
+# MainAVIHeader: microseconds per frame, max bytes per second, padding
+# granularity, flags, total frames, initial frames, streams, suggested
+# buffer size, width, height, 4 reserved
+MAIN_HEADER = struct.Struct("<IIIIIIIIII16x")
+
+# AVIStreamHeader: type, handler, flags, priority, language, initial frames,
+# scale, rate, start, length, suggested buffer size, quality, sample size,
+# frame rectangle
+STREAM_HEADER = struct.Struct("<4s4sIHHIIIIIIiIhhhh")
+
+# BITMAPINFOHEADER: size, width, height, planes, bit count, compression,
+# image size, horizontal and vertical resolution, colours used, colours
+# important
+BITMAP_HEADER = struct.Struct("<IiiHH4sIiiII")
+
+# AVIINDEXENTRY: chunk id, flags, offset, length
+AVI_INDEX_ENTRY = struct.Struct("<4sIII")
+
+# The most frame data written to a single AVI. The RIFF sizes of AVI 1.0
+# files are limited to 4 GB, and many players can't read files over 1 GB.
+MAX_MOVI_SIZE = 1024 * 1024 * 1024
+
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+
+# The framerate is written as the microseconds per frame
+RATE_SCALE = 1000000
+
+# JPEG start of frame markers (SOF0 to SOF15, except DHT, JPG and DAC)
+SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - frozenset((0xc4, 0xc8, 0xcc))
+
+# Markers without a length
+STANDALONE_MARKERS = frozenset(range(0xd0, 0xd9)) | frozenset((0x01,))
+
+# Start of scan, after which there are no more headers
+SOS_MARKER = 0xda
+
+def get_jpeg_dimensions(frame):
+    """
+    Reads a JPEG's dimensions from its start of frame header.
+
+    :param frame The JPEG data, a str
+
+    :return A (width, height) tuple, or None if the frame has no start of
+            frame header before its image data
+    """
+    if frame[:2] != "\xff\xd8":
+        return None
+
+    position = 2
+    while position + 4 <= len(frame):
+        if frame[position] != "\xff":
+            return None
+
+        marker = ord(frame[position + 1])
+        position += 2
+
+        if marker == 0xff:
+            # Fill byte, the marker follows
+            position -= 1
+            continue
+
+        if marker in STANDALONE_MARKERS:
+            continue
+
+        if marker == SOS_MARKER:
+            return None
+
+        length, = struct.unpack_from("!H", frame, position)
+
+        if marker in SOF_MARKERS:
+            if position + 7 > len(frame):
+                return None
+
+            height, width = struct.unpack_from("!HH", frame, position + 3)
+
+            return width, height
+
+        position += length
+
+    return None
+
+def get_index_path(path):
+    """
+    :return The path of the timestamp index of the AVI at `path`
+    """
+    return os.path.splitext(path)[0] + INDEX_EXTENSION
+
+def get_start_time(path):
+    """
+    Reads the time of an AVI's first frame from its timestamp index, without
+    reading the rest of the index.
+
+    :param path The path of the AVI
+
+    :return The timestamp of the first frame, or None if it has no frames
+    """
+    try:
+        with open(get_index_path(path), "rb") as f:
+            entry = f.read(INDEX_ENTRY.size)
+
+    except IOError:
+        return None
+
+    if len(entry) < INDEX_ENTRY.size:
+        return None
+
+    return INDEX_ENTRY.unpack(entry)[0]
+
+class AVIWriter(object):
+    """
+    Appends JPEG frames to an MJPEG AVI, along with its timestamp index.
+    Frames are only written once the writer is flushed (or closed). Writers
+    aren't thread safe.
+    """
+    def __init__(self, path, fps):
+        """
+        :param path The path of the AVI to create
+        :param fps The framerate to write in the headers until the writer is
+                   closed, when the framerate of the frames written is
+                   measured instead
+        """
+        self.path = path
+        self.fps = fps
+
+        self.width = 0
+        self.height = 0
+
+        self.frames_written = 0
+        self.bytes_written = 0
+
+        self.first_timestamp = None
+        self.last_timestamp = None
+
+        self._max_frame_size = 0
+
+        # AVI index entries of every frame, written when the writer's closed
+        self._avi_index = bytearray()
+
+        # Chunks and timestamp index entries of the frames not yet flushed
+        self._pending_chunks = []
+        self._pending_entries = []
+
+        self._file = open(path, "wb")
+        self._index_file = open(get_index_path(path), "wb")
+
+        self._write_headers()
+
+        # Offsets in the AVI index are relative to the 'movi' list's FourCC
+        self._movi_offset = self._file.tell() - 4
+
+    def _write_headers(self):
+        """
+        Writes the AVI's headers. Until the writer is closed, the sizes and
+        frame counts are zero.
+        """
+        self._file.seek(0)
+
+        if self.frames_written > 0:
+            duration = self.last_timestamp - self.first_timestamp
+            if duration > 0 and self.frames_written > 1:
+                self.fps = (self.frames_written - 1) / duration
+
+        fps = min(self.fps, RATE_SCALE) if self.fps > 0 else 1
+        frame_time = int(round(RATE_SCALE / fps))
+
+        main_header = MAIN_HEADER.pack(frame_time,
+            min(int(self._max_frame_size * fps), 0xffffffff), 0,
+            AVIF_HASINDEX, self.frames_written, 0, 1, self._max_frame_size,
+            self.width, self.height)
+
+        stream_header = STREAM_HEADER.pack("vids", "MJPG", 0, 0, 0, 0,
+            frame_time, RATE_SCALE, 0, self.frames_written,
+            self._max_frame_size, -1, 0, 0, 0, self.width, self.height)
+
+        bitmap_header = BITMAP_HEADER.pack(BITMAP_HEADER.size, self.width,
+            self.height, 1, 24, "MJPG", self.width * self.height * 3, 0, 0,
+            0, 0)
+
+        stream_list = "".join((
+            self._pack_chunk("strh", stream_header),
+            self._pack_chunk("strf", bitmap_header)))
+
+        header_list = "".join((
+            self._pack_chunk("avih", main_header),
+            self._pack_list("strl", stream_list)))
+
+        movi_size = 4 + self.bytes_written
+
+        riff_size = (4 + CHUNK_HEADER.size + 4 + len(header_list)
+                     + CHUNK_HEADER.size + movi_size)
+        if self.frames_written > 0:
+            riff_size += CHUNK_HEADER.size + len(self._avi_index)
+
+        self._file.write(CHUNK_HEADER.pack("RIFF", riff_size) + "AVI ")
+        self._file.write(self._pack_list("hdrl", header_list))
+        self._file.write(CHUNK_HEADER.pack("LIST", movi_size) + "movi")
+
+    def _pack_chunk(self, fourcc, data):
+        return CHUNK_HEADER.pack(fourcc, len(data)) + data
+
+    def _pack_list(self, fourcc, data):
+        return CHUNK_HEADER.pack("LIST", 4 + len(data)) + fourcc + data
+
+    def is_full(self, frame):
+        """
+        :return True if the frame wouldn't fit in the AVI (see
+                `MAX_MOVI_SIZE`)
+        """
+        return (self.bytes_written + CHUNK_HEADER.size + len(frame) + 1
+                > MAX_MOVI_SIZE)
+
+    def write(self, frame, timestamp):
+        """
+        Appends a frame.
+
+        :param frame The JPEG data of the frame, a str
+        :param timestamp The time the frame was received
+        """
+        if self.frames_written == 0:
+            dimensions = get_jpeg_dimensions(frame)
+
+            if dimensions is None:
+                logging.warn("No JPEG dimensions found in the first frame of "
+                    "%s", self.path)
+
+            else:
+                self.width, self.height = dimensions
+
+            self.first_timestamp = timestamp
+
+        chunk_offset = self._movi_offset + 4 + self.bytes_written
+
+        # Chunks are padded to an even length
+        padding = "\x00" * (len(frame) % 2)
+
+        self._pending_chunks.extend((CHUNK_HEADER.pack("00dc", len(frame)),
+                                     frame, padding))
+
+        self._pending_entries.append(INDEX_ENTRY.pack(timestamp,
+            chunk_offset + CHUNK_HEADER.size, len(frame)))
+
+        self._avi_index += AVI_INDEX_ENTRY.pack("00dc", AVIIF_KEYFRAME,
+            chunk_offset - self._movi_offset, len(frame))
+
+        self.bytes_written += CHUNK_HEADER.size + len(frame) + len(padding)
+        self.frames_written += 1
+
+        self._max_frame_size = max(self._max_frame_size, len(frame))
+        self.last_timestamp = timestamp
+
+    def flush(self):
+        """
+        Writes the frames written since the last flush. The timestamp index
+        is only written after the frames it points at.
+        """
+        if self._pending_chunks:
+            self._file.write("".join(self._pending_chunks))
+            self._pending_chunks = []
+
+        self._file.flush()
+
+        if self._pending_entries:
+            self._index_file.write("".join(self._pending_entries))
+            self._pending_entries = []
+
+        self._index_file.flush()
+
+    def sync(self):
+        """
+        Flushes, then waits for the files to reach the disk.
+        """
+        self.flush()
+
+        os.fsync(self._file.fileno())
+        os.fsync(self._index_file.fileno())
+
+    def close(self):
+        """
+        Writes the AVI index and fills in the headers, then closes the files.
+        """
+        if self._file is None:
+            return
+
+        try:
+            self.flush()
+
+            if self.frames_written > 0:
+                self._file.write(CHUNK_HEADER.pack("idx1",
+                                                   len(self._avi_index)))
+                self._file.write(self._avi_index)
+
+                self._write_headers()
+
+        finally:
+            self._file.close()
+            self._index_file.close()
+
+            self._file = None
+            self._index_file = None
+
+class AVIReader(object):
+    """
+    Reads the frames of an AVI written by an AVIWriter, through its timestamp
+    index, so frames can be found by time without scanning the AVI. Only the
+    index is read into memory. The AVI is memory mapped, so frames are only
+    read from the disk (by the OS, which reads ahead) as they're needed.
+
+    A recording still being written can be read, up to the frames written
+    when the reader was opened.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        with open(get_index_path(path), "rb") as f:
+            self._index = f.read()
+
+        # A partly written last entry is ignored
+        self.frame_count = len(self._index) // INDEX_ENTRY.size
+
+        self._map = None
+
+        if self.frame_count > 0:
+            with open(path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    def get_entry(self, position):
+        """
+        :param position The position of a frame in the AVI
+
+        :return The frame's (timestamp, offset, length) tuple
+        """
+        if not 0 <= position < self.frame_count:
+            raise IndexError("Frame %d out of range" % position)
+
+        return INDEX_ENTRY.unpack_from(self._index,
+                                       position * INDEX_ENTRY.size)
+
+    def get_timestamp(self, position):
+        return self.get_entry(position)[0]
+
+    @property
+    def start_time(self):
+        """
+        :return The timestamp of the first frame, or None if there are none
+        """
+        return self.get_timestamp(0) if self.frame_count else None
+
+    @property
+    def end_time(self):
+        """
+        :return The timestamp of the last frame, or None if there are none
+        """
+        return self.get_timestamp(self.frame_count - 1) if self.frame_count \
+            else None
+
+    def find_frame(self, timestamp):
+        """
+        Binary searches the index for the first frame received at or after a
+        given time.
+
+        :param timestamp The time, as returned by `time.time`
+
+        :return The position of the frame, or `frame_count` if every frame
+                was received before `timestamp`
+        """
+        low = 0
+        high = self.frame_count
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self.get_timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def read_frame(self, position):
+        """
+        :param position The position of a frame in the AVI
+
+        :return The (frame, timestamp) of the frame
+        """
+        timestamp, offset, length = self.get_entry(position)
+
+        return self._map[offset:offset + length], timestamp
+
+    def read_frames(self, start_time, end_time = None):
+        """
+        Reads the frames received within a time range, in order.
+
+        :param start_time The time of the first frame wanted
+        :param end_time The time of the last frame wanted, or None for all
+                        frames from `start_time`
+
+        :return A generator of (frame, timestamp) tuples
+        """
+        for position in xrange(self.find_frame(start_time), self.frame_count):
+            if end_time is not None and self.get_timestamp(position) > end_time:
+                break
+
+            yield self.read_frame(position)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
@@ -0,0 +1,237 @@
+"""
+broadcaster.py
+
+Distributes the frames of a feed to all of its viewers. Each frame is encoded
+as a part of the multipart stream once, when it is received, and the same
+immutable string is then written to every subscribed connection, rather than
+every viewer building its own copy of every frame.
+"""
+
+import collections
+import logging
+import time
+
+import tornado.ioloop
+
+# Seconds without a new frame before a stream is considered finished
+STREAM_TIMEOUT = 10
+
+# The number of recently encoded frames kept for viewers reading frames from
+# the cache (see `FeedBroadcaster.get_encoded_frame`)
+ENCODED_CACHE_SIZE = 64
+
+PART_HEADER = b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+
+class EncodedFrame(object):
+    """
+    A frame encoded as a part of the multipart stream. Connections using
+    HTTP/1.1 chunked transfer encoding need the part wrapped in a chunk, which
+    tornado would otherwise do for every connection, so that framing is also
+    built here (once, and only if a connection needs it).
+    """
+    def __init__(self, frame, timestamp, sequence_num):
+        self.frame = frame
+        self.timestamp = timestamp
+        self.sequence_num = sequence_num
+
+        self._part = None
+        self._chunk = None
+
+    def get_data(self, chunked):
+        """
+        :param chunked Whether the connection uses chunked transfer encoding
+
+        :return The encoded frame as a str, ready to be written as is
+        """
+        header = PART_HEADER % len(self.frame)
+
+        if not chunked:
+            if self._part is None:
+                self._part = b"".join((header, self.frame, b"\r\n"))
+
+            return self._part
+
+        if self._chunk is None:
+            part_len = len(header) + len(self.frame) + 2
+
+            self._chunk = b"".join((b"%x\r\n" % part_len, header, self.frame,
+                                    b"\r\n\r\n"))
+
+        return self._chunk
+
+class FeedBroadcaster(object):
+    """
+    Broadcasts the frames of a single feed to its subscribers. Subscribers
+    must provide `send_frame(encoded_frame)`, and `end_stream()`, called when
+    the feed times out. Subscribers update `bytes_sent` and `frames_skipped`
+    as they write frames out (or skip them if they fall behind). All
+    methods must be called on the IOLoop; frames are handed over to the
+    IOLoop from whichever thread completed them, or broadcast straight away
+    if they were completed on the IOLoop itself (see the "ioloop" receiver).
+    """
+    def __init__(self, frame_cache, io_loop = None, timeout = STREAM_TIMEOUT):
+        self.frame_cache = frame_cache
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.timeout = timeout
+
+        self.subscribers = set()
+
+        # The most recent EncodedFrame, sent to viewers as soon as they join
+        self.latest_frame = None
+
+        # Map of (sequence number, timestamp) -> EncodedFrame, of the most
+        # recently encoded frames
+        self._encoded_frames = collections.OrderedDict()
+
+        # Stats
+        self.frames_broadcast = 0
+        self.bytes_sent = 0
+        self.frames_skipped = 0
+        # Total seconds between frames being completed and being broadcast
+        self.latency_total = 0.0
+
+        self._last_frame_time = time.time()
+
+        # Only runs while there are subscribers
+        self._timeout_checker = tornado.ioloop.PeriodicCallback(
+                                        self._check_timeout, 1000,
+                                        io_loop = self.io_loop)
+
+        self.frame_cache.add_listener(self._on_frame)
+
+    @property
+    def subscriber_count(self):
+        return len(self.subscribers)
+
+    @property
+    def mean_latency(self):
+        """
+        :return The mean seconds between a frame being completed by the
+                receiver and being handed to the subscribers
+        """
+        if not self.frames_broadcast:
+            return 0.0
+
+        return self.latency_total / self.frames_broadcast
+
+    def get_encoded_frame(self, frame_info):
+        """
+        Gets a frame encoded as a part of the multipart stream, encoding it
+        only if it hasn't been recently. Viewers reading frames from the
+        cache rather than being sent every new frame use this, so viewers at
+        the same position share the encoded frames.
+
+        :param frame_info The (frame, timestamp, sequence number) tuple
+
+        :return The frame's EncodedFrame
+        """
+        frame, ts, sequence_num = frame_info
+
+        # Sequence numbers restart with the transmitter, timestamps don't
+        key = (sequence_num, ts)
+
+        encoded = self._encoded_frames.get(key)
+
+        if encoded is None:
+            encoded = EncodedFrame(frame, ts, sequence_num)
+
+            self._encoded_frames[key] = encoded
+
+            if len(self._encoded_frames) > ENCODED_CACHE_SIZE:
+                self._encoded_frames.popitem(last = False)
+
+        return encoded
+
+    def subscribe(self, subscriber):
+        """
+        Adds a subscriber, and sends it the most recent frame straight away
+        rather than waiting for the next one.
+        """
+        self.subscribers.add(subscriber)
+
+        if len(self.subscribers) == 1:
+            self._last_frame_time = time.time()
+            self._timeout_checker.start()
+
+        if self.latest_frame is None:
+            # Frames aren't encoded while nobody is watching
+            latest = self.frame_cache.get_latest_frame()
+
+            if latest is not None:
+                self.latest_frame = self.get_encoded_frame(latest)
+
+        if self.latest_frame is not None:
+            self._send(subscriber, self.latest_frame)
+
+        logging.debug("Viewer joined feed '%s', %d viewers",
+            self.frame_cache.client.identifier, len(self.subscribers))
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+        if not self.subscribers:
+            self._timeout_checker.stop()
+
+        logging.debug("Viewer left feed '%s', %d viewers, %d bytes sent, %d "
+            "frames skipped, %.2f ms mean broadcast latency",
+            self.frame_cache.client.identifier, len(self.subscribers),
+            self.bytes_sent, self.frames_skipped, 1000 * self.mean_latency)
+
+    def close(self):
+        """
+        Stops broadcasting, and ends the streams of all subscribers
+        """
+        self.frame_cache.remove_listener(self._on_frame)
+        self._timeout_checker.stop()
+
+        for subscriber in list(self.subscribers):
+            subscriber.end_stream()
+
+    def _on_frame(self, frame_info):
+        """
+        Frame cache listener, called from the thread which completed a frame.
+        """
+        if self.subscribers:
+            if tornado.ioloop.IOLoop.current(instance = False) is self.io_loop:
+                # Already on the IOLoop, no need to wait for the next
+                # iteration
+                self._broadcast(frame_info)
+
+            else:
+                self.io_loop.add_callback(self._broadcast, frame_info)
+
+        else:
+            # Don't hold on to stale frames for the next viewer
+            self.latest_frame = None
+
+            if self._encoded_frames:
+                # The encoded frames are only touched on the IOLoop
+                self.io_loop.add_callback(self._encoded_frames.clear)
+
+    def _broadcast(self, frame_info):
+        encoded = self.get_encoded_frame(frame_info)
+
+        self.latest_frame = encoded
+        self._last_frame_time = time.time()
+        self.frames_broadcast += 1
+        self.latency_total += self._last_frame_time - encoded.timestamp
+
+        # Subscribers may unsubscribe while we're sending
+        for subscriber in list(self.subscribers):
+            self._send(subscriber, encoded)
+
+    def _send(self, subscriber, encoded):
+        try:
+            subscriber.send_frame(encoded)
+
+        except:
+            logging.exception("Exception sending frame %d to %s",
+                encoded.sequence_num, subscriber)
+
+    def _check_timeout(self):
+        if time.time() - self._last_frame_time > self.timeout:
+            logging.info("Feed '%s' timed out, ending %d streams",
+                self.frame_cache.client.identifier, len(self.subscribers))
+
+            for subscriber in list(self.subscribers):
+                subscriber.end_stream()
@@ -8,15 +8,15 @@ multiple application threads.
 
 import logging
 import collections
+import functools
 import time
 import threading
-import operator
 
 class NoCacheFoundError(Exception):
     """ Raised when no cache is found during a search """
     pass
 
-class IncompleteFrameError(object):
+class IncompleteFrameError(Exception):
     """ Raised when trying to get a frame from fragments when insufficient
     fragments exist """
     pass
@@ -27,14 +27,72 @@ class FeedCache(object):
     by the daemon. This is necessary for us to share the cache between
     multiple providers (i.e. between the observer, relay and receiver
     servers).
+
+    Feeds are only added and removed with the lock held. Lookups are far
+    more common (every fragment and every viewer request), so they read the
+    dicts without taking the lock; single dict operations are atomic.
+
+    Besides every feed's frame count limit, the frames of all feeds together
+    may be limited to `max_bytes`. Whenever a frame is added beyond the
+    limit, the oldest frames across all feeds are evicted, although every
+    feed keeps at least its newest frame. The total is kept as frames are
+    added and removed, and the frames of all feeds are queued in the order
+    they were cached, so the oldest frame is found without going through
+    every feed. Feeds can also be limited to the
+    frames received in the last `cache_window` seconds (or their entry in
+    `feed_windows`).
     """
-    def __init__(self, max_cache_size):
+    def __init__(self, max_cache_size, reassembly_window = 16,
+                 reassembly_timeout = 2.0, store_factory = None,
+                 max_bytes = None, cache_window = None, feed_windows = None):
         self.max_cache_size = max_cache_size
 
+        # The byte budget of all feeds, None for no limit
+        self.max_bytes = max_bytes
+
+        # Map of identifier -> seconds of frames to keep, for feeds not using
+        # the default window. A window of None keeps frames regardless of
+        # their age.
+        self.cache_window = cache_window
+        self.feed_windows = feed_windows or {}
+
+        # Passed on to every FrameCache, see `FrameCache.add_frame`
+        self.reassembly_window = reassembly_window
+        self.reassembly_timeout = reassembly_timeout
+
+        # A callable taking a client and the cache size, returning the frame
+        # store for the client's FrameCache (see `FrameCache`). Frames are
+        # kept in a deque if not given.
+        self.store_factory = store_factory
+
+        # Map of client -> FrameCache
         self.caches = {}
+        # Map of client identifier -> FrameCache, for viewer lookups
+        self._index = {}
 
         self.lock = threading.RLock()
 
+        # The total size of the frames of all feeds
+        self.resident_bytes = 0
+        # (FrameCache, sequence number) of the cached frames of all feeds,
+        # oldest first, when there's a byte budget. Frames since removed
+        # otherwise are skipped when they're reached, or dropped when the
+        # queue is compacted (see `_compact_arrivals`).
+        self._arrivals = collections.deque()
+        # Held while updating the two above
+        self._resident_lock = threading.Lock()
+
+        # Held while evicting frames over the byte budget
+        self._eviction_lock = threading.Lock()
+
+        # Frames evicted to keep within the byte budget
+        self.frames_evicted = 0
+
+        # Callables notified of new frames in any feed, see `add_listener`
+        self._listeners = []
+        # Callables notified of removed feeds, see `add_removal_listener`
+        self._removal_listeners = []
+
     def cache_frame(self, client, sequence_num, max_fragments, fragment_num, 
                     frame):
         """
@@ -46,23 +104,246 @@ class FeedCache(object):
         :param sequence_num The ID of the frame
         :param max_fragments The number of fragments in the sequence
         :param fragment_num The ID of the fragment in the sequence
-        :param frame The raw frame data, potentially a fragment
+        :param frame The raw frame data, potentially a fragment. This may be a
+                     memoryview over a receive buffer, which is copied once
+                     when it is stored in the fragment cache
+        """
+        cache = self.caches.get(client)
+
+        if cache is None:
+            cache = self._create_cache(client)
+
+        cache.add_frame(sequence_num, max_fragments, fragment_num, frame)
+
+    def _create_cache(self, client):
         """
-        cache = None
+        Creates the FrameCache for a client, unless another thread got there
+        first.
 
+        :param client The client to create the cache for
+
+        :return The client's FrameCache
+        """
         # We need to lock this so multiple caches cannot be created/overriden
         # for the same client by multiple threads
         with self.lock:
-            if client not in self.caches:
-                cache = FrameCache(self.max_cache_size, client)
+            cache = self.caches.get(client)
+
+            if cache is None:
+                store = None
+                if self.store_factory is not None:
+                    store = self.store_factory(client, self.max_cache_size)
+
+                cache = FrameCache(self.max_cache_size, client,
+                                   self.reassembly_window,
+                                   self.reassembly_timeout, store,
+                                   self.feed_windows.get(client.identifier,
+                                                         self.cache_window),
+                                   self._on_resident_change)
 
                 self.caches[client] = cache
+                self._index[client.identifier] = cache
                 client.cache = cache
 
-            else:
-                cache = self.caches[client]
+                cache.add_listener(functools.partial(self._on_frame, cache))
 
-        cache.add_frame(sequence_num, max_fragments, fragment_num, frame)
+            return cache
+
+    def add_listener(self, listener):
+        """
+        Registers a callable to be notified of new frames in every feed,
+        including feeds created later. The listener is called with the
+        FrameCache and the (frame, timestamp, sequence number) tuple, from
+        whichever thread completed the frame (see `FrameCache.add_listener`).
+
+        :param listener The callable to register
+        """
+        with self.lock:
+            self._listeners = self._listeners + [ listener ]
+
+    def remove_listener(self, listener):
+        """
+        Unregisters a callable registered with `add_listener`.
+
+        :param listener The callable to unregister
+        """
+        with self.lock:
+            self._listeners = [ l for l in self._listeners if l != listener ]
+
+    def add_removal_listener(self, listener):
+        """
+        Registers a callable to be notified when a feed's cache is removed
+        (e.g. when it is reaped for being idle). The listener is called with
+        the removed FrameCache, from the thread which removed it.
+
+        :param listener The callable to register
+        """
+        with self.lock:
+            self._removal_listeners = self._removal_listeners + [ listener ]
+
+    def remove_removal_listener(self, listener):
+        """
+        Unregisters a callable registered with `add_removal_listener`.
+
+        :param listener The callable to unregister
+        """
+        with self.lock:
+            self._removal_listeners = [ l for l in self._removal_listeners
+                                        if l != listener ]
+
+    def _on_frame(self, cache, frame_info):
+        if self.max_bytes is not None:
+            self._enforce_budget()
+
+        for listener in self._listeners:
+            try:
+                listener(cache, frame_info)
+
+            except:
+                logging.exception("Exception notifying feed listener %s",
+                    listener)
+
+    def _on_resident_change(self, cache, sequence_num, size):
+        """
+        Called by a FrameCache, with its lock held, whenever it stores or
+        removes a frame.
+
+        :param cache The FrameCache
+        :param sequence_num The sequence number of the stored frame
+        :param size The size of the stored frame, or minus the size of the
+                    removed frames
+        """
+        with self._resident_lock:
+            self.resident_bytes += size
+
+            if size > 0 and self.max_bytes is not None:
+                self._arrivals.append((cache, sequence_num))
+
+    def _enforce_budget(self):
+        """
+        Evicts the oldest frames across all feeds until the frames of all
+        feeds fit within `max_bytes`, keeping at least the newest frame of
+        every feed. Only one thread evicts at a time; other threads carry on
+        rather than waiting, as the evicting thread will see their frames.
+        """
+        if not self._eviction_lock.acquire(False):
+            return
+
+        try:
+            # The newest frames of their feeds, which are put back in front
+            kept = []
+
+            while self.resident_bytes > self.max_bytes and self._arrivals:
+                cache, sequence_num = self._arrivals.popleft()
+
+                if self.caches.get(cache.client) is not cache:
+                    # The feed has been removed
+                    continue
+
+                evicted = cache.evict_frame(sequence_num, keep = 1)
+
+                if evicted == 0:
+                    kept.append((cache, sequence_num))
+                elif evicted is not None:
+                    self.frames_evicted += 1
+
+            self._arrivals.extendleft(reversed(kept))
+
+            if len(self._arrivals) > 2 * self.max_cache_size * max(
+                    len(self.caches), 1):
+                self._compact_arrivals()
+
+        finally:
+            self._eviction_lock.release()
+
+    def _compact_arrivals(self):
+        """
+        Drops the queued frames which are no longer cached, such as frames
+        pushed out by newer frames, which otherwise stay queued until the
+        budget is reached. Must be called with the eviction lock held.
+        """
+        # Frames cached meanwhile are queued afresh, and go after the ones
+        # being compacted
+        with self._resident_lock:
+            arrivals = self._arrivals
+            self._arrivals = collections.deque()
+
+        ranges = {}
+        queued = []
+
+        for cache, sequence_num in arrivals:
+            if self.caches.get(cache.client) is not cache:
+                continue
+
+            if cache not in ranges:
+                ranges[cache] = cache.get_sequence_range()
+
+            oldest, newest = ranges[cache]
+
+            if oldest is not None and oldest <= sequence_num <= newest:
+                queued.append((cache, sequence_num))
+
+        with self._resident_lock:
+            self._arrivals.extendleft(reversed(queued))
+
+    def get_resident_bytes(self):
+        """
+        :return A map of feed identifier -> bytes of cached frames
+        """
+        return dict((cache.client.identifier, cache.resident_bytes)
+                    for cache in self.caches.values())
+
+    def log_stats(self):
+        logging.info("Feed cache: %d bytes of frames in %d feeds%s, %d frames "
+            "evicted over budget", self.resident_bytes, len(self.caches),
+            "" if self.max_bytes is None else " (budget %d)" % self.max_bytes,
+            self.frames_evicted)
+
+        for cache in sorted(self.caches.values(),
+                            key = lambda c: c.client.identifier):
+            logging.info("Feed '%s': %d bytes cached, %.1f fps (jitter %.1f "
+                "ms), %d frames completed, %d dropped incomplete, %d late, %d "
+                "evicted, %d fragments discarded, %d sequence restarts",
+                cache.client.identifier, cache.resident_bytes,
+                cache.get_framerate(), 1000 * cache.get_jitter(),
+                cache.frames_completed, cache.frames_dropped,
+                cache.frames_late, cache.frames_evicted,
+                cache.fragments_discarded, cache.restarts)
+
+    def remove_cache(self, client):
+        """
+        Removes a client's FrameCache, if it has one.
+
+        :param client The client whose cache should be removed
+
+        :return The removed FrameCache, or None if the client had no cache
+        """
+        with self.lock:
+            cache = self.caches.pop(client, None)
+
+            if cache is None:
+                return None
+
+            # Another client may have since taken over the identifier
+            if self._index.get(client.identifier) is cache:
+                del self._index[client.identifier]
+
+            client.cache = None
+
+        # The removed cache's frames no longer count towards the budget
+        with cache.lock:
+            cache.resident_listener = None
+            self._on_resident_change(cache, None, -cache.resident_bytes)
+
+        for listener in self._removal_listeners:
+            try:
+                listener(cache)
+
+            except:
+                logging.exception("Exception notifying removal listener %s",
+                    listener)
+
+        return cache
 
     def get_cache(self, cache_id):
         """
@@ -74,34 +355,141 @@ class FeedCache(object):
 
         :raises NoCacheFoundError When no cache can be found matching the ID
         """
+        cache = self._index.get(cache_id)
 
-        with self.lock:
-            for c in self.caches.values():
-                if c.client.identifier == cache_id:
-                    return c
+        if cache is None:
+            raise NoCacheFoundError("No cache found matching ID %s" % cache_id)
 
-        raise NoCacheFoundError("No cache found matching ID %s" % cache_id)
+        return cache
+
+    def get_identifiers(self):
+        """
+        :return A sorted list of the identifiers of all feeds with a cache
+        """
+        return sorted(self._index)
 
 INITIAL_FRAMERATE = 30
 
+# The framerate is estimated from a moving average of the intervals between
+# frames, where each new interval has a weight of 1/FRAMERATE_SAMPLES. Until
+# that many intervals have been seen, it's their plain mean instead, so the
+# estimate isn't biased towards its starting value.
+FRAMERATE_SAMPLES = 16
+
+# An interval this many times longer than the average is a gap in the feed
+# (the transmitter stalled, or frames were lost), and is left out of the
+# estimate. If FRAMERATE_GAP_COUNT such intervals follow each other, the
+# feed has slowed down instead, and the estimate starts over.
+FRAMERATE_GAP_FACTOR = 4
+FRAMERATE_GAP_COUNT = 3
+
+# A fragment this far behind the newest sequence number can't be a late
+# arrival, so the transmitter must have restarted its sequence numbers
+RESTART_DISTANCE = 1000
+
+# The largest number of fragments a frame may be split into (the limit of the
+# version 2 fragment header)
+MAX_FRAGMENTS = 65535
+
 class FrameCache(object):
     """
     The cache will be accessed from multiple threads, therefore we need to
     make it thread safe.
+
+    Complete frames are kept in a store of (frame, timestamp, sequence
+    number) tuples, which is a deque unless another store is given, such as
+    a `sharedmem.SharedFrameStore` which other processes can read. A store
+    must provide `append`, `popleft` (returning the removed tuple), `clear`,
+    `__getitem__` and `__len__`, and hold at most `size` frames. Stores
+    which have to copy frames to read them should also provide
+    `get_header`, returning a tuple with the timestamp and sequence number
+    at the same positions, without reading the frame.
+
+    Frames are only cached in increasing sequence order, so `get_frame` can
+    find a frame by binary search of the store rather than scanning it. A
+    frame completing after a newer one has been cached is dropped, as
+    viewers and recordings have already moved past it.
+
+    If a `window` is given, frames older than that many seconds are evicted
+    as new frames are added. The owning FeedCache may also evict frames to
+    keep within its byte budget (see `evict_frame`).
     """
-    def __init__(self, size, client):
+    def __init__(self, size, client, reassembly_window = 16,
+                 reassembly_timeout = 2.0, store = None, window = None,
+                 resident_listener = None):
         self.client = client
 
         self.size = size
-        self._cache = collections.deque(maxlen = size)
+        self.window = window
+
+        if store is None:
+            store = collections.deque(maxlen = size)
+
+        self._cache = store
+        # Reads the timestamp and sequence number of a stored frame, for
+        # lookups
+        self._get_header = getattr(store, "get_header", store.__getitem__)
+
+        # The total size of the frames in the store
+        self.resident_bytes = 0
+        # A callable notified, with the lock held, of every frame stored and
+        # removed, see `_update_resident`
+        self.resident_listener = resident_listener
+        # Frames evicted before being pushed out by newer frames, because of
+        # the time window or the byte budget
+        self.frames_evicted = 0
+
+        # The most recent frame, read without the lock
+        self._latest_frame = None
 
         # The fragment cache holds fragments until there's a complete frame to
-        # build
-        self._fragment_cache = {}
+        # build. It's ordered by arrival, so the oldest sequences are first.
+        # At most `reassembly_window` sequences are in flight, and sequences
+        # which haven't completed within `reassembly_timeout` seconds are
+        # dropped.
+        self._fragment_cache = collections.OrderedDict()
+
+        self.reassembly_window = reassembly_window
+        self.reassembly_timeout = reassembly_timeout
+
+        # The newest sequence number seen, and when it was first seen
+        self._newest_sequence = None
+        self._newest_sequence_time = 0
+
+        # Recently completed sequences, so that late duplicate fragments don't
+        # start reassembling the same frame again
+        self._completed = set()
+        self._completed_order = collections.deque()
+
+        # Reassembly counters
+        self.frames_completed = 0
+        # Frames evicted before all of their fragments arrived
+        self.frames_dropped = 0
+        # Fragments which were duplicates, out of range, or for frames which
+        # were already completed or dropped
+        self.fragments_discarded = 0
+        # Frames completed after a newer frame was cached
+        self.frames_late = 0
+        # Times the transmitter restarted its sequence numbers. Readers
+        # keeping a sequence number cursor check this to know their cursor
+        # is no longer valid.
+        self.restarts = 0
 
         self.lock = threading.RLock()
 
-        self._last_framerate_guess = INITIAL_FRAMERATE
+        # Callables notified of every new complete frame. The list is
+        # replaced rather than modified, so it can be iterated without the
+        # lock.
+        self._listeners = []
+
+        # The moving averages of the interval between frames and of its
+        # deviation from the average (the jitter), in seconds. Updated as
+        # frames are added, and read without the lock.
+        self._frame_interval = None
+        self._frame_jitter = 0.0
+
+        self._interval_samples = 0
+        self._gap_samples = 0
 
     def add_frame(self, sequence_num, max_fragments, fragment_num, fragment):
         """
@@ -113,16 +501,31 @@ class FrameCache(object):
         :param fragment The frame fragment
         """
         with self.lock:
+            now = time.time()
+
             # Try to get the fragment matching the frame...
-            fragment_cache = None
-            if sequence_num not in self._fragment_cache:
+            fragment_cache = self._fragment_cache.get(sequence_num)
+
+            if fragment_cache is None:
+                if (not 0 < max_fragments <= MAX_FRAGMENTS
+                        or not self._accept_sequence(sequence_num, now)):
+                    self.fragments_discarded += 1
+                    return
+
                 fragment_cache = FragmentCache(sequence_num, max_fragments)
 
                 self._fragment_cache[sequence_num] = fragment_cache
-            else:
-                fragment_cache = self._fragment_cache[sequence_num]
 
-            fragment_cache.add_fragment(fragment_num, fragment)
+                self._evict_fragments(now)
+
+            elif fragment_cache.max_fragments != max_fragments:
+                # Fragments of the same frame must agree on the fragment count
+                self.fragments_discarded += 1
+                return
+
+            if not fragment_cache.add_fragment(fragment_num, fragment):
+                self.fragments_discarded += 1
+                return
 
             """logging.debug("Added fragment to fragment cache. seqnum: %d,"
                          " fragn: %d, maxfragn: %d", 
@@ -137,48 +540,357 @@ class FrameCache(object):
             else:
                 return
 
+            # The frame is now held by the frame cache only
+            del self._fragment_cache[sequence_num]
+            self._mark_completed(sequence_num)
+
+            self.frames_completed += 1
 
             if frame[-1] != "\xd9":
                 logging.warn("Frame does not end in \\xd9")
                 #logging.debug(repr(frame))
 
+            if self._cache and sequence_num <= self._get_header(-1)[2]:
+                self.frames_late += 1
+                return
+
             ctime = time.time()
             to_cache = (frame, ctime, sequence_num)
 
             #logging.debug("Adding %s to cache", to_cache)
 
-            # The deque will automatially remove items from the left side of
-            # the cache since we specified a maxlen (if we were appending to
-            # the left side, it'd remove from the right side)
-            self._cache.append(to_cache)
+            # Make room for the frame, so the store doesn't drop the oldest
+            # frame without us accounting for it
+            if len(self._cache) == self.size:
+                self._remove_oldest()
+
+            try:
+                self._cache.append(to_cache)
+
+                self._update_resident(sequence_num, len(frame))
+
+            except ValueError as e:
+                # Listeners still get the frame, it just can't be cached
+                logging.warn("Unable to cache frame of '%s': %s",
+                    self.client.identifier, e)
+
+            if self._latest_frame is not None:
+                self._update_framerate(ctime - self._latest_frame[1])
+
+            self._latest_frame = to_cache
+
+            if self.window is not None:
+                while (len(self._cache) > 1
+                        and self._get_header(0)[1] < ctime - self.window):
+                    self._remove_oldest()
+                    self.frames_evicted += 1
 
             self.client.last_frame_update = time.time()
 
-            self.get_framerate()
+        # Notify listeners outside the lock, so they're free to read the cache
+        for listener in self._listeners:
+            try:
+                listener(to_cache)
+
+            except:
+                logging.exception("Exception notifying frame listener %s",
+                    listener)
+
+    def add_listener(self, listener):
+        """
+        Registers a callable to be notified of new frames. The listener is
+        called with the (frame, timestamp, sequence number) tuple from
+        whichever thread completed the frame, so it must be quick and thread
+        safe (e.g. hand the frame over to an IOLoop or a queue).
+
+        :param listener The callable to register
+        """
+        with self.lock:
+            self._listeners = self._listeners + [ listener ]
+
+    def remove_listener(self, listener):
+        """
+        Unregisters a callable registered with `add_listener`.
+
+        :param listener The callable to unregister
+        """
+        with self.lock:
+            self._listeners = [ l for l in self._listeners if l != listener ]
+
+    def _accept_sequence(self, sequence_num, now):
+        """
+        Decides whether a fragment starting a new reassembly for the given
+        sequence should be accepted. Must be called with the lock held.
+
+        :param sequence_num The sequence number of the fragment
+        :param now The current time
+
+        :return True if reassembly should start, False if the fragment is
+                late or a duplicate
+        """
+        if sequence_num in self._completed:
+            return False
+
+        if (self._newest_sequence is None 
+                or sequence_num > self._newest_sequence):
+            self._newest_sequence = sequence_num
+            self._newest_sequence_time = now
+
+            return True
+
+        distance = self._newest_sequence - sequence_num
+
+        if distance < self.reassembly_window:
+            return True
+
+        # Sequence numbers going far backwards, or no newer sequence arriving
+        # for a while, means the transmitter has restarted
+        if (distance > RESTART_DISTANCE 
+                or now - self._newest_sequence_time > self.reassembly_timeout):
+            logging.info("Sequence for '%s' restarted at %d (was %d)",
+                self.client.identifier, sequence_num, self._newest_sequence)
+
+            self._reset_reassembly()
+
+            self._newest_sequence = sequence_num
+            self._newest_sequence_time = now
+
+            return True
+
+        return False
+
+    def _evict_fragments(self, now):
+        """
+        Evicts incomplete frames which have fallen out of the reassembly
+        window or timed out. Must be called with the lock held.
+
+        :param now The current time
+        """
+        while self._fragment_cache:
+            sequence_num, fragment_cache = next(
+                self._fragment_cache.iteritems())
+
+            if (len(self._fragment_cache) <= self.reassembly_window
+                    and self._newest_sequence - sequence_num 
+                        < self.reassembly_window
+                    and now - fragment_cache.time_created 
+                        <= self.reassembly_timeout):
+                break
+
+            logging.debug("Dropping incomplete frame %d for '%s' (%d/%d "
+                "fragments)", sequence_num, self.client.identifier, 
+                len(fragment_cache), fragment_cache.max_fragments)
+
+            del self._fragment_cache[sequence_num]
+            self._mark_completed(sequence_num)
+
+            self.frames_dropped += 1
+
+    def _mark_completed(self, sequence_num):
+        """
+        Remembers that the sequence is finished with (completed or dropped),
+        for as long as it's within the reassembly window. Must be called with
+        the lock held.
+        """
+        self._completed.add(sequence_num)
+        self._completed_order.append(sequence_num)
+
+        if len(self._completed_order) > self.reassembly_window:
+            self._completed.discard(self._completed_order.popleft())
+
+    def _reset_reassembly(self):
+        """
+        Drops all reassembly state, and the cached frames, which belong to
+        the previous sequence. Must be called with the lock held.
+        """
+        self.frames_dropped += len(self._fragment_cache)
+
+        self._fragment_cache.clear()
+        self._completed.clear()
+        self._completed_order.clear()
+
+        self._cache.clear()
+        self._update_resident(None, -self.resident_bytes)
+
+        self.restarts += 1
 
     def get_frame(self, last_fid):
         """
-        Gets the most recent frame after the specified cutoff. We don't just
-        get the most recent frame from the cache as that may not be the frame
-        that the client requires. Therefore we use the timestamp.
+        Gets the oldest cached frame after the specified cutoff. We don't
+        just get the most recent frame from the cache as that may not be the
+        frame that the client requires. Therefore we use the sequence number.
+
+        Frames are cached in sequence order, so the frame is found directly
+        when no frames were lost since `last_fid`, and by binary search
+        otherwise.
+
+        :param last_fid The sequence number of the last frame the caller got
+
+        :return The (frame, timestamp, sequence number) tuple of the first
+                frame with a sequence number greater than `last_fid`, or None
+                if there isn't one
+        """
+        with self.lock:
+            get_header = self._get_header
+            count = len(self._cache)
+
+            if count == 0 or get_header(-1)[2] <= last_fid:
+                return None
+
+            first_fid = get_header(0)[2]
+
+            if last_fid < first_fid:
+                return self._cache[0]
+
+            # Frames are usually consecutive
+            position = last_fid + 1 - first_fid
+
+            if position < count and get_header(position)[2] == last_fid + 1:
+                return self._cache[position]
+
+            return self._cache[self._find_position(2, last_fid)]
+
+    def get_frames_after(self, last_fid, until_fid = None):
+        """
+        Gets every cached frame after the specified cutoff at once, rather
+        than one `get_frame` call per frame.
+
+        :param last_fid The sequence number of the last frame the caller got
+        :param until_fid The sequence number of the last frame wanted, or
+                         None for all of the newer frames
+
+        :return A list of (frame, timestamp, sequence number) tuples, oldest
+                first
+        """
+        with self.lock:
+            start = self._find_position(2, last_fid)
+
+            end = len(self._cache)
+            if until_fid is not None:
+                end = self._find_position(2, until_fid)
+
+            return [ self._cache[i] for i in range(start, end) ]
+
+    def find_sequence_before(self, timestamp):
+        """
+        Finds the last cached frame received at or before a given time.
+
+        :param timestamp The time, as returned by `time.time`
+
+        :return The sequence number of the frame, or None if every cached
+                frame was received after `timestamp`
+        """
+        with self.lock:
+            position = self._find_position(1, timestamp)
+
+            if position == 0:
+                return None
+
+            return self._get_header(position - 1)[2]
+
+    def _find_position(self, field, value):
+        """
+        Binary searches the headers of the stored frames, which are in
+        sequence (and so also timestamp) order. Must be called with the lock
+        held.
+
+        :param field 2 to search by sequence number, 1 by timestamp
+        :param value The value to search for
+
+        :return The position of the first frame whose field is greater than
+                `value`, or the number of frames if there is none
+        """
+        get_header = self._get_header
+
+        low = 0
+        high = len(self._cache)
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if get_header(middle)[field] > value:
+                high = middle
+            else:
+                low = middle + 1
+
+        return low
+
+    def expire_reassembly(self):
+        """
+        Drops incomplete frames which have timed out. These are otherwise
+        only dropped once newer frames arrive, which they won't if the feed
+        has gone idle.
+        """
+        with self.lock:
+            self._evict_fragments(time.time())
+
+    def get_sequence_range(self):
+        """
+        :return The sequence numbers of the oldest and the newest cached
+                frames, (None, None) if there are none
+        """
+        with self.lock:
+            if not self._cache:
+                return None, None
+
+            return self._get_header(0)[2], self._get_header(-1)[2]
+
+    def evict_frame(self, sequence_num, keep = 0):
         """
+        Evicts a frame if it's the oldest cached frame, unless there are no
+        more than `keep` frames.
 
-        #logging.debug("Attempting to get latest frame with ID cutoff %d", 
-        #    last_fid)
+        :param sequence_num The sequence number of the frame to evict
+        :param keep The number of newest frames which can't be evicted
 
+        :return The size of the evicted frame, 0 if it's one of the `keep`
+                newest frames, or None if it's no longer the oldest frame
+        """
         with self.lock:
-            to_send = None
+            if not self._cache or self._get_header(0)[2] != sequence_num:
+                return None
 
-            for f, ts, fid in self._cache:
-                if fid > last_fid:
-                    # Get the frame with an ID > than the last one sent
-                    logging.debug("selected a frame")
-                    
-                    to_send = (f, ts, fid)
+            if len(self._cache) <= keep:
+                return 0
 
-                    break
+            self.frames_evicted += 1
 
-            return to_send
+            return self._remove_oldest()
+
+    def _remove_oldest(self):
+        """
+        Removes the oldest frame from the store. Must be called with the lock
+        held.
+
+        :return The size of the removed frame
+        """
+        frame, ts, sequence_num = self._cache.popleft()
+
+        self._update_resident(sequence_num, -len(frame))
+
+        return len(frame)
+
+    def _update_resident(self, sequence_num, size):
+        """
+        Accounts for a frame being stored or removed. Must be called with the
+        lock held.
+
+        :param sequence_num The sequence number of the frame
+        :param size The size of the stored frame, or minus the size of the
+                    removed frames
+        """
+        self.resident_bytes += size
+
+        if self.resident_listener is not None:
+            self.resident_listener(self, sequence_num, size)
+
+    def get_latest_frame(self):
+        """
+        :return The most recent (frame, timestamp, sequence number) tuple, or
+                None if no frame has been received
+        """
+        # A single attribute read, so no need for the lock
+        return self._latest_frame
 
     def is_stream_timed_out(self):
         """
@@ -188,82 +900,134 @@ class FrameCache(object):
         return time.time() - self.client.last_frame_update > 10
         #return False
 
-    def get_framerate(self):
+    def _update_framerate(self, interval):
         """
-        The framerate is approximately the number of frames in cache/time 
-        between first and last frame received in the cache. We go a bit
-        more in-depth and use a moving average every time this method is
-        invoked.
+        Adds the interval between the last two frames to the framerate
+        estimate. Must be called with the lock held.
+
+        :param interval The seconds between the last two frames
         """
-        cache_len = len(self)
+        if (self._frame_interval is not None
+                and interval > FRAMERATE_GAP_FACTOR * self._frame_interval):
+            self._gap_samples += 1
 
-        if cache_len == 0:
-            return self._last_framerate_guess
+            if self._gap_samples < FRAMERATE_GAP_COUNT:
+                return
+
+            # Not a gap, the feed has slowed down
+            self._interval_samples = 0
+
+        self._gap_samples = 0
+
+        self._interval_samples = min(self._interval_samples + 1,
+                                     FRAMERATE_SAMPLES)
 
-        time_diff = self._cache[-1][1] - self._cache[0][1]
+        if self._interval_samples == 1:
+            self._frame_jitter = 0.0
+            self._frame_interval = interval
+            return
 
-        guess = cache_len / (time_diff if time_diff > 0 else 1)
+        weight = 1.0 / self._interval_samples
+
+        self._frame_jitter += weight * (abs(interval - self._frame_interval)
+                                        - self._frame_jitter)
+        self._frame_interval += weight * (interval - self._frame_interval)
+
+    def get_framerate(self):
+        """
+        :return The estimated framerate of the feed, in frames per second, or
+                INITIAL_FRAMERATE until two frames have been received
+        """
+        # A single attribute read, so no need for the lock
+        interval = self._frame_interval
 
-        new_guess = (self._last_framerate_guess + guess)/2
+        if not interval:
+            return INITIAL_FRAMERATE
 
-        """logging.debug(
-                "New framerate guess - ID: '%s', new: %d, old: %d",
-                    self.client.identifier, new_guess, 
-                    self._last_framerate_guess
-            )"""
+        return 1.0 / interval
 
-        self._last_framerate_guess = new_guess
+    def get_jitter(self):
+        """
+        :return The mean deviation of the intervals between frames from
+                their average, in seconds
+        """
+        return self._frame_jitter
 
-        return new_guess
+    def close(self):
+        """
+        Releases the frame store, if it needs releasing. The cache must not
+        be used afterwards.
+        """
+        with self.lock:
+            if hasattr(self._cache, "close"):
+                self._cache.close()
 
     def __len__(self):
         with self.lock:
             return len(self._cache)
 
 class FragmentCache(object):
+    """
+    Reassembles a single frame. A slot is allocated for each of the frame's
+    fragments up front, and every fragment is written into its own slot as
+    it arrives, so fragments may arrive in any order and no sorting is
+    needed to complete the frame. Duplicate and out of range fragments are
+    rejected rather than counting towards completion.
+
+    A FragmentCache is owned by a FrameCache, and is only accessed with the
+    FrameCache's lock held.
+    """
     def __init__(self, sequence_num, max_fragments):
 
         self.sequence_num = sequence_num
 
-        self.max_fragments = max_fragments
-
-        self._cache = []
+        self.time_created = time.time()
 
-        self.lock = threading.RLock()
+        self.max_fragments = max_fragments
 
-        self._complete_fragment = None
+        self._slots = [ None ] * max_fragments
+        self._received = 0
 
     def is_fragment_complete(self):
-        with self.lock:
-            return len(self._cache) == self.max_fragments
+        return self._received == self.max_fragments
 
     def add_fragment(self, fragment_id, fragment):
-        with self.lock:
-            #logging.debug("Adding fragment %d to fragment cache for seq %d",
-            #    fragment_id, self.sequence_num)
+        """
+        Adds a fragment to its slot. Fragments given as a memoryview are
+        copied here, as the underlying buffer may be reused by the receiver
+        once the fragment has been cached.
 
-            self._cache.append((fragment_id, fragment))
+        :param fragment_id The number of the fragment in the sequence
+        :param fragment The fragment data, a str or memoryview
 
-    def get_complete_fragment(self):
-        with self.lock:
-            if not self.is_fragment_complete():
-                raise IncompleteFrameError("Frame %s is not complete" % (
-                    self.sequence_num))
+        :return True if the fragment was added, False if it was a duplicate
+                or its number is out of range
+        """
+        if self.max_fragments == 1:
+            # Older transmitters number the only fragment of a frame 1
+            fragment_id = 0
 
-            if self._complete_fragment is None:
-                # Construct the frame from fragments
-                # We need to sort by fragment ID first, as the fragments may
-                # not necessarily come in order...
-                self._cache.sort(key = operator.itemgetter(0))
+        if not 0 <= fragment_id < self.max_fragments:
+            return False
 
-                # Join all fragments
-                frame = "".join(x[1] for x in self._cache)
+        if self._slots[fragment_id] is not None:
+            return False
 
-                self._complete_fragment = frame
+        if isinstance(fragment, memoryview):
+            fragment = fragment.tobytes()
 
+        self._slots[fragment_id] = fragment
+        self._received += 1
 
-            return self._complete_fragment
+        return True
+
+    def get_complete_fragment(self):
+        if not self.is_fragment_complete():
+            raise IncompleteFrameError("Frame %s is not complete" % (
+                self.sequence_num))
+
+        # Joining a single fragment returns it without a copy
+        return "".join(self._slots)
 
     def __len__(self):
-        with self.lock:
-            return len(self._cache)
+        return self._received
@@ -27,6 +27,8 @@ import caching
 import receiver
 import relay
 import observer
+import reaper
+import sharedmem
 import storage
 
 # Import here after we've done checking in the observer
@@ -39,18 +41,39 @@ if __name__ == "__main__":
 
     # Initialize shared objects first
     authenticator = authentication.Authenticator()
-    feed_cache = caching.FeedCache(settings.receiver.cache_size)
+
+    store_factory = None
+    if settings.receiver.cache_backend == "shared":
+        store_factory = sharedmem.create_store_factory(
+            settings.receiver.shared_cache_dir,
+            settings.receiver.shared_slot_size)
+
+        logging.info("Caching frames in shared memory (%s)" % \
+            settings.receiver.shared_cache_dir)
+
+    feed_cache = caching.FeedCache(settings.receiver.cache_size,
+        settings.receiver.reassembly_window, 
+        settings.receiver.reassembly_timeout, store_factory,
+        settings.receiver.cache_max_bytes, settings.receiver.cache_window,
+        settings.receiver.feed_cache_windows)
     storage_manager = storage.VideoStorageManager(feed_cache)
 
     # Instantiate server objects
+    ## Relay
+    relay_manager = None
+    if settings.relay.enabled:
+        relay_manager = relay.RelayManager(feed_cache, settings.relay.targets)
+
+        logging.info("Relaying feeds to %s" % (settings.relay.targets,))
+
     ## Receiver
     receiver_server_address = (
         settings.receiver.host,
         settings.receiver.port
     )
 
-    receiver_server = receiver.ReceiverServer(receiver_server_address, 
-        authenticator, feed_cache)
+    receiver_server = receiver.create_server(receiver_server_address, 
+        authenticator, feed_cache, relay_manager)
 
     logging.info("Receiver server listening on %s:%s" % \
         receiver_server.server_address)
@@ -79,28 +102,58 @@ if __name__ == "__main__":
     logging.info("Observer server listening on %s:%s" % \
         observer_server_address)
 
-    # Create threads and set thread properties
-    recv_thread = threading.Thread(target = receiver_server.serve_forever)
-    recv_thread.daemon = True
+    ## Reaper
+    feed_reaper = reaper.FeedReaper(feed_cache, authenticator,
+        settings.receiver.feed_timeout,
+        settings.authentication.token_timeout,
+        settings.receiver.reap_interval)
+
+    # Create threads and set thread properties. The "ioloop" receiver runs on
+    # the main thread's IOLoop with the observer instead.
+    recv_thread = None
+    if not isinstance(receiver_server, receiver.IOLoopReceiverServer):
+        recv_thread = threading.Thread(target = receiver_server.serve_forever)
+        recv_thread.daemon = True
 
     auth_thread = threading.Thread(target = auth_server.serve_forever)
     auth_thread.daemon = True
 
-    # Add a timer to the main thread (tornado IOLoop) which calls the storage
-    # manager's cache flush method.
-    storage_timer = tornado.ioloop.PeriodicCallback(
-                                        storage_manager.flush_caches, 
-                                        settings.storage.flush_timer)
-
     try:
-        logging.info("Starting receiver thread ...")
-        recv_thread.start()
+        if relay_manager is not None:
+            logging.info("Starting relay targets ...")
+            relay_manager.start()
+
+            relay_stats_timer = tornado.ioloop.PeriodicCallback(
+                                    relay_manager.log_stats,
+                                    settings.relay.stats_interval * 1000)
+            relay_stats_timer.start()
+
+        if recv_thread is not None:
+            logging.info("Starting receiver thread ...")
+            recv_thread.start()
+
+        else:
+            logging.info("Adding receiver socket to tornado IOLoop")
+            receiver_server.start()
 
         logging.info("Starting auth thread ...")
         auth_thread.start()
 
-        logging.info("Adding storage timer to tornado IOLoop")
-        storage_timer.start()
+        logging.info("Starting storage writers ...")
+        storage_manager.start()
+
+        storage_stats_timer = tornado.ioloop.PeriodicCallback(
+                                storage_manager.log_stats,
+                                settings.storage.stats_interval * 1000)
+        storage_stats_timer.start()
+
+        cache_stats_timer = tornado.ioloop.PeriodicCallback(
+                                feed_cache.log_stats,
+                                settings.receiver.stats_interval * 1000)
+        cache_stats_timer.start()
+
+        logging.info("Adding feed reaper to tornado IOLoop")
+        feed_reaper.start()
 
         logging.info("Running tornado IOLoop and observer server in main thread ...")
         observer_server.run()
@@ -109,8 +162,10 @@ if __name__ == "__main__":
         # Exit cleanly
         print "KeyboardInterrupt. Exiting"
 
-        storage_timer.stop()
+        feed_reaper.stop()
         servers = [ auth_server, receiver_server, observer_server ]
+        if relay_manager is not None:
+            servers.append(relay_manager)
         
         for s in servers:
             # Stop listening & close sockets
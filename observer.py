@@ -8,14 +8,6 @@ clients in order to deliver a live stream.
 import logging
 import os
 
-try:
-    import concurrent.futures
-except ImportError:
-    print """The Firefly daemon requires the `futures` package, a backport of 
-    the Py3 futures module. Install using `pip install futures`
-    """
-    quit()
-
 try:
     import tornado
     import tornado.options
@@ -28,15 +20,17 @@ except ImportError:
     """
     quit()
 
-from settings import observer as obs_settings
 
+import broadcaster
 import observerhandlers
 
 class ObserverApplication(tornado.web.Application):
-    def __init__(self, feed_cache, pool_size):
+    def __init__(self, feed_cache):
         handlers = [
             (r"/", observerhandlers.RootHandler),
             (r"/feed/([a-zA-Z0-9_]+)", observerhandlers.StreamHandler),
+            (r"/recording/([a-zA-Z0-9_]+)",
+                observerhandlers.RecordingHandler),
         ]
 
         settings = {
@@ -51,18 +45,50 @@ class ObserverApplication(tornado.web.Application):
         # frame caches of all available streams.
         self.feed_cache = feed_cache
 
-        # All frame acquirement is done in a thread pool in order to enable
-        # asynchronous operation.
-        self.thread_pool = concurrent.futures.ThreadPoolExecutor(
-                                            max_workers = pool_size
-                                        )
+        # Map of FrameCache -> FeedBroadcaster, created on the first view
+        self.broadcasters = {}
+
+        if feed_cache is not None:
+            feed_cache.add_removal_listener(self._on_feed_removed)
+
+    def get_broadcaster(self, frame_cache):
+        """
+        Gets the broadcaster for a feed, creating it if necessary. Must be
+        called on the IOLoop.
+
+        :param frame_cache The FrameCache of the feed
+
+        :return The feed's `broadcaster.FeedBroadcaster`
+        """
+        feed_broadcaster = self.broadcasters.get(frame_cache)
+
+        if feed_broadcaster is None:
+            feed_broadcaster = broadcaster.FeedBroadcaster(frame_cache)
+
+            self.broadcasters[frame_cache] = feed_broadcaster
+
+        return feed_broadcaster
+
+    def _on_feed_removed(self, frame_cache):
+        """
+        Feed cache removal listener. Ends the streams of the feed's viewers.
+        """
+        io_loop = tornado.ioloop.IOLoop.instance()
+
+        if tornado.ioloop.IOLoop.current(instance = False) is not io_loop:
+            io_loop.add_callback(self._on_feed_removed, frame_cache)
+            return
+
+        feed_broadcaster = self.broadcasters.pop(frame_cache, None)
+
+        if feed_broadcaster is not None:
+            feed_broadcaster.close()
 
 class ObserverServer(object):
     def __init__(self, server_address, feed_cache):
         self.feed_cache = feed_cache
         
-        self.application = ObserverApplication(feed_cache, 
-            obs_settings.pool_size)
+        self.application = ObserverApplication(feed_cache)
 
         self.application.listen(server_address[1], server_address[0])
 
@@ -74,8 +100,6 @@ class ObserverServer(object):
     def shutdown(self):
         tornado.ioloop.IOLoop.instance().stop()
 
-        self.application.thread_pool.shutdown(wait = False)
-
     def server_close(self):
         pass
 
@@ -11,80 +11,109 @@ import time
 import tornado.web
 from tornado.web import HTTPError
 import tornado.concurrent
+import tornado.iostream
+import tornado.locks
 from tornado import gen
 
+import avi
+import broadcaster
+import caching
+import storage
+from settings import observer as obs_settings
+from settings import storage as storage_settings
+
 class NoFrameFoundError(Exception):
     """ Raised when we cannot get the next frame for some reason """
     pass
 
-class FrameHelper(object):
-    """
-    Since we cannot directly yield results inside a while loop, we simply wrap
-    them in a helper object. `get_frame` will be called as the loop condition,
-    and the frame will be accessible via `self.next_frame` if there is an
-    available frame.
-    """
-    def __init__(self, frame_cache):
-        self.frame_cache = frame_cache
-
-        self.next_frame = None
-        # Start at -1 so we can get the 0th frame
-        self.last_frame_id = -1
-
-        self.last_frame_time = time.time()
+class BaseHandler(tornado.web.RequestHandler):
+    def __init__(self, application, request, **kwargs):
+        super(BaseHandler, self).__init__(application, request, **kwargs)
 
-    def get_frame(self):
+    def start_multipart(self):
         """
-        Gets the latest frame from the given cache. This must be run in a 
-        ThreadPoolExecutor instance, enabling async operation. The executor 
-        will handle setting the attributes of a Future object with either what
-        we return or an exception if one is raised.
-
-        :return True if we were able to get a frame, False if no more frames
-                are available (i.e. stream is over)
+        Sets the headers of a multipart stream of frames, written as
+        `broadcaster.EncodedFrame`s.
         """
+        self.set_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+
+        # The broadcaster encodes frames with HTTP/1.1 chunked framing once
+        # for all viewers. Setting the header ourselves stops tornado from
+        # framing every write again.
+        self.chunked = self.request.version == "HTTP/1.1"
+        if self.chunked:
+            self.set_header("Transfer-Encoding", "chunked")
 
-        frame_info = None
-        stream_finished = False
+    def end_multipart(self):
+        if self.chunked and not self.request.connection.stream.closed():
+            # Terminate the chunked body
+            self.write(b"0\r\n\r\n")
 
-        while frame_info is None and not stream_finished:
-            # Sleep the frame period (1/framerate)
-            time.sleep(1/self.frame_cache.get_framerate())
-            #time.sleep(1)
+class RootHandler(BaseHandler):
+    def get(self):
+        feed_cache = self.application.feed_cache
 
-            stream_finished = self.frame_cache.is_stream_timed_out()
+        feeds = []
+        for identifier in feed_cache.get_identifiers():
+            try:
+                feeds.append((identifier,
+                              feed_cache.get_cache(identifier).get_framerate()))
 
-            frame_info = self.frame_cache.get_frame(self.last_frame_id)
+            except caching.NoCacheFoundError:
+                # Removed since listing the identifiers
+                continue
 
-            stream_finished = time.time() - self.last_frame_time > 10
+        self.render('index.html', feeds = feeds)
 
-        if stream_finished:
-            return False
+# Viewer delivery modes
+LIVE = "live"
+SMOOTH = "smooth"
+REPLAY = "replay"
 
-        else:
-            self.next_frame, _, self.last_frame_id = frame_info
+MODES = (LIVE, SMOOTH, REPLAY)
 
-            logging.debug("Got next frame for cache %s. Frame ID: %d", 
-                self.frame_cache, self.last_frame_id)
+# The longest pause between frames when replaying, so a gap in the feed
+# doesn't stall the replay
+MAX_REPLAY_GAP = 1.0
 
-            self.last_frame_time = time.time()
+class StreamHandler(BaseHandler):
+    """
+    Streams a feed to a viewer. The handler subscribes to the feed's
+    broadcaster, which tells it about every new frame, and finishes once the
+    feed times out or the viewer disconnects. Frames are written one at a
+    time, waiting for each to be flushed to the viewer before writing the
+    next.
 
-            return True
+    Frames are delivered in one of three modes, chosen with the `mode` query
+    argument or otherwise `settings.observer.feed_modes` and
+    `settings.observer.mode`:
 
-class BaseHandler(tornado.web.RequestHandler):
-    def __init__(self, application, request, **kwargs):
-        super(BaseHandler, self).__init__(application, request, **kwargs)
+    + "live": the newest frame is always sent next. Frames arriving while
+      the viewer is waiting for its connection to catch up replace each
+      other, so a slow viewer skips frames rather than falling behind.
+    + "smooth": starts at the newest frame, but every frame is sent. A
+      viewer which falls behind (e.g. after a stall) plays through the
+      cached frames at up to `settings.observer.catchup_speed` times the
+      feed's framerate until it has caught up.
+    + "replay": every cached frame from the `from_seq` (a sequence number)
+      or `from_time` (a unix time, or seconds before now if negative) query
+      argument is sent, paced as it was received. Without either, the
+      replay starts at the oldest cached frame.
 
-class RootHandler(BaseHandler):
-    def get(self):
-        identifiers = [ c.identifier for c in self.application.feed_cache.caches.keys() ]
+    Frames are written without waiting for earlier ones to be flushed, as
+    long as no more than `settings.observer.max_buffer_bytes` are waiting to
+    be flushed. Beyond that, the viewer waits for its connection to catch
+    up, and then skips ahead (see `skip_ahead`).
 
-        self.render('index.html', identifiers = identifiers)
+    The "smooth" and "replay" modes read frames from the feed's cache, with
+    a cursor per viewer, and get the encoded frames from the broadcaster, so
+    viewers at the same position share them. When the transmitter restarts
+    its sequence numbers, cursors start over at the new sequence.
+    """
+    broadcaster = None
 
-class StreamHandler(BaseHandler):
     @gen.coroutine
     def get(self, slug):
-        # FrameHelper takes a frame cache... 
         try:
             frame_cache = self.application.feed_cache.get_cache(slug)
 
@@ -96,22 +125,460 @@ class StreamHandler(BaseHandler):
 
             raise HTTPError(400)
 
-        f_helper = FrameHelper(frame_cache)
+        self.mode = self.get_argument("mode",
+            obs_settings.feed_modes.get(slug, obs_settings.mode))
 
-        self.set_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+        if self.mode not in MODES:
+            raise HTTPError(400, "Unknown mode '%s'" % self.mode)
+
+        cursor = self.get_start_cursor(frame_cache)
+
+        self.start_multipart()
+
+        # The newest frame waiting to be written, in "live" mode
+        self.pending_frame = None
+
+        self.max_buffer_bytes = obs_settings.max_buffer_bytes
+
+        # Bytes written but not yet flushed, and the coroutine flushing them
+        self.buffered_bytes = 0
+        self.flusher = None
+
+        # The coroutine writing frames out, which finishes once there's
+        # nothing left to write ("live" mode) or the stream has finished
+        self.writer = None
+
+        # Notified of every new frame, in "smooth" and "replay" modes
+        self.frame_available = tornado.locks.Condition()
+
+        self.frames_sent = 0
+        self.frames_skipped = 0
+
+        self.stream_finished = tornado.concurrent.Future()
+
+        self.broadcaster = self.application.get_broadcaster(frame_cache)
+        self.broadcaster.subscribe(self)
+
+        if self.mode != LIVE:
+            self.writer = self.play(frame_cache, cursor)
+
+        try:
+            yield self.stream_finished
+
+        finally:
+            self.broadcaster.unsubscribe(self)
+
+            logging.debug("%s stream of '%s' finished, %d frames sent, %d "
+                "frames skipped", self.mode, slug, self.frames_sent,
+                self.frames_skipped)
+
+        # Let the writer finish the frame it's flushing
+        self.pending_frame = None
+        if self.writer is not None:
+            yield self.writer
+
+        if self.flusher is not None:
+            yield self.flusher
+
+        self.end_multipart()
+
+    def get_start_cursor(self, frame_cache):
+        """
+        :param frame_cache The FrameCache of the feed being viewed
+
+        :return The sequence number after which frames are read from the
+                cache, in "smooth" and "replay" modes
+
+        :raises HTTPError When the replay start is invalid
+        """
+        if self.mode == SMOOTH:
+            latest = frame_cache.get_latest_frame()
+
+            return latest[2] - 1 if latest is not None else -1
+
+        if self.mode == REPLAY:
+            try:
+                from_seq = self.get_argument("from_seq", None)
+
+                if from_seq is not None:
+                    return int(from_seq) - 1
+
+                from_time = self.get_argument("from_time", None)
+
+                if from_time is not None:
+                    from_time = float(from_time)
+
+                    if from_time < 0:
+                        from_time += time.time()
+
+                    # Frames after the cursor are the ones received after
+                    # from_time
+                    cursor = frame_cache.find_sequence_before(from_time)
+
+                    return cursor if cursor is not None else -1
+
+            except ValueError:
+                raise HTTPError(400, "Invalid replay start")
+
+        return -1
+
+    def send_frame(self, encoded_frame):
+        """
+        Tells the viewer about a new frame. Called by the broadcaster.
+
+        :param encoded_frame The `broadcaster.EncodedFrame` of the new frame
+        """
+        if self.stream_finished.done():
+            return
+
+        if self.mode != LIVE:
+            self.frame_available.notify_all()
+            return
+
+        # Latest frame wins: a frame still waiting to be written is replaced
+        if self.pending_frame is not None:
+            self.frames_skipped += 1
+            self.broadcaster.frames_skipped += 1
+
+        self.pending_frame = encoded_frame
+
+        if self.writer is None or self.writer.done():
+            self.writer = self.write_latest()
+
+    @gen.coroutine
+    def write_latest(self):
+        """
+        Writes the pending frame, and any frame which replaces it while the
+        connection catches up, until there's none left.
+        """
+        try:
+            while self.pending_frame is not None:
+                encoded_frame = self.pending_frame
+                self.pending_frame = None
+
+                yield self.write_frame(encoded_frame)
+
+        except tornado.iostream.StreamClosedError:
+            self.pending_frame = None
+            self.end_stream()
+
+    @gen.coroutine
+    def play(self, frame_cache, cursor):
+        """
+        Writes every cached frame after the cursor in turn, waiting for new
+        frames once it reaches the newest, until the stream finishes.
+
+        :param frame_cache The FrameCache of the feed
+        :param cursor The sequence number of the last frame sent
+        """
+        last_timestamp = None
+        last_write_time = None
+
+        restarts = frame_cache.restarts
+
+        try:
+            while not self.stream_finished.done():
+                if frame_cache.restarts != restarts:
+                    # The transmitter restarted its sequence numbers, so
+                    # carry on from the first frame of the new sequence
+                    restarts = frame_cache.restarts
+                    cursor = -1
+
+                frame_info = frame_cache.get_frame(cursor)
+
+                if frame_info is None:
+                    yield self.frame_available.wait()
+                    continue
+
+                frame, ts, sequence_num = frame_info
+
+                if last_write_time is not None:
+                    delay = (self.get_interval(frame_cache, frame_info,
+                                               last_timestamp)
+                             - (time.time() - last_write_time))
+
+                    if delay > 0:
+                        yield gen.sleep(delay)
+
+                        if self.stream_finished.done():
+                            break
+
+                last_write_time = time.time()
+
+                waited = yield self.write_frame(
+                                self.broadcaster.get_encoded_frame(frame_info))
+
+                cursor = sequence_num
+                last_timestamp = ts
+
+                if waited:
+                    cursor = self.skip_ahead(frame_cache, cursor, ts, waited)
+
+        except tornado.iostream.StreamClosedError:
+            self.end_stream()
+
+    def skip_ahead(self, frame_cache, cursor, timestamp, waited):
+        """
+        Moves the cursor of a viewer which had to wait for its connection to
+        catch up: "smooth" viewers skip to the newest frame, and "replay"
+        viewers skip the frames which became due while they waited, so the
+        replay carries on where it would have been.
+
+        :param frame_cache The FrameCache of the feed
+        :param cursor The sequence number of the last frame sent
+        :param timestamp The timestamp of the last frame sent
+        :param waited The seconds spent waiting for the connection
+
+        :return The new cursor
+        """
+        if self.mode == REPLAY:
+            due = frame_cache.find_sequence_before(timestamp + waited)
+
+        else:
+            latest = frame_cache.get_latest_frame()
+            due = latest[2] if latest is not None else None
+
+        # Send the due frame next
+        if due is None or due - 1 <= cursor:
+            return cursor
+
+        skipped = len(frame_cache.get_frames_after(cursor, due - 1))
+
+        self.frames_skipped += skipped
+        self.broadcaster.frames_skipped += skipped
+
+        return due - 1
+
+    def get_interval(self, frame_cache, frame_info, last_timestamp):
+        """
+        :param frame_cache The FrameCache of the feed
+        :param frame_info The frame about to be sent
+        :param last_timestamp The timestamp of the last frame sent
+
+        :return The least number of seconds between sending the last frame
+                and this one
+        """
+        frame, ts, sequence_num = frame_info
+
+        if self.mode == REPLAY:
+            return min(max(ts - last_timestamp, 0), MAX_REPLAY_GAP)
+
+        # Frames at the live edge are sent as soon as they arrive
+        latest = frame_cache.get_latest_frame()
+        if latest is None or latest[2] == sequence_num:
+            return 0
+
+        framerate = max(frame_cache.get_framerate(), 1)
+
+        return 1.0 / (framerate * obs_settings.catchup_speed)
+
+    @gen.coroutine
+    def write_frame(self, encoded_frame):
+        """
+        Writes a frame, to be flushed by `flush_buffered`. If that leaves
+        more than `max_buffer_bytes` waiting to be flushed, waits for all of
+        them to be flushed.
+
+        :param encoded_frame The `broadcaster.EncodedFrame` to write
+
+        :return The seconds spent waiting, 0 if the frame fit in the buffer
+        """
+        data = encoded_frame.get_data(self.chunked)
+
+        #logging.debug("Sending frame %d to client",
+        #    encoded_frame.sequence_num)
+
+        self.write(data)
+        self.buffered_bytes += len(data)
+
+        self.frames_sent += 1
+        self.broadcaster.bytes_sent += len(data)
+
+        if self.flusher is None or self.flusher.done():
+            self.flusher = self.flush_buffered()
+
+        if self.buffered_bytes <= self.max_buffer_bytes:
+            raise gen.Return(0)
+
+        start = time.time()
+
+        yield self.flusher
+
+        if self.stream_finished.done():
+            raise tornado.iostream.StreamClosedError()
+
+        raise gen.Return(time.time() - start)
+
+    @gen.coroutine
+    def flush_buffered(self):
+        """
+        Flushes the frames written, and those written while they're being
+        flushed, until there's none left. Only one flush is ever in
+        progress, as tornado only resolves the most recent one.
+        """
+        try:
+            while self.buffered_bytes > 0:
+                flushing = self.buffered_bytes
+
+                yield self.flush()
+
+                self.buffered_bytes -= flushing
+
+        except tornado.iostream.StreamClosedError:
+            self.buffered_bytes = 0
+            self.end_stream()
+
+    def end_stream(self):
+        if not self.stream_finished.done():
+            self.stream_finished.set_result(None)
+
+            # Wake the writer, so it notices
+            self.frame_available.notify_all()
+
+    def on_connection_close(self):
+        if self.broadcaster is not None:
+            self.end_stream()
+
+class RecordingHandler(BaseHandler):
+    """
+    Streams a feed's recorded footage from `settings.storage.dir`, in the
+    same multipart format as live feeds. The stream starts at `from_time`
+    (seconds since the epoch, or relative to now if negative), or the start
+    of the oldest recording, and ends at `to_time` or the end of the newest
+    recording.
+
+    Frames are sent with the intervals they were recorded with, although
+    gaps in the recording are cut short (see `MAX_REPLAY_GAP`). Segments are
+    read through their timestamp index, and memory mapped, so only the
+    frames sent are read (see `avi.AVIReader`).
+    """
+    @gen.coroutine
+    def get(self, slug):
+        segments = storage.get_segments(
+            storage.get_feed_directory(storage_settings.dir, slug))
+
+        if not segments:
+            raise HTTPError(404, "No recordings of '%s'" % slug)
+
+        try:
+            from_time = self.get_time_argument("from_time")
+            to_time = self.get_time_argument("to_time")
+
+        except ValueError:
+            raise HTTPError(400, "Invalid recording time")
+
+        self.start_multipart()
+
+        self.frames_sent = 0
+        self.stream_closed = False
+
+        try:
+            yield self.play(segments[self.find_segment(segments, from_time):],
+                            from_time, to_time)
+
+        except tornado.iostream.StreamClosedError:
+            pass
+
+        logging.debug("Recording of '%s' finished, %d frames sent", slug,
+            self.frames_sent)
+
+        self.end_multipart()
+
+    def get_time_argument(self, name):
+        """
+        :return The time given by the argument, or None if it wasn't given
+
+        :raises ValueError When the argument isn't a number
+        """
+        value = self.get_argument(name, None)
+
+        if value is None:
+            return None
+
+        value = float(value)
+
+        if value < 0:
+            value += time.time()
+
+        return value
+
+    def find_segment(self, segments, timestamp):
+        """
+        :param segments The paths of the feed's segments, oldest first
+        :param timestamp The time to start from, or None for the oldest
+
+        :return The position of the segment holding the frames from
+                `timestamp`
+        """
+        position = 0
+
+        if timestamp is None:
+            return position
+
+        for i, path in enumerate(segments):
+            start_time = avi.get_start_time(path)
+
+            if start_time is not None and start_time > timestamp:
+                break
+
+            position = i
+
+        return position
+
+    @gen.coroutine
+    def play(self, segments, from_time, to_time):
+        """
+        Writes the recorded frames in the given segments, from `from_time`
+        to `to_time`, paced as they were recorded.
+        """
+        last_timestamp = None
+        last_write_time = None
+
+        for path in segments:
+            try:
+                reader = avi.AVIReader(path)
+
+            except EnvironmentError:
+                # Deleted to stay within the storage budget
+                logging.debug("Skipping unreadable recording %s", path)
+                continue
+
+            try:
+                position = 0
+                if from_time is not None:
+                    position = reader.find_frame(from_time)
+
+                for position in xrange(position, reader.frame_count):
+                    if self.stream_closed:
+                        return
+
+                    frame, ts = reader.read_frame(position)
+
+                    if to_time is not None and ts > to_time:
+                        return
+
+                    if last_write_time is not None:
+                        delay = (min(max(ts - last_timestamp, 0),
+                                     MAX_REPLAY_GAP)
+                                 - (time.time() - last_write_time))
+
+                        if delay > 0:
+                            yield gen.sleep(delay)
+
+                    last_write_time = time.time()
+
+                    encoded_frame = broadcaster.EncodedFrame(frame, ts,
+                                                             position)
+
+                    self.write(encoded_frame.get_data(self.chunked))
+                    self.frames_sent += 1
 
-        while (yield self.application.thread_pool.submit(f_helper.get_frame)):
-            # The yield statement in the while loop will execute the future
-            # returned by the thread_pool. The Future will return the result of
-            # `FrameHelper.get_frame`. If True, there is a frame available,
-            # which we can read out.
-            frame = f_helper.next_frame
+                    yield self.flush()
 
-            #logging.debug("Sending frame %s to client", repr(frame))
-            logging.debug("Sending frame %d to client", f_helper.last_frame_id)
+                    last_timestamp = ts
 
-            self.write(b"--frame\r\n"
-                       b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n")
+            finally:
+                reader.close()
 
-            # Flush the frame out
-            self.flush()
+    def on_connection_close(self):
+        self.stream_closed = True
@@ -0,0 +1,189 @@
+"""
+protocol.py
+
+Implements parsing of the fragment datagrams sent by video feed transmitters
+to the receiver. Datagrams are parsed in place: only the small header fields
+are copied, while the (potentially large) frame payload is exposed as a
+`memoryview` of the received datagram. This lets the receiver hand the
+payload to the cache without splitting and re-joining the frame data.
+
+Two versions of the fragment format are supported on the same port. A
+version 1 fragment datagram is in the form:
+<challenge>\x00<seq num>\x00<max fragments>\x00<fragment num>\x00<frame>\x00
+
+Note that the frame itself may contain \x00, so only the first four
+delimiters separate header fields, and the payload runs up to the final
+delimiter.
+
+A version 2 fragment datagram has a fixed size binary header (see
+`HEADER_V2`) followed by the frame payload. The header starts with a marker
+byte which can never start a version 1 fragment, as challenge tokens are
+only digits. The protocol version is negotiated during authentication.
+"""
+
+import struct
+import zlib
+
+DELIMITER = "\x00"
+
+# The number of delimited header fields preceding the frame payload
+HEADER_FIELDS = 4
+
+# The highest protocol version we understand
+PROTOCOL_VERSION = 2
+
+V2_MARKER = 0xff
+
+# Set in the header flags if the checksum field holds the CRC32 of the payload
+FLAG_CHECKSUM = 0x01
+
+# marker, version, flags, token, sequence number, max fragments,
+# fragment number, payload length, checksum
+HEADER_V2 = struct.Struct("!BBB8sIHHHI")
+
+TOKEN_LENGTH_V2 = 8
+
+class InvalidFragmentError(Exception):
+    """ Raised when a datagram is not a valid fragment """
+    pass
+
+def parse_fragment(data, length = None):
+    """
+    Parses a fragment datagram without copying its payload.
+
+    :param data The datagram, either a str or a bytearray (e.g. a reusable
+                receive buffer)
+    :param length The number of valid bytes in `data`. Defaults to the whole
+                  of `data`
+
+    :return A tuple of (challenge token, sequence number, max fragments,
+            fragment number, payload), where payload is a memoryview over
+            `data`
+
+    :raises InvalidFragmentError When the datagram is malformed
+    """
+    if length is None:
+        length = len(data)
+
+    if data[0:1] == chr(V2_MARKER):
+        return _parse_fragment_v2(data, length)
+
+    fields = []
+    start = 0
+
+    # Only scan as far as the header delimiters, the payload is never
+    # searched
+    for _ in range(HEADER_FIELDS):
+        end = data.find(DELIMITER, start, length)
+
+        if end == -1:
+            raise InvalidFragmentError("Fragment has too few header fields")
+
+        fields.append(data[start:end])
+
+        start = end + 1
+
+    # The payload is terminated by the last delimiter. Searching backwards
+    # finds it immediately for well formed fragments.
+    end = data.rfind(DELIMITER, start, length)
+
+    if end == -1:
+        raise InvalidFragmentError("Fragment payload is not terminated")
+
+    try:
+        sequence_num = int(fields[1])
+        max_fragments = int(fields[2])
+        fragment_num = int(fields[3])
+
+    except ValueError:
+        raise InvalidFragmentError("Unable to cast header fields to int")
+
+    return (str(fields[0]), sequence_num, max_fragments, fragment_num,
+            memoryview(data)[start:end])
+
+def _parse_fragment_v2(data, length):
+    """
+    Parses a version 2 fragment. See `parse_fragment`.
+    """
+    if length < HEADER_V2.size:
+        raise InvalidFragmentError("Fragment is shorter than the header")
+
+    (marker, version, flags, token, sequence_num, max_fragments,
+        fragment_num, payload_len, checksum) = HEADER_V2.unpack_from(data)
+
+    if version != 2:
+        raise InvalidFragmentError("Unsupported protocol version %d" % version)
+
+    start = HEADER_V2.size
+    end = start + payload_len
+
+    if end > length:
+        raise InvalidFragmentError("Fragment payload is truncated")
+
+    if flags & FLAG_CHECKSUM:
+        if zlib.crc32(buffer(data, start, payload_len)) & 0xffffffff \
+                != checksum:
+            raise InvalidFragmentError("Fragment checksum mismatch")
+
+    return (token.rstrip("\x00"), sequence_num, max_fragments, fragment_num,
+            memoryview(data)[start:end])
+
+def build_fragment(token, sequence_num, max_fragments, fragment_num, payload,
+                   version = 1, checksum = False):
+    """
+    Builds a fragment datagram.
+
+    :param token The challenge token received on authentication
+    :param sequence_num The ID of the frame
+    :param max_fragments The number of fragments in the sequence
+    :param fragment_num The ID of the fragment in the sequence
+    :param payload The fragment data
+    :param version The protocol version to use
+    :param checksum Whether to include a CRC32 of the payload (version 2
+                    only)
+
+    :return The datagram as a str
+    """
+    if version == 1:
+        return "%s\x00%d\x00%d\x00%d\x00%s\x00" % (token, sequence_num,
+            max_fragments, fragment_num, payload)
+
+    elif version == 2:
+        if len(token) > TOKEN_LENGTH_V2:
+            raise ValueError("Token '%s' is too long for protocol version 2"
+                % token)
+
+        flags = 0
+        crc = 0
+        if checksum:
+            flags |= FLAG_CHECKSUM
+            crc = zlib.crc32(payload) & 0xffffffff
+
+        return HEADER_V2.pack(V2_MARKER, 2, flags, token,
+                              sequence_num & 0xffffffff, max_fragments,
+                              fragment_num, len(payload), crc) + payload
+
+    raise ValueError("Unsupported protocol version %s" % version)
+
+def fragment_frame(token, sequence_num, frame, max_payload_size, 
+                   version = 1, checksum = False):
+    """
+    Splits a frame into fragment datagrams.
+
+    :param token The challenge token received on authentication
+    :param sequence_num The ID of the frame
+    :param frame The encoded frame
+    :param max_payload_size The maximum size of each fragment's payload
+    :param version The protocol version to use
+    :param checksum Whether to include payload checksums (version 2 only)
+
+    :return A list of datagrams
+    """
+    num_fragments = max(1, 
+        (len(frame) + max_payload_size - 1) // max_payload_size)
+
+    return [ build_fragment(token, sequence_num, num_fragments, i,
+                            frame[i * max_payload_size:
+                                  (i + 1) * max_payload_size],
+                            version, checksum)
+             for i in range(num_fragments) ]
@@ -0,0 +1,103 @@
+"""
+reaper.py
+
+Feeds and authenticated clients would otherwise stay around for as long as
+the daemon runs, along with their cached frames and tokens, as transmitters
+come and go (often reconnecting with new identifiers). The reaper
+periodically removes feeds which haven't received a frame for a while, and
+expires the tokens of clients which haven't sent a fragment for longer
+still, so that they have to authenticate again. Tokens of feeds which are
+only relayed, never cached, are kept for as long as fragments arrive.
+
+Removing a feed notifies the feed cache's removal listeners, so viewers'
+streams are ended and recordings are closed (see
+`caching.FeedCache.add_removal_listener`).
+"""
+
+import logging
+import time
+
+import tornado.ioloop
+
+class FeedReaper(object):
+    """
+    Reaps idle feeds and expires idle clients' tokens. Runs on the IOLoop.
+    """
+    def __init__(self, feed_cache, authenticator, feed_timeout, token_timeout,
+                 interval, io_loop = None):
+        """
+        :param feed_cache The `caching.FeedCache` to remove idle feeds from
+        :param authenticator The `authentication.Authenticator` to expire
+                             tokens of
+        :param feed_timeout Seconds without a frame before a feed is removed
+        :param token_timeout Seconds without a fragment before a token
+                             expires
+        :param interval Seconds between checks
+        :param io_loop The IOLoop to run on
+        """
+        self.feed_cache = feed_cache
+        self.authenticator = authenticator
+
+        self.feed_timeout = feed_timeout
+        self.token_timeout = token_timeout
+
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+
+        # Stats
+        self.feeds_reaped = 0
+        self.tokens_expired = 0
+
+        self._timer = tornado.ioloop.PeriodicCallback(self.reap,
+                                                      interval * 1000,
+                                                      io_loop = self.io_loop)
+
+    def start(self):
+        self._timer.start()
+
+    def stop(self):
+        self._timer.stop()
+
+    def reap(self):
+        """
+        Removes idle feeds, drops timed out reassembly buffers of the others,
+        and expires the tokens of idle clients.
+        """
+        now = time.time()
+
+        for cache in self.feed_cache.caches.values():
+            client = cache.client
+
+            if now - client.last_frame_update > self.feed_timeout:
+                logging.info("Removing feed '%s', no frames for %.1f seconds",
+                    client.identifier, now - client.last_frame_update)
+
+                self._remove_feed(client)
+
+            else:
+                cache.expire_reassembly()
+
+        for client in self.authenticator.get_idle_clients(self.token_timeout):
+            logging.info("Expiring token of '%s' (%s), no fragments for %.1f "
+                "seconds", client.identifier, client.host,
+                now - client.last_seen)
+
+            # The feed is normally long gone, unless the token timeout is the
+            # shorter one
+            if client.cache is not None:
+                self._remove_feed(client)
+
+            self.authenticator.remove_client(client)
+
+            self.tokens_expired += 1
+
+    def _remove_feed(self, client):
+        cache = self.feed_cache.remove_cache(client)
+
+        if cache is None:
+            return
+
+        # Removal listeners may hand the cache over to the IOLoop (e.g. to
+        # end viewers' streams), so only release it after they've run
+        self.io_loop.add_callback(cache.close)
+
+        self.feeds_reaped += 1
@@ -8,22 +8,139 @@ sent via UDP, so we can tolerate frame loss or temporary loss of connection.
 The receiver maintains a cache of frames so clients that wish to view the
 stream will receive at least some frames if none have been received for
 some time.
+
+Three receiver implementations are provided, selected by
+`settings.receiver.mode`:
+
++ "threaded": a SocketServer UDP server which spawns a new thread for every
+  datagram received.
++ "batched": a fixed number of long-lived reader threads which drain the
+  socket in batches into preallocated buffers.
++ "ioloop": the socket is registered on the tornado IOLoop which also runs
+  the observer, so frames are completed and broadcast to viewers in the same
+  thread, without handing them between threads.
+
+Alternatively, when `settings.receiver.workers` is set, datagrams are
+received and reassembled by that many worker processes sharing the receiver
+port (see `ReceiverPool`), so receiving isn't limited by the daemon
+process' GIL.
 """
 
+import errno
 import logging
+import multiprocessing
+import multiprocessing.managers
+import os
+import select
+import signal
+import socket
 import SocketServer
+import threading
+import time
+
+import tornado.ioloop
 
 from settings import receiver as recv_settings
 
+import authentication
 import caching
+import protocol
+import relay
+import sharedmem
+
+# Python 2 doesn't expose SO_REUSEPORT, 15 is its value on Linux
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+class ReceiverStats(object):
+    """
+    Thread-safe packet counters for a receiver. Readers may record a whole
+    batch at once so the lock is only taken once per batch. The counters
+    are periodically written to the log.
+    """
+    def __init__(self, report_interval):
+        self.report_interval = report_interval
+
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+
+        self.lock = threading.Lock()
+
+        self._last_report_time = time.time()
+        self._last_report_packets = 0
+
+        # A callable returning the number of datagrams dropped by the kernel
+        # (i.e. socket buffer overruns), or None if not available
+        self.kernel_drops = lambda: None
+
+    def record(self, packets, nbytes, dropped):
+        """
+        Records a batch of received packets.
+
+        :param packets The number of packets received
+        :param nbytes The total size of the received packets
+        :param dropped The number of packets which were discarded
+        """
+        with self.lock:
+            self.packets += packets
+            self.bytes += nbytes
+            self.dropped += dropped
+
+            now = time.time()
+            if now - self._last_report_time >= self.report_interval:
+                self._report(now)
+
+    def packets_per_second(self):
+        with self.lock:
+            elapsed = time.time() - self._last_report_time
+
+            return (self.packets - self._last_report_packets) / \
+                (elapsed if elapsed > 0 else 1)
+
+    def _report(self, now):
+        rate = (self.packets - self._last_report_packets) / \
+            (now - self._last_report_time)
+
+        logging.info("Receiver: %.1f packets/s, %d packets (%d bytes) total, "
+            "%d dropped, %s dropped by kernel", rate, self.packets,
+            self.bytes, self.dropped, self.kernel_drops())
+
+        self._last_report_time = now
+        self._last_report_packets = self.packets
+
+def read_socket_drops(sock):
+    """
+    Reads the number of datagrams dropped by the kernel for the given UDP
+    socket from /proc/net/udp. This is only available on Linux.
+
+    :param sock The bound UDP socket
+
+    :return The number of dropped datagrams, or None if unavailable
+    """
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+
+        with open("/proc/net/udp") as f:
+            # Skip the header line
+            f.readline()
+
+            for line in f:
+                fields = line.split()
+
+                if fields[9] == inode:
+                    return int(fields[-1])
+
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+
+    return None
 
 class ReceiverHandler(SocketServer.BaseRequestHandler):
     """
     A new handler instance is created for every frame sent by whatever our
-    transmitter is. Each handler is run in its own thread. We need to
-    authenticate the request and if valid, store the frame under the
-    client's unique ID. We can technically have multiple sources (i.e.
-    a MIMO system).
+    transmitter is. Each handler is run in its own thread. The actual
+    processing of the datagram is done by the server, which is shared with
+    the batched receiver.
     """
     def __init__(self, request, client_address, server):
         SocketServer.BaseRequestHandler.__init__(self, request, 
@@ -33,108 +150,106 @@ class ReceiverHandler(SocketServer.BaseRequestHandler):
         pass
 
     def handle(self):
-        """
-        Handles the UDP packet. Data is sent in the format:
-        <challenge>\x00<seq num>\x00<max fragments>\x00<fragment num>\x00<frame>\x00,
-        where \x00 is a character delimiting the fragment. <seq num> is a 
-        unique number identifying the frame and <fragment num> is a number 
-        identifying which part of the frame this fragment belongs to. 
-        <max fragments> is a number indicating how many fragments are in the
-        sequence.
-        Note that the frame itself may have \x00 in its binary, therefore we
-        should simply join everything after our control parameters.
+        self.server.handle_datagram(self.request[0], self.client_address)
 
-        This protocol allows for 'split-packet' sending of frames, i.e. a frame
-        can be split into multiple packets, allowing large frames to be sent
-        despite the ~65kB limit of UDP packets.
-        """
-        try:
-            data = self.request[0]
+    def finish(self):
+        pass
 
-            #logging.debug("Received %s from %s", repr(data), self.client_address)
-            delimited = data.split("\x00")
+class BaseReceiver(object):
+    """
+    Implements processing of received datagrams, independent of how they are
+    read from the socket. We need to authenticate the request and if valid,
+    store the frame under the client's unique ID. We can technically have
+    multiple sources (i.e. a MIMO system).
 
-            #print delimited
+    Subclasses must set `authenticator`, `feed_cache`, `relay_manager` and
+    `stats`.
+    """
+    # A (token, client) tuple for the last authenticated token
+    _last_authenticated = None
 
-            if len(delimited) < 5:
-                logging.warn("Invalid fragment received from %s", 
-                    self.client_address)
+    def handle_datagram(self, data, client_address, length = None):
+        """
+        Handles the UDP packet. The datagram format is described in the
+        `protocol` module. This protocol allows for 'split-packet' sending of
+        frames, i.e. a frame can be split into multiple packets, allowing
+        large frames to be sent despite the ~65kB limit of UDP packets.
 
-                return
+        The fragment payload is passed to the cache as a memoryview over
+        `data`, so `data` may be a reused buffer as long as it is not
+        modified until this method returns.
 
+        :param data The datagram (a str or bytearray)
+        :param client_address The address the datagram was received from
+        :param length The number of valid bytes in `data`, if it is a buffer
+
+        :return True if the fragment was accepted, False if it was dropped
+        """
+        try:
             try:
-                challenge_token = delimited[0]
-                sequence_num = int(delimited[1])
-                max_fragments = int(delimited[2])
-                fragment_num = int(delimited[3])
-            except ValueError:
-                logging.exception("Unable to cast packet data to int")
-                return
-            
-            fragment = "\x00".join(delimited[4:-1])
+                (challenge_token, sequence_num, max_fragments, fragment_num,
+                    fragment) = protocol.parse_fragment(data, length)
 
-            #if sequence_num == 24:
-                #logging.debug("Received %s from %s", repr(data), self.client_address)
-                #logging.debug("Received fragment of length %s", len(fragment))
-                #logging.debug(delimited)
+            except protocol.InvalidFragmentError as e:
+                logging.warn("Invalid fragment received from %s: %s", 
+                    client_address, e)
+
+                return False
 
             # Need to verify the challenge token and store the frame under the
             # token's UID
-            client = self.server.authenticate(challenge_token)
+            client = self.authenticate(challenge_token)
 
             if client is None:
                 logging.warn("Invalid challenge token given by %s", 
-                    self.client_address)
+                    client_address)
 
-            else:
-                # store the frame in the cache
-                self.server.cache_frame(client, sequence_num, max_fragments, fragment_num, fragment)
+                return False
 
-        except:
-            logging.exception("An error occurred handling fragment from %s",
-                self.client_address)
+            client.last_seen = time.time()
 
-    def finish(self):
-        pass
+            # Feeds relayed in pass-through mode are forwarded as soon as
+            # their fragments arrive, and may not need caching locally
+            if (self.relay_manager is not None
+                    and not self.relay_manager.relay_fragment(client,
+                        sequence_num, max_fragments, fragment_num, fragment)):
+                return True
 
+            # store the frame in the cache
+            self.cache_frame(client, sequence_num, max_fragments, 
+                             fragment_num, fragment)
 
-class ReceiverServer(SocketServer.ThreadingMixIn, SocketServer.UDPServer):
-    def __init__(self, server_address, authenticator, feed_cache,
-                 handler = ReceiverHandler):
-        """
-        Set up cache and others, run super init.
-        """
+            return True
 
-        # Allow binding to the same address if the app didn't exit cleanly
-        self.allow_reuse_address = True
-        # Ensure request threads are terminated when the application exits
-        self.daemon_threads = True
+        except:
+            logging.exception("An error occurred handling fragment from %s",
+                client_address)
 
-        SocketServer.UDPServer.__init__(self, server_address, handler)
-
-        self.authenticator = authenticator
-        self.feed_cache = feed_cache
-        
+            return False
 
     def authenticate(self, token):
         """
-        Encapsulates authentication.
+        Encapsulates authentication. Consecutive fragments almost always come
+        from the same transmitter, so the last successfully authenticated
+        token is remembered and matched before looking the token up.
 
         :param token The token to verify
 
         :return The client the token belongs to, or None if the toke cannot be
                 verified
         """
-        client = None
+        # Read the memo once, as other reader threads may replace it
+        last = self._last_authenticated
 
-        try:
-            client = self.authenticator.authenticate_token(token)
+        if last is not None and last[0] == token and not last[1].expired:
+            return last[1]
 
-        except:
-            logging.exception("Error authenticating token '%s'", token)
+        client = self.authenticator.find_client_by_token(token)
 
-        finally:
-            return client
+        if client is not None:
+            self._last_authenticated = (token, client)
+
+        return client
 
     def cache_frame(self, client, sequence_num, max_fragments, fragment_num, 
                     frame):
@@ -146,7 +261,7 @@ class ReceiverServer(SocketServer.ThreadingMixIn, SocketServer.UDPServer):
         :param sequence_num The ID of the frame
         :param max_fragments The number of fragments in the sequence
         :param fragment_num The ID of the fragment in the sequence
-        :param frame The raw frame data (posssibly split)
+        :param frame The raw frame data (posssibly split), as a buffer
         """
         try:
             self.feed_cache.cache_frame(client, sequence_num, max_fragments, 
@@ -155,9 +270,514 @@ class ReceiverServer(SocketServer.ThreadingMixIn, SocketServer.UDPServer):
         except:
             logging.exception("Exception caching frame for %s", client)
 
+class ReceiverServer(BaseReceiver, SocketServer.ThreadingMixIn, 
+                     SocketServer.UDPServer):
+    def __init__(self, server_address, authenticator, feed_cache,
+                 relay_manager = None, handler = ReceiverHandler):
+        """
+        Set up cache and others, run super init.
+        """
+
+        # Allow binding to the same address if the app didn't exit cleanly
+        self.allow_reuse_address = True
+        # Ensure request threads are terminated when the application exits
+        self.daemon_threads = True
+
+        SocketServer.UDPServer.__init__(self, server_address, handler)
+
+        self.authenticator = authenticator
+        self.feed_cache = feed_cache
+        self.relay_manager = relay_manager
+
+        self.stats = ReceiverStats(recv_settings.stats_interval)
+        self.stats.kernel_drops = lambda: read_socket_drops(self.socket)
+
+    def handle_datagram(self, data, client_address):
+        accepted = BaseReceiver.handle_datagram(self, data, client_address)
+
+        self.stats.record(1, len(data), 0 if accepted else 1)
+
+        return accepted
+
+    def stop_server(self):
+        """
+        Stop listening and close the socket
+        """
+        self.shutdown()
+        self.server_close()
+
+class BatchedReceiverServer(BaseReceiver):
+    """
+    Receives datagrams using a fixed number of long-lived reader threads
+    rather than a thread per datagram. Each reader owns a preallocated
+    buffer which datagrams are read into with `recvfrom_into`, and drains up
+    to `batch_size` datagrams from the socket every time it wakes up. The
+    server exposes the same `serve_forever`/`shutdown`/`server_close`
+    interface as the SocketServer based receiver.
+    """
+    def __init__(self, server_address, authenticator, feed_cache,
+                 relay_manager = None, readers = 1, batch_size = 64,
+                 buffer_size = 65535, reuse_port = False):
+        self.authenticator = authenticator
+        self.feed_cache = feed_cache
+        self.relay_manager = relay_manager
+
+        self.readers = readers
+        self.batch_size = batch_size
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Allow binding to the same address if the app didn't exit cleanly
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Share the port with other processes, the kernel spreads
+            # datagrams between them by source address
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.socket.bind(server_address)
+
+        self.server_address = self.socket.getsockname()
+
+        # One buffer per reader, large enough for any UDP datagram
+        self._buffers = [ bytearray(buffer_size) for _ in range(readers) ]
+
+        self.stats = ReceiverStats(recv_settings.stats_interval)
+        self.stats.kernel_drops = lambda: read_socket_drops(self.socket)
+
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+
+    def serve_forever(self, poll_interval = 0.5):
+        """
+        Runs the reader loops until `shutdown` is called. The first reader
+        runs in the calling thread, any additional readers in their own
+        daemon threads.
+        """
+        self._is_shut_down.clear()
+
+        threads = []
+        for buf in self._buffers[1:]:
+            t = threading.Thread(target = self._read_loop, 
+                                 args = (buf, poll_interval))
+            t.daemon = True
+            t.start()
+
+            threads.append(t)
+
+        try:
+            self._read_loop(self._buffers[0], poll_interval)
+
+            for t in threads:
+                t.join()
+
+        finally:
+            self._shutdown_request = False
+            self._is_shut_down.set()
+
+    def _read_loop(self, buf, poll_interval):
+        while not self._shutdown_request:
+            r, _, _ = select.select([self.socket], [], [], poll_interval)
+
+            if not r:
+                continue
+
+            packets = 0
+            nbytes = 0
+            dropped = 0
+
+            # Drain as many datagrams as are available (up to the batch size)
+            # without blocking
+            while packets < self.batch_size:
+                try:
+                    n, address = self.socket.recvfrom_into(buf, 0,
+                                                           socket.MSG_DONTWAIT)
+                except socket.error as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        logging.exception("Error reading from receiver socket")
+
+                    break
+
+                packets += 1
+                nbytes += n
+
+                # The buffer is only reused once the datagram is handled, as
+                # the cache copies the payload out of it
+                if not self.handle_datagram(buf, address, n):
+                    dropped += 1
+
+            self.stats.record(packets, nbytes, dropped)
+
+    def shutdown(self):
+        """
+        Stops the reader loops, and blocks until they have exited
+        """
+        self._shutdown_request = True
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        self.socket.close()
+
     def stop_server(self):
         """
         Stop listening and close the socket
         """
         self.shutdown()
         self.server_close()
+
+class IOLoopReceiverServer(BaseReceiver):
+    """
+    Receives datagrams on a tornado IOLoop rather than in threads of its own.
+    The socket is non-blocking, and every time it becomes readable up to
+    `batch_size` datagrams are drained into a single preallocated buffer.
+    Every fragment is handled on the IOLoop thread, so the frame listeners
+    (e.g. the observer's broadcasters) run there too.
+
+    Call `start` to register the socket, rather than running `serve_forever`
+    in a thread.
+    """
+    def __init__(self, server_address, authenticator, feed_cache,
+                 relay_manager = None, io_loop = None, batch_size = 64,
+                 buffer_size = 65535):
+        self.authenticator = authenticator
+        self.feed_cache = feed_cache
+        self.relay_manager = relay_manager
+
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.batch_size = batch_size
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Allow binding to the same address if the app didn't exit cleanly
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setblocking(False)
+        self.socket.bind(server_address)
+
+        self.server_address = self.socket.getsockname()
+
+        self._buffer = bytearray(buffer_size)
+
+        self.stats = ReceiverStats(recv_settings.stats_interval)
+        self.stats.kernel_drops = lambda: read_socket_drops(self.socket)
+
+        self._started = False
+
+    def start(self):
+        """
+        Registers the socket on the IOLoop. Datagrams are handled once the
+        IOLoop is running.
+        """
+        if self._started:
+            return
+
+        self.io_loop.add_handler(self.socket.fileno(), self._on_readable,
+                                 tornado.ioloop.IOLoop.READ)
+
+        self._started = True
+
+    def serve_forever(self, poll_interval = 0.5):
+        """
+        Registers the socket and runs the IOLoop, for running the receiver on
+        its own.
+        """
+        self.start()
+        self.io_loop.start()
+
+    def _on_readable(self, fd, events):
+        packets = 0
+        nbytes = 0
+        dropped = 0
+
+        # Drain what's available, but return to the IOLoop after a batch so
+        # viewers aren't starved under heavy load
+        while packets < self.batch_size:
+            try:
+                n, address = self.socket.recvfrom_into(self._buffer)
+
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logging.exception("Error reading from receiver socket")
+
+                break
+
+            packets += 1
+            nbytes += n
+
+            if not self.handle_datagram(self._buffer, address, n):
+                dropped += 1
+
+        if packets:
+            self.stats.record(packets, nbytes, dropped)
+
+    def shutdown(self):
+        """
+        Unregisters the socket from the IOLoop. Must be called on the IOLoop
+        thread, or once the IOLoop has stopped.
+        """
+        if self._started:
+            self.io_loop.remove_handler(self.socket.fileno())
+
+            self._started = False
+
+    def server_close(self):
+        self.socket.close()
+
+    def stop_server(self):
+        """
+        Stop listening and close the socket
+        """
+        self.shutdown()
+        self.server_close()
+
+def _ignore_interrupt():
+    # The daemon stops its child processes itself on a KeyboardInterrupt
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _run_worker(index, server_address, shared_tokens, ring, queue,
+                readers, batch_size, buffer_size):
+    """
+    The main function of a `ReceiverPool` worker process. Frames are
+    received and reassembled as usual, and every complete frame is written
+    to the worker's ring, with its location put on the queue.
+    """
+    _ignore_interrupt()
+
+    authenticator = authentication.SharedTokenAuthenticator(shared_tokens)
+
+    # Frames are only cached until they're published, viewers are served by
+    # the daemon's own cache
+    feed_cache = caching.FeedCache(1, recv_settings.reassembly_window,
+                                   recv_settings.reassembly_timeout)
+
+    def publish(cache, frame_info):
+        frame, ts, sequence_num = frame_info
+
+        location = ring.write(cache.client.token, sequence_num, ts, frame)
+
+        if location is None:
+            logging.warn("Frame %d of '%s' is too large for shared memory "
+                "(%d bytes)", sequence_num, cache.client.identifier, 
+                len(frame))
+
+            return
+
+        queue.put((index,) + location)
+
+    feed_cache.add_listener(publish)
+
+    def revalidate():
+        # Forget the feeds of tokens which the daemon has expired
+        while True:
+            time.sleep(recv_settings.reap_interval)
+
+            for client in authenticator.revalidate():
+                feed_cache.remove_cache(client)
+
+    t = threading.Thread(target = revalidate)
+    t.daemon = True
+    t.start()
+
+    server = BatchedReceiverServer(server_address, authenticator, feed_cache,
+                                   readers = readers, batch_size = batch_size,
+                                   buffer_size = buffer_size, 
+                                   reuse_port = True)
+
+    logging.info("Receiver worker %d (pid %d) listening on %s:%s", index,
+        os.getpid(), *server.server_address)
+
+    server.serve_forever()
+
+class ReceiverPool(object):
+    """
+    Receives datagrams in a number of worker processes, each binding the
+    receiver port with SO_REUSEPORT. The kernel picks the worker for every
+    datagram by its source address, so all fragments of a transmitter are
+    reassembled by the same worker.
+
+    Workers verify tokens through the map published by the daemon's
+    `Authenticator` (see `Authenticator.share_tokens`), held by a
+    `multiprocessing.Manager` process. Complete frames are written to a
+    shared memory `sharedmem.FrameRing` per worker, and `serve_forever`
+    reads them back out, as the workers announce them, into the daemon's
+    feed cache, from which viewers, storage and relays are served as usual.
+
+    Pass-through relaying isn't possible, as fragments never reach the
+    daemon process, so all feeds are relayed as complete frames.
+    """
+    def __init__(self, server_address, authenticator, feed_cache,
+                 relay_manager = None, workers = 2, ring_slots = 64,
+                 ring_slot_size = 512 * 1024, readers = 1, batch_size = 64,
+                 buffer_size = 65535):
+        self.authenticator = authenticator
+        self.feed_cache = feed_cache
+
+        if relay_manager is not None and (relay_manager.feed_modes
+                or relay_manager.default_mode != relay.REASSEMBLED):
+            logging.warn("Pass-through relaying isn't available with "
+                "receiver workers, relaying complete frames instead")
+
+            relay_manager.default_mode = relay.REASSEMBLED
+            relay_manager.feed_modes = {}
+
+        if server_address[1] == 0:
+            # Find a free port for the workers to share
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            s.bind(server_address)
+            server_address = s.getsockname()
+            s.close()
+
+        self.server_address = server_address
+
+        self._manager = multiprocessing.managers.SyncManager()
+        self._manager.start(_ignore_interrupt)
+
+        shared_tokens = self._manager.dict()
+        authenticator.share_tokens(shared_tokens)
+
+        # Locations of frames written by the workers, as (worker, slot,
+        # generation) tuples
+        self._queue = multiprocessing.Queue()
+
+        self.rings = [ sharedmem.FrameRing(ring_slots, ring_slot_size)
+                       for _ in range(workers) ]
+
+        # Workers are started straight away, before the daemon starts any
+        # other threads
+        self.processes = []
+        for index, ring in enumerate(self.rings):
+            process = multiprocessing.Process(target = _run_worker,
+                args = (index, server_address, shared_tokens, ring, 
+                        self._queue, readers, batch_size, buffer_size))
+            process.daemon = True
+            process.start()
+
+            self.processes.append(process)
+
+        # Stats
+        self.frames_received = 0
+        self.worker_frames = [ 0 ] * workers
+        # Frames overwritten in a ring before we could read them
+        self.frames_overrun = 0
+
+        self._is_shut_down = threading.Event()
+
+    def serve_forever(self, poll_interval = 0.5):
+        """
+        Reads the frames announced by the workers into the feed cache, until
+        `shutdown` is called.
+        """
+        self._is_shut_down.clear()
+
+        try:
+            while True:
+                location = self._queue.get()
+
+                if location is None:
+                    break
+
+                self._handle_frame(*location)
+
+        finally:
+            self._is_shut_down.set()
+
+    def _handle_frame(self, index, slot, generation):
+        frame_info = self.rings[index].read(slot, generation)
+
+        if frame_info is None:
+            self.frames_overrun += 1
+            return
+
+        token, sequence_num, ts, frame = frame_info
+
+        client = self.authenticator.find_client_by_token(token)
+
+        if client is None:
+            logging.warn("Frame received by worker %d for unknown token",
+                index)
+
+            return
+
+        # The worker received the fragments, but can't update our client
+        client.last_seen = time.time()
+
+        self.frames_received += 1
+        self.worker_frames[index] += 1
+
+        try:
+            # A complete frame is cached as a frame of a single fragment
+            self.feed_cache.cache_frame(client, sequence_num, 1, 0, frame)
+
+        except:
+            logging.exception("Exception caching frame for %s", client)
+
+    def shutdown(self):
+        """
+        Blocks until `serve_forever` has returned, and then stops the worker
+        processes
+        """
+        self._queue.put(None)
+        self._is_shut_down.wait()
+
+        for process in self.processes:
+            process.terminate()
+
+        for process in self.processes:
+            process.join()
+
+    def server_close(self):
+        for ring in self.rings:
+            ring.close()
+
+        self._manager.shutdown()
+
+    def stop_server(self):
+        """
+        Stop the workers and release shared resources
+        """
+        self.shutdown()
+        self.server_close()
+
+def create_server(server_address, authenticator, feed_cache,
+                  relay_manager = None):
+    """
+    Creates the receiver server selected by `settings.receiver.mode`, or a
+    `ReceiverPool` if `settings.receiver.workers` is set.
+
+    :param server_address The (host, port) to listen on
+    :param authenticator The `authentication.Authenticator` used to verify
+                         challenge tokens
+    :param feed_cache The `caching.FeedCache` frames are stored in
+    :param relay_manager The `relay.RelayManager` fragments are passed to,
+                         if relaying is enabled
+
+    :return A receiver server providing `serve_forever`, `shutdown` and
+            `server_close`. An "ioloop" receiver is instead started with
+            `start`, on the IOLoop it was created for
+    """
+    mode = recv_settings.mode
+
+    if recv_settings.workers:
+        return ReceiverPool(server_address, authenticator, feed_cache,
+                            relay_manager,
+                            workers = recv_settings.workers,
+                            ring_slots = recv_settings.ring_slots,
+                            ring_slot_size = recv_settings.ring_slot_size,
+                            readers = recv_settings.readers,
+                            batch_size = recv_settings.batch_size,
+                            buffer_size = recv_settings.buffer_size)
+
+    if mode == "threaded":
+        return ReceiverServer(server_address, authenticator, feed_cache,
+                              relay_manager)
+
+    elif mode == "batched":
+        return BatchedReceiverServer(server_address, authenticator, 
+                                     feed_cache, relay_manager,
+                                     readers = recv_settings.readers,
+                                     batch_size = recv_settings.batch_size,
+                                     buffer_size = recv_settings.buffer_size)
+
+    elif mode == "ioloop":
+        return IOLoopReceiverServer(server_address, authenticator, feed_cache,
+                                    relay_manager,
+                                    batch_size = recv_settings.batch_size,
+                                    buffer_size = recv_settings.buffer_size)
+
+    raise ValueError("Unknown receiver mode '%s'" % mode)
@@ -6,8 +6,355 @@ by the receiver to other instances of the daemon. This lets us establish a
 decentralised distribution method, as well as the ability to run the service
 in multiple locations. Such ability is necessary for local distribution on
 the scene, as well as remotely for various personnel.
+
+A relay authenticates with each target daemon exactly like a transmitter
+would (one authentication per feed, using the feed's identifier), and then
+re-fragments and sends every complete frame to the target's receiver.
+Frames are handed to each target through a bounded queue and sent from a
+background thread per target, so a slow or unreachable target never blocks
+the receiver.
+
+Feeds can instead be relayed in pass-through mode (see
+`settings.relay.feed_modes`), where the receiver hands every validated
+fragment straight to the relay as it arrives. Only the challenge token is
+rewritten for the target, so frames are forwarded without waiting for them
+to be reassembled, and an edge daemon which only forwards needn't reassemble
+them at all.
 """
 
+import collections
+import logging
 import socket
+import threading
+import time
 
 from settings import relay as relay_settings
+
+import authentication
+import protocol
+
+# Relay modes
+REASSEMBLED = "reassembled"
+PASSTHROUGH = "passthrough"
+
+class RelayTarget(object):
+    """
+    Forwards frames and fragments to a single target daemon. The frame queue
+    holds at most `queue_size` frames and the fragment queue at most
+    `fragment_queue_size` fragments; when a queue is full the oldest item is
+    dropped to make room for the newest.
+    """
+    def __init__(self, auth_address, queue_size, fragment_queue_size,
+                 max_payload_size, protocol_version, auth_timeout,
+                 reauthenticate_interval):
+        self.auth_address = auth_address
+
+        self.max_payload_size = max_payload_size
+        self.protocol_version = protocol_version
+        self.auth_timeout = auth_timeout
+        self.reauthenticate_interval = reauthenticate_interval
+
+        # Queue of (identifier, (frame, timestamp, sequence number))
+        self.queue = collections.deque()
+        self.queue_size = queue_size
+        # Queue of (identifier, (sequence number, max fragments,
+        # fragment number, fragment))
+        self.fragment_queue = collections.deque()
+        self.fragment_queue_size = fragment_queue_size
+        self.condition = threading.Condition()
+
+        # A single socket is reused for sending all datagrams to the target
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        # Map of identifier -> (SimpleAuthenticationClient, time authenticated)
+        # Only used by the sender thread.
+        self._auth_clients = {}
+        # Map of identifier -> time of the last failed authentication attempt
+        self._auth_failures = {}
+
+        # Stats
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.frames_dropped = 0
+        self.fragments_sent = 0
+        self.fragments_dropped = 0
+
+        self._running = False
+        self._thread = None
+
+    def enqueue(self, identifier, frame_info):
+        """
+        Queues a frame to be sent. Called from the receiver's threads, so this
+        must never block for long.
+
+        :param identifier The identifier of the feed the frame belongs to
+        :param frame_info The (frame, timestamp, sequence number) tuple
+        """
+        with self.condition:
+            if len(self.queue) >= self.queue_size:
+                self.queue.popleft()
+                self.frames_dropped += 1
+
+            self.queue.append((identifier, frame_info))
+
+            self.condition.notify()
+
+    def enqueue_fragment(self, identifier, fragment_info):
+        """
+        Queues a fragment to be sent. Called from the receiver's threads, so
+        this must never block for long.
+
+        :param identifier The identifier of the feed the fragment belongs to
+        :param fragment_info A (sequence number, max fragments, fragment
+                             number, fragment) tuple. The fragment must be a
+                             str, not a view of a receive buffer.
+        """
+        with self.condition:
+            if len(self.fragment_queue) >= self.fragment_queue_size:
+                self.fragment_queue.popleft()
+                self.fragments_dropped += 1
+
+            self.fragment_queue.append((identifier, fragment_info))
+
+            self.condition.notify()
+
+    def start(self):
+        self._running = True
+
+        self._thread = threading.Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self.condition:
+            self._running = False
+            self.condition.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        self.socket.close()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while (self._running and not self.queue
+                        and not self.fragment_queue):
+                    self.condition.wait()
+
+                if not self._running:
+                    return
+
+                # Take everything queued, so the lock is only held briefly
+                fragments = list(self.fragment_queue)
+                self.fragment_queue.clear()
+
+                batch = list(self.queue)
+                self.queue.clear()
+
+            # Fragments are sent first, they're the latency sensitive ones
+            for identifier, fragment_info in fragments:
+                try:
+                    self._send_fragment(identifier, fragment_info)
+
+                except:
+                    logging.exception("Exception relaying fragment of '%s' "
+                        "to %s:%s", identifier, *self.auth_address)
+
+                    self.fragments_dropped += 1
+
+            for identifier, frame_info in batch:
+                try:
+                    self._send_frame(identifier, frame_info)
+
+                except:
+                    logging.exception("Exception relaying frame of '%s' to "
+                        "%s:%s", identifier, *self.auth_address)
+
+                    self.frames_dropped += 1
+
+    def _get_auth_client(self, identifier):
+        """
+        Gets an authenticated client for the feed, authenticating with the
+        target if we haven't yet. We re-authenticate periodically, in case
+        the target has restarted or expired our token. After a failed
+        attempt, frames of the feed are dropped until the next retry.
+
+        :param identifier The feed's identifier
+
+        :return A SimpleAuthenticationClient, or None if not authenticated
+        """
+        now = time.time()
+
+        auth_client, auth_time = self._auth_clients.get(identifier,
+                                                        (None, None))
+
+        if (auth_client is not None
+                and now - auth_time < self.reauthenticate_interval):
+            return auth_client
+
+        last_failure = self._auth_failures.get(identifier)
+        if (last_failure is not None
+                and now - last_failure < self.reauthenticate_interval):
+            return auth_client
+
+        new_client = authentication.SimpleAuthenticationClient(
+                                        self.auth_address, identifier,
+                                        self.protocol_version,
+                                        timeout = self.auth_timeout)
+
+        try:
+            new_client.authenticate()
+
+        except (socket.error, ValueError, IndexError):
+            logging.warn("Unable to authenticate feed '%s' with relay target "
+                "%s:%s", identifier, *self.auth_address)
+
+            self._auth_failures[identifier] = now
+
+            # Keep using the previous token, it may still be valid
+            return auth_client
+
+        finally:
+            new_client.close()
+
+        self._auth_failures.pop(identifier, None)
+        self._auth_clients[identifier] = (new_client, now)
+
+        return new_client
+
+    def _send_frame(self, identifier, frame_info):
+        auth_client = self._get_auth_client(identifier)
+
+        if auth_client is None:
+            self.frames_dropped += 1
+            return
+
+        frame, ts, sequence_num = frame_info
+
+        for datagram in auth_client.fragment_frame(sequence_num, frame,
+                                                   self.max_payload_size):
+            self.socket.sendto(datagram, auth_client.receiver_address)
+
+            self.bytes_sent += len(datagram)
+
+        self.frames_sent += 1
+
+    def _send_fragment(self, identifier, fragment_info):
+        auth_client = self._get_auth_client(identifier)
+
+        if auth_client is None:
+            self.fragments_dropped += 1
+            return
+
+        sequence_num, max_fragments, fragment_num, fragment = fragment_info
+
+        # Only the token (and the header format, if the target negotiated a
+        # different protocol version) changes
+        datagram = protocol.build_fragment(auth_client.token, sequence_num,
+                                           max_fragments, fragment_num,
+                                           fragment,
+                                           auth_client.protocol_version,
+                                           auth_client.checksum)
+
+        self.socket.sendto(datagram, auth_client.receiver_address)
+
+        self.bytes_sent += len(datagram)
+        self.fragments_sent += 1
+
+class RelayManager(object):
+    """
+    Forwards feeds to all relay targets. Feeds relayed in reassembled mode
+    are forwarded as complete frames, by subscribing to the feed cache. Feeds
+    relayed in pass-through mode are forwarded fragment by fragment, as the
+    receiver hands them to `relay_fragment`.
+    """
+    def __init__(self, feed_cache, targets):
+        self.feed_cache = feed_cache
+
+        self.default_mode = relay_settings.mode
+        self.feed_modes = relay_settings.feed_modes
+
+        # Whether pass-through feeds are also reassembled in our own cache,
+        # for local viewers and storage
+        self.cache_passthrough = relay_settings.cache_passthrough
+
+        self.targets = [ RelayTarget(address,
+                                     relay_settings.queue_size,
+                                     relay_settings.fragment_queue_size,
+                                     relay_settings.max_payload_size,
+                                     relay_settings.protocol_version,
+                                     relay_settings.auth_timeout,
+                                     relay_settings.reauthenticate_interval)
+                         for address in targets ]
+
+    def start(self):
+        for target in self.targets:
+            target.start()
+
+        self.feed_cache.add_listener(self._on_frame)
+
+    def get_mode(self, identifier):
+        """
+        :param identifier The identifier of a feed
+
+        :return The relay mode of the feed, REASSEMBLED or PASSTHROUGH
+        """
+        return self.feed_modes.get(identifier, self.default_mode)
+
+    def relay_fragment(self, client, sequence_num, max_fragments, 
+                       fragment_num, fragment):
+        """
+        Forwards a validated fragment if its feed is relayed in pass-through
+        mode. Called by the receiver for every authenticated fragment, before
+        it is cached.
+
+        :param client The client which sent the fragment
+        :param sequence_num The ID of the frame
+        :param max_fragments The number of fragments in the sequence
+        :param fragment_num The ID of the fragment in the sequence
+        :param fragment The fragment data, a str or a memoryview over a
+                        receive buffer
+
+        :return True if the fragment should also be cached locally
+        """
+        if self.get_mode(client.identifier) != PASSTHROUGH:
+            return True
+
+        # The receive buffer is reused, so the relay needs its own copy
+        if isinstance(fragment, memoryview):
+            fragment = fragment.tobytes()
+
+        fragment_info = (sequence_num, max_fragments, fragment_num, fragment)
+
+        for target in self.targets:
+            target.enqueue_fragment(client.identifier, fragment_info)
+
+        return self.cache_passthrough
+
+    def _on_frame(self, cache, frame_info):
+        identifier = cache.client.identifier
+
+        # Pass-through feeds have already been forwarded
+        if self.get_mode(identifier) == PASSTHROUGH:
+            return
+
+        for target in self.targets:
+            target.enqueue(identifier, frame_info)
+
+    def log_stats(self):
+        for target in self.targets:
+            logging.info("Relay to %s:%s: %d frames, %d fragments (%d bytes) "
+                "sent, %d frames, %d fragments dropped", 
+                target.auth_address[0], target.auth_address[1],
+                target.frames_sent, target.fragments_sent, target.bytes_sent,
+                target.frames_dropped, target.fragments_dropped)
+
+    def shutdown(self):
+        self.feed_cache.remove_listener(self._on_frame)
+
+        for target in self.targets:
+            target.stop()
+
+    def server_close(self):
+        pass
@@ -15,30 +15,123 @@ class SettingsDict(dict):
 authentication = SettingsDict({
     "host": "192.168.101.129",
     "port": 56789,
-    "whitelist": [ '192.168.101.1', '192.168.101.129', "192.168.101.128" ]
+    "whitelist": [ '192.168.101.1', '192.168.101.129', "192.168.101.128" ],
+    # The highest fragment protocol version offered to transmitters
+    "protocol_version": 2,
+    # Seconds without a fragment before a transmitter's token expires, after
+    # which it must authenticate again
+    "token_timeout": 300
 })
 
 # Receiver settings
 receiver = SettingsDict({
     "host": "192.168.101.129",
     "port": 56790,
-    "cache_size": 100,
+    "cache_size": 100, # Max frames cached per feed
+    # Max bytes of frames cached across all feeds, the oldest frames are
+    # evicted beyond this. None for no limit.
+    "cache_max_bytes": 256 * 1024 * 1024,
+    # Seconds of frames to keep per feed (None to only limit by frame count
+    # and bytes), and a map of identifier -> seconds for feeds which differ
+    "cache_window": None,
+    "feed_cache_windows": {},
+    # "memory" keeps each feed's cached frames in the daemon process,
+    # "shared" in a shared memory ring (see `sharedmem.SharedFrameStore`)
+    # which other processes can read
+    "cache_backend": "memory",
+    # Directory of the shared rings' files, ideally on a memory filesystem.
+    # None keeps them anonymous, so they're only shared with forked
+    # processes.
+    "shared_cache_dir": "/dev/shm/firefly",
+    "shared_slot_size": 512 * 1024, # Max size of a frame in a shared ring
+    # Max number of frames being reassembled at once per feed, and how long
+    # (in seconds) to wait for a frame's missing fragments before dropping it
+    "reassembly_window": 16,
+    "reassembly_timeout": 2.0,
+    # "threaded" handles every datagram in a new thread, "batched" drains the
+    # socket from a fixed number of long-lived reader threads, and "ioloop"
+    # drains it on the observer's IOLoop in the main thread
+    "mode": "batched",
+    "readers": 1, # Reader threads, "batched" mode only
+    "batch_size": 64, # Max datagrams read per reader wakeup
+    "buffer_size": 65535, # Per reader, must fit the largest datagram
+    # Number of worker processes sharing the receiver port (with
+    # SO_REUSEPORT, Linux 3.9+), 0 to receive in the daemon process. Workers
+    # use "batched" readers, regardless of the mode.
+    "workers": 0,
+    # Frames are handed from workers to the daemon through a shared memory
+    # ring per worker, of this many slots of this many bytes each. Frames
+    # larger than a slot are dropped.
+    "ring_slots": 64,
+    "ring_slot_size": 512 * 1024,
+    "stats_interval": 10, # Seconds between receiver stats log messages
+    # Seconds without a frame before a feed's cache is removed, and seconds
+    # between checking for idle feeds and expired tokens
+    "feed_timeout": 60,
+    "reap_interval": 10
 })
 
 # Relay settings
 relay = SettingsDict({
-    "targets": [ ('1.1.1.1', 12345) ]
+    "enabled": False,
+    # Authentication server addresses of the daemons to forward feeds to
+    "targets": [ ('1.1.1.1', 12345) ],
+    # "reassembled" forwards complete frames, "passthrough" forwards each
+    # fragment as soon as it is received
+    "mode": "reassembled",
+    # Map of feed identifier -> mode, for feeds not using the default mode
+    "feed_modes": {},
+    # Whether pass-through feeds are also reassembled for local viewers
+    "cache_passthrough": True,
+    "queue_size": 30, # Frames queued per target before dropping the oldest
+    "fragment_queue_size": 1024, # Likewise for pass-through fragments
+    "max_payload_size": 4096, # Max frame bytes per datagram
+    "protocol_version": 2, # Highest fragment protocol version to request
+    "auth_timeout": 5, # Seconds
+    # Seconds between re-authenticating (or retrying) with a target
+    "reauthenticate_interval": 60,
+    "stats_interval": 10 # Seconds between relay stats log messages
 })
 
 # Observer settings
 observer = SettingsDict({
     "host": "192.168.101.129",
     "port": 12345,
-    "pool_size": 50
+    # How frames are delivered to viewers, unless the viewer asks otherwise:
+    # "live" always sends the newest frame, "smooth" sends every frame,
+    # catching up at a bounded speed after falling behind, and "replay"
+    # sends every cached frame from a given point (see
+    # `observerhandlers.StreamHandler`)
+    "mode": "live",
+    # Map of feed identifier -> mode, for feeds not using the default mode
+    "feed_modes": {},
+    # Bytes written to a viewer's connection but not yet flushed, beyond
+    # which the viewer skips ahead once its connection catches up: "live"
+    # viewers to the newest frame, "smooth" viewers to the newest cached
+    # frame, and "replay" viewers past the frames due while they waited
+    "max_buffer_bytes": 1024 * 1024,
+    # Max playback speed (relative to the feed's framerate) of "smooth"
+    # viewers catching up
+    "catchup_speed": 2.0
 })
 
 storage = SettingsDict({
     "dir": "storage",
     "db": "firefly.db",
-    "flush_timer": 1000 # Once every 1000ms
+    # Writer threads recording feeds, e.g. one per disk. Each feed is always
+    # recorded by the same writer.
+    "writers": 1,
+    # Frames queued per writer. Frames which don't fit are read back from
+    # the feed's cache later, if they're still cached.
+    "queue_size": 256,
+    "batch_size": 32, # Max frames written (and flushed) at once
+    # Seconds between syncing recordings to disk with fsync, None to leave
+    # it to the OS, or 0 to sync after every batch
+    "fsync_interval": None,
+    # Seconds of footage per segment of a feed's recording
+    "segment_duration": 300,
+    # Max bytes taken up by the recordings of all feeds, None for no limit.
+    # The oldest segments are deleted to stay within it.
+    "max_bytes": None,
+    "stats_interval": 60 # Seconds between storage stats log messages
 })
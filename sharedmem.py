@@ -0,0 +1,488 @@
+"""
+sharedmem.py
+
+Shared memory structures for handing frames between the daemon's processes.
+
+Receiver worker processes (see `receiver.ReceiverPool`) reassemble frames
+and write them into a ring of fixed size slots in an anonymous shared
+memory map, created by the daemon before the workers are forked. Only the
+small (slot, generation) pair then needs to be sent to the daemon process,
+which reads the frame straight out of the shared memory.
+
+Feed caches can also keep their frames in a ring (see `SharedFrameStore`
+and `settings.receiver.cache_backend`). Such a ring is backed by a file,
+ideally on a memory filesystem such as /dev/shm, so any process can map the
+same frames with a `SharedFrameReader`.
+"""
+
+import collections
+import mmap
+import os
+import re
+import struct
+import threading
+import uuid
+
+import storage
+
+# slot count, slot size, generation of the last frame written
+RING_HEADER = struct.Struct("!IIQ")
+
+# generation, sequence number, timestamp, token length, frame length
+SLOT_HEADER = struct.Struct("!QqdHI")
+
+MAX_TOKEN_LENGTH = 64
+
+class FrameRing(object):
+    """
+    A single producer ring of frames in shared memory. Every slot holds one
+    frame, along with the token of the feed it belongs to. Writes never
+    wait for readers: once the ring wraps around, the oldest slots are
+    overwritten, and readers which fall that far behind find the slot's
+    generation has changed and drop the frame.
+
+    The slot's generation is cleared while it's being written and set again
+    afterwards, and readers check it both before and after copying the
+    frame out, so a frame overwritten mid-read is never returned.
+
+    An anonymous ring must be created before the processes sharing it are
+    forked. A ring backed by a file can be opened by any process with
+    `FrameRing.open`.
+    """
+    def __init__(self, slot_count, slot_size, path = None):
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.path = path
+
+        size = RING_HEADER.size + slot_count * slot_size
+
+        if path is None:
+            self.mmap = mmap.mmap(-1, size)
+
+        else:
+            # Never reuse another ring's file, which may still be mapped
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0644)
+
+            try:
+                os.ftruncate(fd, size)
+                self.mmap = mmap.mmap(fd, size)
+
+            finally:
+                os.close(fd)
+
+        RING_HEADER.pack_into(self.mmap, 0, slot_count, slot_size, 0)
+
+        # The generation of the last frame written. Generations start at 1,
+        # so a cleared slot never matches.
+        self._generation = 0
+
+        self._write_lock = threading.Lock()
+
+        # Stats
+        self.frames_written = 0
+        self.frames_too_large = 0
+
+    @classmethod
+    def open(cls, path):
+        """
+        Maps an existing ring, created by another process, for reading.
+
+        :param path The file backing the ring
+
+        :return A FrameRing, which must not be written to
+        """
+        ring = cls.__new__(cls)
+
+        with open(path, "rb") as f:
+            ring.mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        ring.slot_count, ring.slot_size, _ = RING_HEADER.unpack_from(
+                                                                ring.mmap)
+        ring.path = path
+
+        return ring
+
+    @property
+    def max_frame_size(self):
+        return self.slot_size - SLOT_HEADER.size - MAX_TOKEN_LENGTH
+
+    @property
+    def latest_generation(self):
+        """
+        :return The generation of the last frame written, 0 if none has been
+        """
+        return RING_HEADER.unpack_from(self.mmap)[2]
+
+    def get_slot(self, generation):
+        """
+        :return The slot a frame of the given generation is written to
+        """
+        return generation % self.slot_count
+
+    def write(self, token, sequence_num, timestamp, frame):
+        """
+        Writes a frame into the next slot.
+
+        :param token The challenge token of the feed the frame belongs to
+        :param sequence_num The sequence number of the frame
+        :param timestamp The time the frame was completed
+        :param frame The frame data, a str
+
+        :return A (slot, generation) tuple identifying the frame, or None if
+                it doesn't fit in a slot
+        """
+        if len(token) > MAX_TOKEN_LENGTH or len(frame) > self.max_frame_size:
+            self.frames_too_large += 1
+            return None
+
+        with self._write_lock:
+            self._generation += 1
+            generation = self._generation
+
+            slot = self.get_slot(generation)
+            offset = self._get_offset(slot)
+
+            # Invalidate the slot while it's being written
+            SLOT_HEADER.pack_into(self.mmap, offset, 0, 0, 0, 0, 0)
+
+            start = offset + SLOT_HEADER.size
+            self.mmap[start:start + len(token)] = token
+
+            start += len(token)
+            self.mmap[start:start + len(frame)] = frame
+
+            SLOT_HEADER.pack_into(self.mmap, offset, generation, sequence_num,
+                                  timestamp, len(token), len(frame))
+
+            RING_HEADER.pack_into(self.mmap, 0, self.slot_count,
+                                  self.slot_size, generation)
+
+            self.frames_written += 1
+
+        return slot, generation
+
+    def read(self, slot, generation, copy = True):
+        """
+        Reads a frame written by `write`.
+
+        :param slot The slot returned by `write`
+        :param generation The generation returned by `write`
+        :param copy Whether to copy the frame out of the ring. Otherwise the
+                    frame is returned as a buffer over the ring, which is
+                    only valid for as long as `is_current` remains True
+
+        :return A (token, sequence number, timestamp, frame) tuple, or None
+                if the slot has since been overwritten
+        """
+        offset = self._get_offset(slot)
+
+        (slot_generation, sequence_num, timestamp, token_len,
+            frame_len) = SLOT_HEADER.unpack_from(self.mmap, offset)
+
+        if slot_generation != generation:
+            return None
+
+        start = offset + SLOT_HEADER.size
+        token = self.mmap[start:start + token_len]
+
+        start += token_len
+
+        if not copy:
+            return token, sequence_num, timestamp, buffer(self.mmap, start,
+                                                          frame_len)
+
+        frame = self.mmap[start:start + frame_len]
+
+        # The writer may have lapped us while we were copying
+        if not self.is_current(slot, generation):
+            return None
+
+        return token, sequence_num, timestamp, frame
+
+    def read_header(self, slot, generation):
+        """
+        Reads a frame's sequence number and timestamp, without copying the
+        frame.
+
+        :param slot The slot returned by `write`
+        :param generation The generation returned by `write`
+
+        :return A (sequence number, timestamp, frame length) tuple, or None
+                if the slot has since been overwritten
+        """
+        (slot_generation, sequence_num, timestamp, token_len,
+            frame_len) = SLOT_HEADER.unpack_from(self.mmap,
+                                                 self._get_offset(slot))
+
+        if slot_generation != generation:
+            return None
+
+        return sequence_num, timestamp, frame_len
+
+    def invalidate(self, slot, generation):
+        """
+        Marks a slot as no longer holding a frame, so readers skip it, unless
+        it has already been overwritten.
+
+        :param slot The slot returned by `write`
+        :param generation The generation returned by `write`
+        """
+        with self._write_lock:
+            if self.is_current(slot, generation):
+                SLOT_HEADER.pack_into(self.mmap, self._get_offset(slot), 0, 0,
+                                      0, 0, 0)
+
+    def is_current(self, slot, generation):
+        """
+        :return True if the slot still holds the frame of the given
+                generation
+        """
+        return SLOT_HEADER.unpack_from(self.mmap,
+                                       self._get_offset(slot))[0] == generation
+
+    def _get_offset(self, slot):
+        return RING_HEADER.size + slot * self.slot_size
+
+    def close(self):
+        self.mmap.close()
+
+class SharedFrameStore(object):
+    """
+    Holds the most recent frames of a feed in a FrameRing, for use as the
+    frame store of a `caching.FrameCache`. Like the default deque, the
+    store holds (frame, timestamp, sequence number) tuples, up to `size` of
+    them, dropping the oldest as frames are appended. Frames are copied out
+    of the ring when they're read, but their headers can be read on their
+    own (see `get_header`), so frames can be looked up without copying them.
+
+    A store is owned by a FrameCache, and is only accessed with the
+    FrameCache's lock held.
+    """
+    def __init__(self, size, slot_size, path = None):
+        # A spare slot, so other processes never read the slot being written
+        # while it still holds one of our `size` frames
+        self.ring = FrameRing(size + 1, slot_size, path)
+
+        self.size = size
+
+        # (slot, generation) of every frame held, oldest first
+        self._locations = collections.deque(maxlen = size)
+
+    def append(self, frame_info):
+        """
+        :param frame_info A (frame, timestamp, sequence number) tuple
+
+        :raises ValueError When the frame doesn't fit in a slot
+        """
+        frame, ts, sequence_num = frame_info
+
+        location = self.ring.write("", sequence_num, ts, frame)
+
+        if location is None:
+            raise ValueError("Frame %d is larger than %d bytes" % (
+                sequence_num, self.ring.max_frame_size))
+
+        self._locations.append(location)
+
+    def popleft(self):
+        """
+        Drops the oldest frame.
+
+        :return Its (frame, timestamp, sequence number) tuple, where the frame
+                is a buffer over the ring rather than a copy, only valid until
+                the next frame is appended
+        """
+        token, sequence_num, ts, frame = self.ring.read(
+                                *self._locations.popleft(), copy = False)
+
+        return (frame, ts, sequence_num)
+
+    def clear(self):
+        # Readers in other processes must not return the dropped frames
+        # either, as the frames which follow may restart the sequence
+        for location in self._locations:
+            self.ring.invalidate(*location)
+
+        self._locations.clear()
+
+    def __getitem__(self, index):
+        token, sequence_num, ts, frame = self.ring.read(
+                                                *self._locations[index])
+
+        return (frame, ts, sequence_num)
+
+    def get_header(self, index):
+        """
+        :return The (frame length, timestamp, sequence number) of a frame,
+                read from its slot header without copying the frame
+        """
+        sequence_num, ts, frame_len = self.ring.read_header(
+                                                *self._locations[index])
+
+        return (frame_len, ts, sequence_num)
+
+    def __iter__(self):
+        for i in range(len(self._locations)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self._locations)
+
+    def close(self):
+        self.ring.close()
+
+        if self.ring.path is not None:
+            try:
+                os.unlink(self.ring.path)
+
+            except OSError:
+                pass
+
+class SharedFrameReader(object):
+    """
+    Reads the frames of a feed cached in a `SharedFrameStore` by another
+    process, such as the daemon.
+    """
+    def __init__(self, path):
+        self.ring = FrameRing.open(path)
+
+    def get_latest_frame(self, copy = True):
+        """
+        :param copy Whether to copy the frame, see `FrameRing.read`
+
+        :return The most recent (frame, timestamp, sequence number) tuple,
+                or None if there isn't one
+        """
+        generation = self.ring.latest_generation
+
+        if generation == 0:
+            return None
+
+        frame_info = self.ring.read(self.ring.get_slot(generation),
+                                    generation, copy)
+
+        if frame_info is None:
+            return None
+
+        token, sequence_num, ts, frame = frame_info
+
+        return (frame, ts, sequence_num)
+
+    def get_frame(self, last_fid, copy = True):
+        """
+        Gets the oldest frame held with a sequence number after `last_fid`.
+
+        The store writes frames in sequence order, and invalidates the slots
+        it drops, so the frame is found by binary search of the slot
+        headers. Only the frame returned is copied.
+
+        :param last_fid The sequence number of the last frame read
+        :param copy Whether to copy the frame, see `FrameRing.read`
+
+        :return A (frame, timestamp, sequence number) tuple, or None if there
+                are no newer frames
+        """
+        latest = self.ring.latest_generation
+
+        # The store keeps a spare slot, which is the oldest one
+        low = max(1, latest - self.ring.slot_count + 2)
+        high = latest + 1
+
+        # Slots which have been invalidated or overwritten are older than
+        # every frame held
+        while low < high:
+            middle = (low + high) // 2
+
+            header = self.ring.read_header(self.ring.get_slot(middle), middle)
+
+            if header is None or header[0] <= last_fid:
+                low = middle + 1
+            else:
+                high = middle
+
+        # The frame found may be overwritten before it's copied, in which
+        # case the next one is the oldest
+        for generation in range(low, latest + 1):
+            frame_info = self.ring.read(self.ring.get_slot(generation),
+                                        generation, copy)
+
+            if frame_info is not None and frame_info[1] > last_fid:
+                token, sequence_num, ts, frame = frame_info
+
+                return (frame, ts, sequence_num)
+
+        return None
+
+    def close(self):
+        self.ring.close()
+
+def get_store_path(directory, client):
+    """
+    Feeds of different hosts may share an identifier, and a feed's cache may
+    be created again (even for the same client) before the old one is
+    closed, so every store gets a file of its own, named after the feed's
+    identifier and a new uuid.
+
+    :param directory The directory shared frame stores are kept in
+    :param client The AuthenticatedClient the store belongs to
+
+    :return A path for a new store of the client's feed
+    """
+    return os.path.join(directory, "%s.%s.ring" % (
+        storage.get_file_name(client.identifier), uuid.uuid4().hex))
+
+def find_stores(directory, identifier):
+    """
+    Lists the stores of a feed, for other processes to open with a
+    `SharedFrameReader`.
+
+    :param directory The directory shared frame stores are kept in
+    :param identifier The identifier of a feed
+
+    :return The paths of the files backing the feed's stores (one per
+            client transmitting the feed, plus any not yet closed), most
+            recently created first
+    """
+    pattern = re.compile(r"^%s\.[0-9a-f]{32}\.ring$" % re.escape(
+        storage.get_file_name(identifier)))
+
+    paths = []
+
+    for name in os.listdir(directory):
+        if not pattern.match(name):
+            continue
+
+        path = os.path.join(directory, name)
+
+        try:
+            paths.append((os.path.getctime(path), path))
+
+        except OSError:
+            # Closed in the meantime
+            pass
+
+    return [ path for ctime, path in sorted(paths, reverse = True) ]
+
+def create_store_factory(directory, slot_size):
+    """
+    Creates a function creating a SharedFrameStore for each feed, to pass to
+    `caching.FeedCache`.
+
+    :param directory The directory to keep the stores' files in, or None for
+                     anonymous stores (only shared with forked processes)
+    :param slot_size The size of each store's slots, which limits the size
+                     of the frames it can hold
+
+    :return A callable taking a client and a cache size
+    """
+    if directory is not None and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    def create_store(client, size):
+        path = None
+        if directory is not None:
+            path = get_store_path(directory, client)
+
+        return SharedFrameStore(size, slot_size, path)
+
+    return create_store
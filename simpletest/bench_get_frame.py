@@ -0,0 +1,77 @@
+"""
+A micro-benchmark comparing the original linear scan of `get_frame` with the
+indexed lookup of the caching module, at several cache sizes. Both take the
+frame cache's lock, as the original did. Caches are filled with consecutive
+frames, and with frames where every fifth one was lost (so lookups can't go
+straight to the next sequence number). We report the average time of a
+lookup from a random position in the cache, along with
+`get_latest_frame`.
+"""
+
+import collections
+import random
+import sys
+import threading
+import timeit
+sys.path.append('..') # required to import from upper directory
+
+import authentication
+import caching
+
+CACHE_SIZES = (100, 1000, 10000)
+LOOKUPS = 1000
+REPEATS = 5
+
+def linear_get_frame(cache, lock, last_fid):
+    """
+    The original lookup, scanning from the oldest frame.
+    """
+    with lock:
+        for f, ts, fid in cache:
+            if fid > last_fid:
+                return (f, ts, fid)
+
+        return None
+
+def fill(size, lossy):
+    client = authentication.AuthenticatedClient('127.0.0.1', 'BENCH')
+    frame_cache = caching.FrameCache(size, client)
+    deque_cache = collections.deque(maxlen = size)
+
+    fids = [ fid for fid in range(size * 2) if not (lossy and fid % 5 == 4) ]
+
+    for fid in fids[-size:]:
+        frame_cache.add_frame(fid, 1, 0, "frame\xff\xd9")
+        deque_cache.append(("frame\xff\xd9", 0, fid))
+
+    return frame_cache, deque_cache, fids[-size:]
+
+if __name__ == "__main__":
+    for lossy in (False, True):
+        print "%s frames:" % ("Lossy" if lossy else "Consecutive")
+
+        for size in CACHE_SIZES:
+            frame_cache, deque_cache, fids = fill(size, lossy)
+            lock = threading.RLock()
+
+            last_fids = [ random.choice(fids) - 1 for _ in range(LOOKUPS) ]
+
+            assert all(frame_cache.get_frame(fid)[2]
+                       == linear_get_frame(deque_cache, lock, fid)[2]
+                       for fid in last_fids), "Lookups disagree"
+
+            # The best of several runs, to leave out other processes
+            linear = min(timeit.repeat(lambda: [ linear_get_frame(deque_cache,
+                                                                  lock, f)
+                                                 for f in last_fids ],
+                                       repeat = REPEATS, number = 1))
+            indexed = min(timeit.repeat(lambda: [ frame_cache.get_frame(f)
+                                                  for f in last_fids ],
+                                        repeat = REPEATS, number = 1))
+            latest = timeit.timeit(frame_cache.get_latest_frame,
+                                   number = LOOKUPS)
+
+            print "  %5d frames: linear %8.2f us, indexed %5.2f us, latest " \
+                "%5.2f us per lookup" % (size, 1e6 * linear / LOOKUPS,
+                                         1e6 * indexed / LOOKUPS,
+                                         1e6 * latest / LOOKUPS)
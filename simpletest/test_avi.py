@@ -0,0 +1,109 @@
+"""
+Tests the MJPEG AVI writer. The JPEG frames of the test video are written
+into a new AVI with made up timestamps, which is then parsed again to check
+its headers, that its AVI index and its timestamp index both point at every
+frame intact, and that the framerate was measured from the timestamps. The
+new AVI is then read back by time.
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import sys
+sys.path.append('..') # required to import from upper directory
+
+import avi
+
+FPS = 9.0
+
+def read_chunks(data, start, end):
+    """
+    :return A list of (FourCC, offset of the data, data) of the chunks
+            between start and end
+    """
+    chunks = []
+
+    while start + 8 <= end:
+        fourcc, size = avi.CHUNK_HEADER.unpack_from(data, start)
+        chunks.append((fourcc, start + 8, data[start + 8:start + 8 + size]))
+
+        start += 8 + size + size % 2
+
+    return chunks
+
+def read_frames(path):
+    data = open(path, "rb").read()
+    movi = data.find("movi")
+
+    _, size = avi.CHUNK_HEADER.unpack_from(data, movi - 8)
+
+    return [ chunk for fourcc, offset, chunk
+             in read_chunks(data, movi + 4, movi - 4 + size)
+             if fourcc == "00dc" ]
+
+if __name__ == "__main__":
+    frames = read_frames("lepton_6.avi")
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "test.avi")
+
+    writer = avi.AVIWriter(path, 30)
+    for i, frame in enumerate(frames):
+        writer.write(frame, 1000 + i / FPS)
+    writer.close()
+
+    data = open(path, "rb").read()
+
+    riff, size = avi.CHUNK_HEADER.unpack_from(data)
+    print "RIFF size matches the file: %s" % (size + 8 == len(data))
+
+    # hdrl, movi and idx1
+    chunks = read_chunks(data, 12, len(data))
+
+    header_list = chunks[0][2]
+    main_header = avi.MAIN_HEADER.unpack_from(header_list, 12)
+    print "Frames in header: %d/%d, size %dx%d, %d us per frame" % (
+        main_header[4], len(frames), main_header[8], main_header[9],
+        main_header[0])
+
+    movi_offset = data.find("movi")
+    avi_index = chunks[2][2]
+
+    intact = 0
+    for i in range(len(avi_index) / avi.AVI_INDEX_ENTRY.size):
+        ckid, flags, offset, length = avi.AVI_INDEX_ENTRY.unpack_from(
+                                        avi_index, i * avi.AVI_INDEX_ENTRY.size)
+        start = movi_offset + offset + 8
+
+        intact += data[start:start + length] == frames[i]
+
+    print "AVI index: %d entries, %d frames intact" % (
+        len(avi_index) / avi.AVI_INDEX_ENTRY.size, intact)
+
+    index = open(avi.get_index_path(path), "rb").read()
+
+    intact = 0
+    for i in range(len(index) / avi.INDEX_ENTRY.size):
+        ts, offset, length = avi.INDEX_ENTRY.unpack_from(index,
+                                                i * avi.INDEX_ENTRY.size)
+
+        intact += (data[offset:offset + length] == frames[i]
+                   and abs(ts - (1000 + i / FPS)) < 1e-6)
+
+    print "Timestamp index: %d entries, %d frames intact" % (
+        len(index) / avi.INDEX_ENTRY.size, intact)
+
+    reader = avi.AVIReader(path)
+
+    # Every frame of the second second
+    start = reader.find_frame(1001)
+    read = list(reader.read_frames(1001, 1002))
+
+    print "Reader: second 1 starts at frame %d, %d frames read, intact: %s" % (
+        start, len(read), [ frame for frame, ts in read ]
+                          == frames[start:start + len(read)])
+
+    reader.close()
+
+    shutil.rmtree(directory)
@@ -0,0 +1,176 @@
+"""
+Measures end-to-end frame latency, from a frame's first fragment being sent
+to the whole frame being read by a viewer, for each receiver mode. The
+receiver and observer are run in this process on loopback; every frame
+carries the time it was sent, and a viewer connected to the observer reads
+the stream and compares it against the time the frame arrives.
+"""
+
+import socket
+import threading
+import time
+import sys
+sys.path.append('..') # required to import from upper directory
+
+import logging
+logging.basicConfig(level = logging.WARN)
+
+import settings
+
+import authentication
+import caching
+import protocol
+import receiver
+import observer
+
+import tornado.ioloop
+
+NUM_FRAMES = 200
+FRAME_SIZE = 30000
+FRAME_INTERVAL = 0.02
+# Each mode gets its own observer port, counting up from here
+OBSERVER_PORT = 18124
+
+def transmit(token, receiver_address):
+    transmitter = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    padding = "\x00" * FRAME_SIZE
+
+    # Sequence 0 is the frame sent before the viewer joins
+    for seq in range(1, NUM_FRAMES + 1):
+        frame = "%.6f\x00%s\xff\xd9" % (time.time(), padding)
+
+        for datagram in protocol.fragment_frame(token, seq, frame, 4096, 2):
+            transmitter.sendto(datagram, receiver_address)
+
+        time.sleep(FRAME_INTERVAL)
+
+    transmitter.close()
+
+def view(port, identifier, latencies):
+    """
+    Reads the (HTTP/1.0, so not chunked) multipart stream, recording the
+    latency of every frame.
+    """
+    viewer = socket.create_connection(('127.0.0.1', port))
+    viewer.sendall("GET /feed/%s HTTP/1.0\r\n\r\n" % identifier)
+    viewer.settimeout(2)
+
+    data = ""
+    first = True
+
+    try:
+        while True:
+            received = viewer.recv(65536)
+
+            if not received:
+                break
+
+            data += received
+
+            while True:
+                start = data.find("Content-Length: ")
+                header_end = data.find("\r\n\r\n", start)
+
+                if start == -1 or header_end == -1:
+                    break
+
+                length = int(data[start + 16:data.find("\r\n", start)])
+
+                if len(data) < header_end + 4 + length:
+                    break
+
+                frame = data[header_end + 4:header_end + 4 + length]
+                data = data[header_end + 4 + length:]
+
+                # The first frame is the latest one cached when we joined
+                if not first:
+                    sent = float(frame[:frame.find("\x00")])
+                    latencies.append(time.time() - sent)
+
+                first = False
+
+    except socket.timeout:
+        pass
+
+    viewer.close()
+
+def measure(mode, port):
+    settings.receiver.mode = mode
+
+    authenticator = authentication.Authenticator()
+    feed_cache = caching.FeedCache(settings.receiver.cache_size)
+
+    receiver_server = receiver.create_server(('127.0.0.1', 0), authenticator,
+                                             feed_cache)
+
+    if mode == "ioloop":
+        receiver_server.start()
+
+    else:
+        t = threading.Thread(target = receiver_server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    observer_server = observer.ObserverServer(('127.0.0.1', port),
+                                              feed_cache)
+
+    identifier = "LATENCY_%s" % mode.upper()
+    client = authenticator.add_new_client('127.0.0.1', identifier)
+
+    latencies = []
+
+    viewer = threading.Thread(target = view, args = (port, identifier,
+                                                     latencies))
+
+    def run_test():
+        """
+        Runs alongside the IOLoop, as the "ioloop" receiver only handles
+        datagrams while it is running.
+        """
+        # Send a frame so the feed exists before the viewer joins
+        transmitter = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        transmitter.sendto(protocol.build_fragment(client.token, 0, 1, 0,
+            "0\x00\xff\xd9", 2), receiver_server.server_address)
+        time.sleep(0.2)
+
+        viewer.start()
+        time.sleep(0.2)
+
+        transmit(client.token, receiver_server.server_address)
+
+    t = threading.Thread(target = run_test)
+    t.daemon = True
+    t.start()
+
+    io_loop = tornado.ioloop.IOLoop.instance()
+
+    def stop_when_done():
+        if not t.is_alive() and not viewer.is_alive():
+            io_loop.stop()
+
+    checker = tornado.ioloop.PeriodicCallback(stop_when_done, 100)
+    checker.start()
+
+    observer_server.run()
+
+    checker.stop()
+    receiver_server.stop_server()
+
+    for feed_broadcaster in observer_server.application.broadcasters.values():
+        feed_broadcaster.close()
+
+    return latencies
+
+if __name__ == "__main__":
+    for i, mode in enumerate(("batched", "ioloop")):
+        latencies = sorted(measure(mode, OBSERVER_PORT + i))
+
+        if not latencies:
+            print "%-8s: no frames received" % mode
+            continue
+
+        print "%-8s: %d/%d frames, latency mean %.2f ms, median %.2f ms, " \
+            "99th percentile %.2f ms" % (mode, len(latencies), NUM_FRAMES,
+                1000 * sum(latencies) / len(latencies),
+                1000 * latencies[len(latencies) // 2],
+                1000 * latencies[int(len(latencies) * 0.99)])
@@ -0,0 +1,148 @@
+"""
+Tests that the reaper only expires the tokens of transmitters which have
+stopped sending. A feed relayed in pass-through mode without being cached
+locally keeps sending for several token timeouts, and all of its frames
+should arrive at a second daemon, while the token of a transmitter which
+went quiet is expired and its feed removed.
+"""
+
+import socket
+import threading
+import time
+import sys
+sys.path.append('..') # required to import from upper directory
+
+import logging
+logging.basicConfig(level = logging.WARN)
+
+import settings
+
+# The relay authenticates from loopback
+settings.authentication.whitelist.append('127.0.0.1')
+
+import authentication
+import caching
+import protocol
+import reaper
+import receiver
+import relay
+
+import tornado.ioloop
+
+FEED_TIMEOUT = 0.5
+TOKEN_TIMEOUT = 1.0
+REAP_INTERVAL = 0.2
+
+# Pass-through frames are sent for this many token timeouts
+NUM_FRAMES = 80
+FRAME_INTERVAL = 0.05
+
+class NullStorageManager(object):
+    """ The second daemon doesn't record anything """
+    def add_client(self, client):
+        pass
+
+def transmit(token, receiver_address):
+    transmitter = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    for seq in range(NUM_FRAMES):
+        frame = "seq %d\x00%s\xff\xd9" % (seq, "\x00" * 10000)
+
+        for datagram in protocol.fragment_frame(token, seq, frame, 4096, 2):
+            transmitter.sendto(datagram, receiver_address)
+
+        time.sleep(FRAME_INTERVAL)
+
+    transmitter.close()
+
+if __name__ == "__main__":
+    # Second daemon
+    remote_authenticator = authentication.Authenticator()
+    remote_cache = caching.FeedCache(NUM_FRAMES)
+
+    remote_receiver = receiver.BatchedReceiverServer(('127.0.0.1', 0),
+        remote_authenticator, remote_cache)
+
+    remote_auth = authentication.AuthenticationServer(('127.0.0.1', 0),
+        remote_authenticator, remote_receiver.server_address,
+        NullStorageManager())
+
+    for server in (remote_receiver, remote_auth):
+        t = threading.Thread(target = server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    # Local daemon, relaying to the second one without caching the
+    # pass-through feed
+    local_authenticator = authentication.Authenticator()
+    local_cache = caching.FeedCache(NUM_FRAMES)
+
+    relay_manager = relay.RelayManager(local_cache,
+                                       [ remote_auth.server_address ])
+    relay_manager.feed_modes = { 'PASSTHROUGH_TEST': relay.PASSTHROUGH }
+    relay_manager.cache_passthrough = False
+    relay_manager.start()
+
+    local_receiver = receiver.BatchedReceiverServer(('127.0.0.1', 0),
+        local_authenticator, local_cache, relay_manager)
+
+    t = threading.Thread(target = local_receiver.serve_forever)
+    t.daemon = True
+    t.start()
+
+    feed_reaper = reaper.FeedReaper(local_cache, local_authenticator,
+                                    FEED_TIMEOUT, TOKEN_TIMEOUT,
+                                    REAP_INTERVAL)
+    feed_reaper.start()
+
+    passthrough_client = local_authenticator.add_new_client('127.0.0.1',
+        'PASSTHROUGH_TEST')
+    idle_client = local_authenticator.add_new_client('127.0.0.1',
+        'IDLE_TEST')
+
+    def run_test():
+        # A single frame, after which the transmitter goes quiet
+        transmitter = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        transmitter.sendto(protocol.build_fragment(idle_client.token, 0, 1, 0,
+            "idle\xff\xd9", 2), local_receiver.server_address)
+        transmitter.close()
+
+        transmit(passthrough_client.token, local_receiver.server_address)
+
+        time.sleep(0.5)
+
+    t = threading.Thread(target = run_test)
+    t.daemon = True
+    t.start()
+
+    io_loop = tornado.ioloop.IOLoop.instance()
+
+    def stop_when_done():
+        if not t.is_alive():
+            io_loop.stop()
+
+    checker = tornado.ioloop.PeriodicCallback(stop_when_done, 100)
+    checker.start()
+
+    io_loop.start()
+
+    checker.stop()
+    feed_reaper.stop()
+
+    relay_manager.shutdown()
+    local_receiver.stop_server()
+    remote_receiver.stop_server()
+    remote_auth.shutdown()
+    remote_auth.server_close()
+
+    try:
+        relayed = len(remote_cache.get_cache('PASSTHROUGH_TEST'))
+    except caching.NoCacheFoundError:
+        relayed = 0
+
+    print "Pass-through feed: relayed %d/%d frames, token expired: %s" % (
+        relayed, NUM_FRAMES, passthrough_client.expired)
+    print "Idle feed: removed: %s, token expired: %s" % (
+        'IDLE_TEST' not in local_cache.get_identifiers(), idle_client.expired)
+    print "Feeds reaped: %d, tokens expired: %d" % (feed_reaper.feeds_reaped,
+        feed_reaper.tokens_expired)
@@ -0,0 +1,96 @@
+"""
+A loopback test of the multi-process receiver. A pool of worker processes
+shares the receiver port, and several transmitters (each with its own
+socket, so the kernel spreads them between the workers) authenticate with
+the authentication server after the workers have started. We then check
+that every feed's frames arrive intact in this process' feed cache.
+"""
+
+import socket
+import threading
+import time
+import sys
+sys.path.append('..') # required to import from upper directory
+
+import logging
+logging.basicConfig(level = logging.INFO)
+
+import settings
+
+settings.authentication.whitelist.append('127.0.0.1')
+
+import authentication
+import caching
+import receiver
+
+NUM_FEEDS = 4
+NUM_WORKERS = 2
+NUM_FRAMES = 50
+
+class NullStorageManager(object):
+    def add_client(self, client):
+        pass
+
+if __name__ == "__main__":
+    authenticator = authentication.Authenticator()
+    feed_cache = caching.FeedCache(NUM_FRAMES)
+
+    pool = receiver.ReceiverPool(('127.0.0.1', 0), authenticator, feed_cache,
+                                 workers = NUM_WORKERS)
+
+    auth_server = authentication.AuthenticationServer(('127.0.0.1', 0),
+        authenticator, pool.server_address, NullStorageManager())
+
+    for server in (pool, auth_server):
+        t = threading.Thread(target = server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    frame = "".join(chr(i % 256) for i in range(20000)) + "\xff\xd9"
+
+    transmitters = []
+    for i in range(NUM_FEEDS):
+        client = authentication.SimpleAuthenticationClient(
+            auth_server.server_address, "POOL_TEST_%d" % i)
+        client.authenticate()
+
+        transmitters.append((client,
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM)))
+
+    for seq in range(NUM_FRAMES):
+        for client, transmitter in transmitters:
+            for datagram in client.fragment_frame(seq, frame, 4096):
+                transmitter.sendto(datagram, client.receiver_address)
+
+        time.sleep(0.01)
+
+    time.sleep(0.5)
+
+    for client, transmitter in transmitters:
+        try:
+            cache = feed_cache.get_cache(client.identifier)
+
+        except caching.NoCacheFoundError:
+            print "FAIL: no frames of %s were received" % client.identifier
+            continue
+
+        received = []
+        last_fid = -1
+        while True:
+            next_frame = cache.get_frame(last_fid)
+
+            if next_frame is None:
+                break
+
+            received.append(next_frame[0] == frame)
+            last_fid = next_frame[2]
+
+        print "%s: received %d/%d frames, %d intact" % (client.identifier,
+            len(received), NUM_FRAMES, received.count(True))
+
+    print "Frames received per worker: %s, %d overrun" % (pool.worker_frames,
+                                                          pool.frames_overrun)
+
+    pool.stop_server()
+    auth_server.shutdown()
+    auth_server.server_close()
@@ -0,0 +1,111 @@
+"""
+A simple relay test on loopback. A second daemon (authentication server and
+receiver) is started in this process, and a relay manager is pointed at it.
+Frames are then added to the local feed cache as if they had been received,
+and we check that they arrive in the second daemon's cache. A second feed is
+relayed in pass-through mode, by sending its fragments to a local receiver.
+"""
+
+import socket
+import threading
+import time
+import sys
+sys.path.append('..') # required to import from upper directory
+
+import settings
+
+# The relay authenticates from loopback
+settings.authentication.whitelist.append('127.0.0.1')
+
+import authentication
+import caching
+import protocol
+import receiver
+import relay
+
+NUM_FRAMES = 50
+
+class NullStorageManager(object):
+    """ The second daemon doesn't record anything """
+    def add_client(self, client):
+        pass
+
+# Second daemon
+remote_authenticator = authentication.Authenticator()
+remote_cache = caching.FeedCache(NUM_FRAMES)
+
+remote_receiver = receiver.BatchedReceiverServer(('127.0.0.1', 0),
+    remote_authenticator, remote_cache)
+
+remote_auth = authentication.AuthenticationServer(('127.0.0.1', 0),
+    remote_authenticator, remote_receiver.server_address,
+    NullStorageManager())
+
+for server in (remote_receiver, remote_auth):
+    t = threading.Thread(target = server.serve_forever)
+    t.daemon = True
+    t.start()
+
+# Local daemon, relaying to the second one
+local_authenticator = authentication.Authenticator()
+local_cache = caching.FeedCache(NUM_FRAMES)
+
+relay_manager = relay.RelayManager(local_cache, [ remote_auth.server_address ])
+relay_manager.feed_modes = { 'PASSTHROUGH_TEST': relay.PASSTHROUGH }
+relay_manager.start()
+
+local_receiver = receiver.BatchedReceiverServer(('127.0.0.1', 0),
+    local_authenticator, local_cache, relay_manager)
+
+t = threading.Thread(target = local_receiver.serve_forever)
+t.daemon = True
+t.start()
+
+client = local_authenticator.add_new_client('127.0.0.1', 'RELAY_TEST')
+passthrough_client = local_authenticator.add_new_client('127.0.0.1',
+    'PASSTHROUGH_TEST')
+
+transmitter = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+# A frame large enough to be split into several fragments
+frame = "".join(chr(i % 256) for i in range(20000)) + "\xff\xd9"
+
+for seq in range(NUM_FRAMES):
+    local_cache.cache_frame(client, seq, 1, 0, frame)
+
+    for datagram in protocol.fragment_frame(passthrough_client.token, seq,
+                                            frame, 4096):
+        transmitter.sendto(datagram, local_receiver.server_address)
+
+    time.sleep(0.01)
+
+time.sleep(0.5)
+
+relay_manager.log_stats()
+relay_manager.shutdown()
+
+for identifier in ('RELAY_TEST', 'PASSTHROUGH_TEST'):
+    try:
+        relayed = remote_cache.get_cache(identifier)
+    except caching.NoCacheFoundError:
+        print "FAIL: no frames of %s were relayed" % identifier
+        continue
+
+    received = []
+    last_fid = -1
+    while True:
+        next_frame = relayed.get_frame(last_fid)
+
+        if next_frame is None:
+            break
+
+        received.append(next_frame[0] == frame)
+        last_fid = next_frame[2]
+
+    print "%s: relayed %d/%d frames, %d intact" % (identifier, len(received),
+        NUM_FRAMES, received.count(True))
+
+local_receiver.stop_server()
+remote_receiver.stop_server()
+remote_auth.shutdown()
+remote_auth.server_close()
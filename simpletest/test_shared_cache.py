@@ -0,0 +1,127 @@
+"""
+Tests the shared memory frame store. The same frames are cached in a feed
+cache keeping frames in memory and one keeping them in shared rings, and we
+check both caches return the same frames. Another process then finds the
+shared ring by the feed's identifier and reads the frames back. Finally a
+feed with the same identifier from another host gets a ring of its own,
+which outlives the first one being closed, and so does that feed when it
+resumes before its old cache is closed.
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import sys
+sys.path.append('..') # required to import from upper directory
+
+import authentication
+import caching
+import sharedmem
+
+CACHE_SIZE = 10
+NUM_FRAMES = 25
+
+def make_frame(seq):
+    return ("frame %d " % seq) * (seq * 100 + 1) + "\xff\xd9"
+
+def read_from_other_process(path, results):
+    reader = sharedmem.SharedFrameReader(path)
+
+    latest = reader.get_latest_frame()
+    results.put(("latest", latest[2], latest[0] == make_frame(latest[2])))
+
+    frames = []
+    last_fid = -1
+    while True:
+        frame_info = reader.get_frame(last_fid)
+
+        if frame_info is None:
+            break
+
+        frames.append((frame_info[2], frame_info[0] == make_frame(frame_info[2])))
+        last_fid = frame_info[2]
+
+    results.put(("frames", frames))
+
+    reader.close()
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+
+    client = authentication.AuthenticatedClient('127.0.0.1', 'SHARED_TEST')
+
+    memory_cache = caching.FeedCache(CACHE_SIZE)
+    shared_cache = caching.FeedCache(CACHE_SIZE, store_factory =
+        sharedmem.create_store_factory(directory, 64 * 1024))
+
+    for seq in range(NUM_FRAMES):
+        for feed_cache in (memory_cache, shared_cache):
+            feed_cache.cache_frame(client, seq, 1, 0, make_frame(seq))
+
+    memory_frames = memory_cache.get_cache('SHARED_TEST')
+    shared_frames = shared_cache.get_cache('SHARED_TEST')
+
+    same = (len(memory_frames) == len(shared_frames)
+            and memory_frames.get_latest_frame()[0::2]
+                == shared_frames.get_latest_frame()[0::2]
+            and all(memory_frames.get_frame(fid)[0::2]
+                    == shared_frames.get_frame(fid)[0::2]
+                    for fid in range(-1, NUM_FRAMES - 1)))
+
+    print "In-process: %d frames cached, same as the memory cache: %s" % (
+        len(shared_frames), same)
+
+    results = multiprocessing.Queue()
+
+    p = multiprocessing.Process(target = read_from_other_process,
+        args = (sharedmem.find_stores(directory, 'SHARED_TEST')[0], results))
+    p.start()
+
+    name, seq, intact = results.get()
+    print "Other process: latest frame %d, intact: %s" % (seq, intact)
+
+    name, frames = results.get()
+    print "Other process: read frames %s, all intact: %s" % (
+        [ seq for seq, intact in frames ], all(x[1] for x in frames))
+
+    p.join()
+
+    other_client = authentication.AuthenticatedClient('127.0.0.2',
+                                                      'SHARED_TEST')
+
+    for seq in range(NUM_FRAMES):
+        shared_cache.cache_frame(other_client, seq, 1, 0, make_frame(seq))
+
+    other_frames = shared_cache.caches[other_client]
+
+    stores = sharedmem.find_stores(directory, 'SHARED_TEST')
+    print "Second host: %d stores for the identifier, first feed intact: %s" % (
+        len(stores), shared_frames.get_frame(-1)[0]
+                     == make_frame(NUM_FRAMES - CACHE_SIZE))
+
+    shared_frames.close()
+
+    stores = sharedmem.find_stores(directory, 'SHARED_TEST')
+    reader = sharedmem.SharedFrameReader(stores[0])
+
+    print "After closing the first feed: %d store left, second feed " \
+        "intact: %s" % (len(stores), reader.get_latest_frame()[0]
+                                     == make_frame(NUM_FRAMES - 1))
+
+    reader.close()
+
+    # The feed resumes before its old cache has been closed
+    shared_cache.remove_cache(other_client)
+    shared_cache.cache_frame(other_client, NUM_FRAMES, 1, 0,
+                             make_frame(NUM_FRAMES))
+
+    resumed_frames = shared_cache.caches[other_client]
+
+    print "Resumed before closing: %d stores, resumed feed intact: %s" % (
+        len(sharedmem.find_stores(directory, 'SHARED_TEST')),
+        resumed_frames.get_frame(-1)[0] == make_frame(NUM_FRAMES))
+
+    other_frames.close()
+    resumed_frames.close()
+    shutil.rmtree(directory)
@@ -0,0 +1,148 @@
+"""
+Tests that "smooth" and "replay" viewers carry on after the transmitter
+restarts its sequence numbers. A feed is transmitted from a high sequence
+number, viewers join, and the transmitter then starts over from 0. Every
+viewer should receive the frames of both sequences, in order.
+"""
+
+import re
+import socket
+import threading
+import time
+import sys
+sys.path.append('..') # required to import from upper directory
+
+import logging
+logging.basicConfig(level = logging.WARN)
+
+import authentication
+import caching
+import protocol
+import receiver
+import observer
+
+import tornado.ioloop
+
+OBSERVER_PORT = 18134
+IDENTIFIER = "RESTART_TEST"
+
+# Frames of the first sequence, from FIRST_SEQUENCE, then of the restarted
+# one, from 0
+FIRST_SEQUENCE = 5000
+FRAMES_PER_SEQUENCE = 20
+FRAME_INTERVAL = 0.02
+
+def transmit(token, receiver_address):
+    transmitter = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    for first in (FIRST_SEQUENCE, 0):
+        for seq in range(first, first + FRAMES_PER_SEQUENCE):
+            frame = "seq %d\x00%s\xff\xd9" % (seq, "\x00" * 1000)
+
+            for datagram in protocol.fragment_frame(token, seq, frame, 4096, 2):
+                transmitter.sendto(datagram, receiver_address)
+
+            time.sleep(FRAME_INTERVAL)
+
+    transmitter.close()
+
+def view(query, received):
+    """
+    Reads the (HTTP/1.0, so not chunked) multipart stream, recording the
+    sequence number of every frame.
+    """
+    viewer = socket.create_connection(('127.0.0.1', OBSERVER_PORT))
+    viewer.sendall("GET /feed/%s?%s HTTP/1.0\r\n\r\n" % (IDENTIFIER, query))
+    viewer.settimeout(1.5)
+
+    data = ""
+
+    try:
+        while True:
+            chunk = viewer.recv(65536)
+
+            if not chunk:
+                break
+
+            data += chunk
+
+    except socket.timeout:
+        pass
+
+    viewer.close()
+
+    received.extend(int(seq) for seq in re.findall(r"seq (\d+)\x00", data))
+
+if __name__ == "__main__":
+    authenticator = authentication.Authenticator()
+    feed_cache = caching.FeedCache(100)
+
+    receiver_server = receiver.create_server(('127.0.0.1', 0), authenticator,
+                                             feed_cache)
+
+    t = threading.Thread(target = receiver_server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    observer_server = observer.ObserverServer(('127.0.0.1', OBSERVER_PORT),
+                                              feed_cache)
+
+    client = authenticator.add_new_client('127.0.0.1', IDENTIFIER)
+
+    queries = ("mode=smooth", "mode=replay&from_seq=%d" % FIRST_SEQUENCE)
+    results = dict((query, []) for query in queries)
+
+    viewers = [ threading.Thread(target = view, args = (query,
+                                                        results[query]))
+                for query in queries ]
+
+    def run_test():
+        # Send a frame so the feed exists before the viewers join
+        transmitter = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        transmitter.sendto(protocol.build_fragment(client.token,
+            FIRST_SEQUENCE - 1, 1, 0, "seq %d\x00\xff\xd9" % (
+                FIRST_SEQUENCE - 1), 2), receiver_server.server_address)
+        time.sleep(0.2)
+
+        for viewer in viewers:
+            viewer.start()
+        time.sleep(0.2)
+
+        transmit(client.token, receiver_server.server_address)
+
+    t = threading.Thread(target = run_test)
+    t.daemon = True
+    t.start()
+
+    io_loop = tornado.ioloop.IOLoop.instance()
+
+    def stop_when_done():
+        if not t.is_alive() and not any(v.is_alive() for v in viewers):
+            io_loop.stop()
+
+    checker = tornado.ioloop.PeriodicCallback(stop_when_done, 100)
+    checker.start()
+
+    observer_server.run()
+
+    checker.stop()
+    receiver_server.stop_server()
+
+    for feed_broadcaster in observer_server.application.broadcasters.values():
+        feed_broadcaster.close()
+
+    expected = (range(FIRST_SEQUENCE, FIRST_SEQUENCE + FRAMES_PER_SEQUENCE)
+                + range(FRAMES_PER_SEQUENCE))
+
+    for query in queries:
+        received = results[query]
+
+        # Where the sequence numbers go back to 0
+        restart = next((i for i in range(1, len(received))
+                        if received[i] < received[i - 1]), len(received))
+
+        # The smooth viewer also gets the frame which was newest when it
+        # joined, before the frames sent afterwards
+        print "%-30s: %d frames before the restart, %d after, as sent: " \
+            "%s" % (query, restart, len(received) - restart,
+                    received[-len(expected):] == expected)
@@ -4,7 +4,6 @@ A simple test which reads from a video file and sends the frames
 
 import socket
 import time
-import math
 import sys
 sys.path.append('..') # required to import from upper directory
 
@@ -37,7 +36,8 @@ frames_sent = 0
 # This should NEVER be bigger than 8192
 MAX_PACKET_SIZE = 4096
 
-"""<challenge>\x00<seq num>\x00<max fragments>\x00<fragment num>\x00<frame>\x00"""
+# The datagram format (v1 text or v2 binary header) is negotiated by the
+# authentication client, see the protocol module
 
 while True:
     success, image = video.read()
@@ -52,43 +52,12 @@ while True:
     #print repr(frame.tobytes())
 
     frame = frame.tobytes()
-    frame_len = len(frame)
-    if frame_len > MAX_PACKET_SIZE:
-        # need to split the frame into fragments
-        num_fragments = int(math.ceil(1.0*frame_len/MAX_PACKET_SIZE))
-        print "Splitting frame into %d fragments" % num_fragments
+    datagrams = auth.fragment_frame(frames_sent, frame, MAX_PACKET_SIZE)
 
-        fragment_len_sent = 0
-        curr_index = 0
-        end_index = MAX_PACKET_SIZE
-        for i in range(num_fragments):
-            if end_index > frame_len:
-                end_index = frame_len
-
-            print "Frame %s indexing range: %s to %s, fragment: %d" % (
-                    frames_sent, curr_index, end_index, i
-                )
-
-            fragment = frame[curr_index:end_index]
-            print "length of fragment: %s" % len(fragment)
-
-            to_send = "%s\x00%s\x00%s\x00%s\x00%s\x00" % (
-                auth.token, frames_sent, num_fragments, i, fragment
-            )
-
-            #print "Sending %s to %s" % (repr(to_send), auth.receiver_address)
-            c.send(to_send)
-
-            fragment_len_sent += len(fragment)
-
-            curr_index = end_index
-            end_index += MAX_PACKET_SIZE
-
-        print "length sent: %s, frame len: %s" % (fragment_len_sent, frame_len)
-
-    else:
-        to_send = "%s\x00%s\x00%s\x00%s\x00%s\x00" % (auth.token, frames_sent, 1, 1, frame)
+    print "Frame %s split into %d fragments (protocol version %d)" % (
+        frames_sent, len(datagrams), auth.protocol_version)
 
+    for to_send in datagrams:
         #print "Sending %s to %s" % (repr(to_send), auth.receiver_address)
         c.send(to_send)
 
@@ -4,121 +4,600 @@ storage.py
 This module provides classes and methods for writing videos to disk, as well as
 a database interface for state persistence.
 
-We use OpenCV to write the video, rather than directly subprocessing ffmpeg.
-This makes it a bit more platform independent.
+Frames are already JPEGs, so videos are written as Motion JPEG AVIs, by
+appending the frames as they are (see `avi.py`). Nothing is decoded or
+encoded, and no video libraries are needed.
+
+Writing happens on dedicated writer threads (see `StorageWriter`), fed with
+complete frames as the feed cache receives them, so slow disks never hold up
+the IOLoop serving viewers, nor the receiver.
+
+Every feed's recordings are kept in a directory of their own, split into
+segments of `settings.storage.segment_duration` seconds, each named by the
+time of its first frame. When the recordings of all feeds outgrow
+`settings.storage.max_bytes`, the oldest segments are deleted.
 """
 
+import binascii
+import collections
 import logging
 import os
+import re
+import threading
 import time
+import weakref
+
+import avi
+from settings import storage as storage_settings
+
+# Queued in place of the frames of a feed which didn't fit in the queue
+CATCH_UP = object()
+
+def get_file_name(identifier):
+    """
+    :param identifier The identifier of a feed
+
+    :return The name of the feed's files, such as its recordings directory
+            and its shared frame stores (see `sharedmem`). Identifiers which
+            aren't safe to use as file names are hex encoded.
+    """
+    if not re.match(r"^[a-zA-Z0-9_]+$", identifier):
+        identifier = binascii.hexlify(identifier)
+
+    return identifier
+
+def get_feed_directory(directory, identifier):
+    """
+    :param directory The directory recordings are kept in
+    :param identifier The identifier of a feed
+
+    :return The directory of the feed's recordings
+    """
+    return os.path.join(directory, get_file_name(identifier))
+
+def get_segments(feed_directory):
+    """
+    :param feed_directory The directory of a feed's recordings
 
-import cv2
-import numpy as np
+    :return The paths of the feed's segments (AVIs), oldest first
+    """
+    try:
+        names = os.listdir(feed_directory)
+
+    except OSError:
+        return []
 
-import settings
+    return [ os.path.join(feed_directory, name) for name in sorted(names)
+             if name.endswith(".avi") ]
 
-class FFVideoWriter(object):
+def prune_recordings(directory, max_bytes):
     """
-    Wraps the video writing
+    Deletes the least recently written segments, until the recordings of
+    all feeds fit in `max_bytes`. The newest segment of every feed is kept,
+    as it may still be being written.
+
+    :param directory The directory recordings are kept in
+    :param max_bytes The most bytes the recordings may take up
+
+    :return The number of bytes deleted
     """
-    def __init__(self, filename, fps, dim = (60,80), colour = True, 
-                 codec = cv2.cv.CV_FOURCC('M','J','P','G')):
-        
+    total = 0
+    # (modification time, size, path) of the segments which may be deleted
+    candidates = []
+
+    for name in os.listdir(directory):
+        segments = get_segments(os.path.join(directory, name))
+
+        for i, path in enumerate(segments):
+            try:
+                stat = os.stat(path)
+                size = stat.st_size + os.path.getsize(
+                                                avi.get_index_path(path))
+
+            except OSError:
+                # Deleted by another writer
+                continue
+
+            total += size
+
+            if i < len(segments) - 1:
+                candidates.append((stat.st_mtime, size, path))
+
+    deleted = 0
+
+    for mtime, size, path in sorted(candidates):
+        if total - deleted <= max_bytes:
+            break
+
+        logging.info("Deleting recording %s (%d bytes) to stay within the "
+            "storage budget", path, size)
+
+        for to_delete in (path, avi.get_index_path(path)):
+            try:
+                os.unlink(to_delete)
+
+            except OSError:
+                pass
+
+        deleted += size
+
+    return deleted
+
+class StorageWriter(object):
+    """
+    Writes the recordings of a share of the feeds on its own thread. The
+    queue holds at most `queue_size` frames. When it's full, new frames are
+    left in the feed's cache, and read back from it once the writer has
+    caught up with the frames queued before them (see `_catch_up`). Frames
+    pushed out of the cache by then are lost to the overrun.
+
+    Frames are written in batches of up to `batch_size`, and every recording
+    written to is flushed once per batch. If `fsync_interval` isn't None,
+    recordings are also synced to disk at most that many seconds after
+    being written to (after every batch if it's 0).
+
+    A new segment is started before writing a frame `segment_duration`
+    seconds or more after the first frame of the current one, or which
+    wouldn't fit in it (see `avi.MAX_MOVI_SIZE`), so no frames are missed.
+    `on_segment_closed` is called on the writer thread after a segment is
+    closed.
+    """
+    def __init__(self, directory, queue_size, batch_size, fsync_interval,
+                 segment_duration, on_segment_closed = None):
+        self.directory = directory
+
+        self.segment_duration = segment_duration
+        self.on_segment_closed = on_segment_closed
+
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+
+        # Queue of (FrameCache, (frame, timestamp, sequence number)),
+        # (FrameCache, CATCH_UP) to read the frames which didn't fit in the
+        # queue back from the cache, or (FrameCache, None) to close the
+        # feed's recording
+        self.queue = collections.deque()
+        self.queue_size = queue_size
+        self.condition = threading.Condition()
+
+        # Frames (rather than other requests) in the queue
+        self._frames_queued = 0
+
+        # Map of FrameCache -> (number, last sequence number) of the frames
+        # which didn't fit in the queue, since its CATCH_UP was queued
+        self._deferred = {}
+
+        # Map of client -> AVIWriter of the current segment. Only used by the
+        # writer thread.
+        self._recordings = {}
+        # Map of client -> sequence number of the last frame written. Only
+        # used by the writer thread.
+        self._last_written = {}
+        # Recordings written to since they were last synced
+        self._unsynced = set()
+        self._last_sync = time.time()
+
+        # Stats
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.segments_written = 0
+        # Frames which didn't fit in the queue
+        self.frames_deferred = 0
+        # Deferred frames read back from the cache, or lost as they had been
+        # pushed out of it
+        self.frames_recovered = 0
+        self.frames_overrun = 0
+        # Frames which couldn't be written
+        self.frames_dropped = 0
+        self.batches_written = 0
+        # Seconds spent writing batches
+        self.write_time = 0.0
+        # The longest batch write since the stats were last logged
+        self.max_write_time = 0.0
+
+        self._running = False
+        self._thread = None
+
+    def enqueue(self, frame_cache, frame_info):
+        """
+        Queues a frame to be written. Called from the receiver's threads, so
+        this must never block for long.
+
+        :param frame_cache The FrameCache of the feed the frame belongs to
+        :param frame_info The (frame, timestamp, sequence number) tuple
+        """
+        with self.condition:
+            # Once a frame of the feed is deferred, so are the following
+            # ones, until they've all been read back
+            if (self._frames_queued >= self.queue_size
+                    or frame_cache in self._deferred):
+                count, last_sequence_num = self._deferred.get(frame_cache,
+                                                              (0, None))
+
+                if count == 0:
+                    self.queue.append((frame_cache, CATCH_UP))
+
+                self._deferred[frame_cache] = (count + 1, frame_info[2])
+                self.frames_deferred += 1
+
+                return
+
+            self.queue.append((frame_cache, frame_info))
+            self._frames_queued += 1
+
+            self.condition.notify()
+
+    def close_recording(self, frame_cache):
+        """
+        Closes the feed's recording, once the frames queued before it have
+        been written. The next frame of the feed starts a new recording.
+
+        :param frame_cache The FrameCache of the feed
+        """
+        with self.condition:
+            self.queue.append((frame_cache, None))
+
+            self.condition.notify()
+
+    def get_queue_depth(self):
+        """
+        :return The number of frames waiting to be written
+        """
+        return self._frames_queued
+
+    def start(self):
+        self._running = True
+
+        self._thread = threading.Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Writes the frames already queued, closes all recordings, and stops
+        the writer thread.
+        """
+        with self.condition:
+            self._running = False
+            self.condition.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if self._running and not self.queue:
+                    # Wake up when recordings are due to be synced
+                    self.condition.wait(self._get_sync_timeout())
+
+                # Take up to a batch, so the lock is only held briefly
+                batch = []
+                while self.queue and len(batch) < self.batch_size:
+                    batch.append(self.queue.popleft())
+
+                self._frames_queued -= sum(1 for frame_cache, frame_info
+                                           in batch if frame_info is not None
+                                           and frame_info is not CATCH_UP)
+
+                running = self._running
+
+            if batch:
+                self._write_batch(batch)
+
+            elif not running:
+                break
+
+            if self._get_sync_timeout() == 0:
+                self._sync_recordings()
+
+        for client in self._recordings.keys():
+            self._close(client)
 
-        self.filename = os.path.join(settings.storage.dir, filename)
-        self._writer = cv2.VideoWriter(self.filename, 0, fps, dim, colour)
+    def _get_sync_timeout(self):
+        """
+        :return The seconds until unsynced recordings are due to be synced,
+                or None if there's nothing to sync
+        """
+        if self.fsync_interval is None or not self._unsynced:
+            return None
+
+        return max(self._last_sync + self.fsync_interval - time.time(), 0)
+
+    def _write_batch(self, batch):
+        start = time.time()
+
+        written = set()
+
+        for frame_cache, frame_info in batch:
+            client = frame_cache.client
+
+            if frame_info is None:
+                self._close(client)
+                written.discard(client)
+                continue
+
+            if frame_info is CATCH_UP:
+                frames = self._catch_up(frame_cache)
+
+            else:
+                frames = [ frame_info ]
 
-        logging.debug("Attempted to open video file %s. Opened: %d",
-            self.filename, self._writer.isOpened())
+            for frame_info in frames:
+                if self._write(frame_cache, frame_info):
+                    written.add(client)
+
+        for client in written:
+            try:
+                self._recordings[client].flush()
+                self._unsynced.add(client)
+
+            except:
+                logging.exception("Exception flushing recording of '%s'",
+                    client.identifier)
+
+        elapsed = time.time() - start
+
+        self.batches_written += 1
+        self.write_time += elapsed
+        self.max_write_time = max(self.max_write_time, elapsed)
+
+    def _write(self, frame_cache, frame_info):
+        """
+        Writes a frame to the feed's recording, opening one if needed.
+
+        :return True if the frame was written
+        """
+        client = frame_cache.client
+
+        frame, ts, sequence_num = frame_info
 
-    def write(self, frame):
         try:
-            self._writer.write(np.fromstring(frame, dtype = np.uint8))
+            recording = self._recordings.get(client)
+
+            if recording is not None and (recording.is_full(frame)
+                    or ts - recording.first_timestamp
+                        >= self.segment_duration):
+                self._close_segment(client)
+                recording = None
+
+            if recording is None:
+                recording = self._open(frame_cache, ts)
+
+            recording.write(frame, ts)
 
         except:
-            logging.exception("Exception writing frame to disk, file: %s", 
-                self.filename)
+            logging.exception("Exception writing frame of '%s' to disk",
+                client.identifier)
+
+            self.frames_dropped += 1
+
+            return False
+
+        self._last_written[client] = sequence_num
+
+        self.frames_written += 1
+        self.bytes_written += len(frame)
+
+        return True
+
+    def _catch_up(self, frame_cache):
+        """
+        Reads the frames of a feed which didn't fit in the queue back from
+        the feed's cache, in one go. They come after every frame of the feed
+        queued before them, and before any queued after them.
+
+        :param frame_cache The FrameCache of the feed
+
+        :return A list of the (frame, timestamp, sequence number) tuples
+                still in the cache
+        """
+        with self.condition:
+            count, last_sequence_num = self._deferred.pop(frame_cache)
+
+        last_written = self._last_written.get(frame_cache.client, -1)
+
+        # The feed's sequence restarted since the last frame written
+        if last_written >= last_sequence_num:
+            last_written = -1
+
+        frames = frame_cache.get_frames_after(last_written, last_sequence_num)
+
+        # Don't count frames which weren't deferred (e.g. completed late)
+        recovered = min(len(frames), count)
+
+        self.frames_recovered += recovered
+        self.frames_overrun += count - recovered
+
+        if recovered < count:
+            logging.warn("%d frames of '%s' were pushed out of the cache "
+                "before they could be recorded", count - recovered,
+                frame_cache.client.identifier)
+
+        return frames
 
-    def end(self):
-        del self._writer
-        self._writer = None
+    def _sync_recordings(self):
+        for client in self._unsynced:
+            try:
+                self._recordings[client].sync()
 
-    def __del__(self):
-        if self._writer is not None:
-            del self._writer
+            except:
+                logging.exception("Exception syncing recording of '%s'",
+                    client.identifier)
+
+        self._unsynced.clear()
+        self._last_sync = time.time()
+
+    def _open(self, frame_cache, timestamp):
+        """
+        Opens a new segment of a feed's recording, at the feed's estimated
+        framerate. The framerate of the frames written is measured when it's
+        closed.
+
+        :param frame_cache The FrameCache of the feed
+        :param timestamp The time of the segment's first frame
+
+        :return The segment's AVIWriter
+        """
+        client = frame_cache.client
+        fps = frame_cache.get_framerate()
+
+        directory = get_feed_directory(self.directory, client.identifier)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Names sort in the order segments were started
+        segment_name = "%s-%03d" % (time.strftime("%Y-%m-%d-%H-%M-%S",
+            time.localtime(timestamp)), int(timestamp * 1000) % 1000)
+        path = os.path.join(directory, segment_name + '.avi')
+
+        # The feed may have come back within the same millisecond
+        count = 1
+        while os.path.exists(path):
+            path = os.path.join(directory, "%s_%d.avi" % (segment_name,
+                                                          count))
+            count += 1
+
+        logging.debug("Recording '%s' at %.1f fps to %s", client.identifier,
+            fps, path)
+
+        recording = avi.AVIWriter(path, fps)
+        self._recordings[client] = recording
+
+        return recording
+
+    def _close(self, client):
+        """
+        Closes a feed's recording.
+        """
+        self._last_written.pop(client, None)
+
+        self._close_segment(client)
+
+    def _close_segment(self, client):
+        recording = self._recordings.pop(client, None)
+        self._unsynced.discard(client)
+
+        if recording is None:
+            return
+
+        try:
+            recording.close()
+
+        except:
+            logging.exception("Exception closing video file %s",
+                recording.path)
+
+        self.segments_written += 1
+
+        if self.on_segment_closed is not None:
+            try:
+                self.on_segment_closed()
+
+            except:
+                logging.exception("Exception after closing video file %s",
+                    recording.path)
 
 class VideoStorageManager(object):
     """
-    Manages writers for all existing streams (clients)
+    Manages writers for all existing streams (clients). Feeds are spread
+    between `settings.storage.writers` writers, each feed always going to
+    the same one, so its frames are written in order.
     """
     def __init__(self, feed_cache):
         self.feed_cache = feed_cache
 
-        # Map of client -> last frame id
-        self._flush_counter = {}
-        # Map of client -> FFVideoWriter
-        self._writers = {}
+        # Clients whose feeds are recorded. Clients are forgotten once the
+        # authenticator drops them.
+        self._clients = weakref.WeakSet()
 
-    def run(self):
-        """
-        Flush the cache every second
-        """
-        while True:
+        self.writers = [ StorageWriter(storage_settings.dir,
+                                       storage_settings.queue_size,
+                                       storage_settings.batch_size,
+                                       storage_settings.fsync_interval,
+                                       storage_settings.segment_duration,
+                                       self.prune_recordings)
+                         for _ in range(max(storage_settings.writers, 1)) ]
+
+        # Writers prune recordings one at a time
+        self._prune_lock = threading.Lock()
 
-            self.flush_caches()
+        # Stats
+        self.bytes_pruned = 0
 
-            time.sleep(1)
+        feed_cache.add_removal_listener(self._on_feed_removed)
+
+    def start(self):
+        # Recordings from earlier runs count towards the budget too
+        self.prune_recordings()
+
+        for writer in self.writers:
+            writer.start()
+
+        self.feed_cache.add_listener(self._on_frame)
 
     def add_client(self, client):
         """
         Adds a client to be maintained by the manager
         """
-        if (client not in self._flush_counter 
-                and client not in self._writers):
+        self._clients.add(client)
 
-            self._flush_counter[client] = -1
-
-            video_name = client.identifier + time.strftime("_%Y-%m-%d-%H-%M") + '.avi'
-            self._writers[client] = FFVideoWriter(video_name, 24, dim = (60, 80))
+    def remove_client(self, client):
+        """
+        Stops recording a client's feed, closing its video
+        """
+        self._clients.discard(client)
 
+        if client.cache is not None:
+            self._get_writer(client).close_recording(client.cache)
 
-    def flush_caches(self):
+    def prune_recordings(self):
         """
-        Flushes all new frames in existing caches to disk. We need to maintain
-        a count of what frame was last flushed, much like the observer
-        maintains a count so clients receive the latest frame...
+        Deletes the oldest segments if the recordings are over budget (see
+        `prune_recordings`).
         """
-        #logging.debug("Flushing caches")
-        finished = []
+        if (storage_settings.max_bytes is None
+                or not os.path.isdir(storage_settings.dir)):
+            return
 
-        # We use the cache's lock to prevent concurrency issues with other
-        # threads needing the same data while we're iterating...
-        for client, writer in self._writers.iteritems():
-            logging.debug("Checking client %s. Last fid: %d, cache: %s",
-                client, self._flush_counter[client], client.cache)
+        with self._prune_lock:
+            self.bytes_pruned += prune_recordings(storage_settings.dir,
+                                                  storage_settings.max_bytes)
 
-            # Skip clients that don't have a frame cache yet
-            if client.cache is None:
-                continue
+    def _get_writer(self, client):
+        return self.writers[hash(client.identifier) % len(self.writers)]
 
-            next = client.cache.get_frame(self._flush_counter[client])
-            if next is None:
-                finished.append(client)
-                continue
+    def _on_frame(self, frame_cache, frame_info):
+        if frame_cache.client in self._clients:
+            self._get_writer(frame_cache.client).enqueue(frame_cache,
+                                                         frame_info)
 
-            frame, ts, fid = next
+    def _on_feed_removed(self, frame_cache):
+        # The client may come back with new frames, which start a new video
+        self._get_writer(frame_cache.client).close_recording(frame_cache)
 
-            self._flush_counter[client] = fid
+    def log_stats(self):
+        for i, writer in enumerate(self.writers):
+            batches = writer.batches_written
 
-            writer.write(frame)
+            logging.info("Storage writer %d: %d frames (%d bytes) written in "
+                "%d segments, %d deferred (%d read back from the cache, %d lost to cache "
+                "overrun), %d dropped, %d queued, %.1f ms per batch (max %.1f "
+                "ms)", i, writer.frames_written, writer.bytes_written,
+                writer.segments_written, writer.frames_deferred, writer.frames_recovered,
+                writer.frames_overrun, writer.frames_dropped,
+                writer.get_queue_depth(),
+                1000 * writer.write_time / batches if batches else 0,
+                1000 * writer.max_write_time)
 
-        # Temp fix for cleaning up finished streams...
-        for client in finished:
-            self._writers[client].end()
-            del self._writers[client]
+            writer.max_write_time = 0.0
 
-            del self._flush_counter[client]
+        if storage_settings.max_bytes is not None:
+            logging.info("Storage: %d bytes of old recordings deleted",
+                self.bytes_pruned)
 
     def close_all(self):
-        for writer in self._writers.values():
-            writer.end()
+        self.feed_cache.remove_listener(self._on_frame)
+
+        for writer in self.writers:
+            writer.stop()